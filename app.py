@@ -1,12 +1,21 @@
+import avvio
+# i tempi di avvio (vedi avvio.PROFILO) sono misurati dall'inizio dello script, importazioni comprese
+avvio.inizia()
 import polars as pl
 import streamlit as st
-import altair as alt
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
 import numpy as np
 import voti_tidy as vt
 import mappe
 import modelli as mod
+import gemelli
+import densita
+import correlazioni
+import fattoriale
+import componenti
+import spazio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+alt = avvio.importa("altair")
 
 
 """
@@ -17,7 +26,8 @@ sono disponibili sul sito [Eligendo](https://elezionistorico.interno.gov.it/elig
 gestito dal Ministero dell'Interno.
 Scaricando i dati, otteniamo inizialmente una tabella che appare nel formato seguente (riportiamo le prime righe):
 """
-st.dataframe(vt.get_raw_data().head(4))
+st.dataframe(vt.anteprima_raw())
+avvio.primo_elemento()
 """
 In questo formato i dati non sono _tidy_. Infatti, le caratteristiche del comune sono ripetute tante volte
 quante il numero di partiti candidati. Vogliamo, invece, che l'unità statistica sia il singolo comune
@@ -42,54 +52,26 @@ in percentuale, più simili. Due comuni sono detti simili se la loro distanza eu
 nazionalmente hanno superato il 3% è piccola.
 """
 
-# dato un comune, trova e restituisce il comune con la minor distanza euclidea dei voti dei partiti in vt.partitiPlot
-def find_closer(comune:str):
-    comune_row = vt.votiPerc.filter(pl.col("COMUNE")==comune).row(0)
-    closest = "NESSUNO"
-    min_dist = 100000
-    for row in vt.votiPerc.iter_rows():
-        dist = 0
-        if row[3] != comune:
-            for i in range(7,15):
-                dist += (row[i] - comune_row[i]) ** 2
-            if dist < min_dist:
-                min_dist = dist
-                closest = (row[3], row[2])
-
-    return closest
-
-
 df_com = None  # per evitare che sia non definito nel comune gemello
-circoscrizioni = sorted(vt.votiPerc.get_column("CIRCOSCRIZIONE").unique().to_list())
+# le sottounità di ogni livello sono precalcolate nel cubo delle aggregazioni (vt.voti_cube)
+circoscrizioni = vt.sottolivelli("ITALIA")
 df_circ = st.selectbox("Circoscrizione", ["ITALIA"]+circoscrizioni, key="df_circ")
 if df_circ == "ITALIA":
     votiPercDf = vt.voti_grouped_by("ITALIA")
 else:
-    regioni = sorted(
-        vt.votiPerc
-        .filter(pl.col("CIRCOSCRIZIONE") == df_circ)
-        .get_column("REGIONE")
-        .unique().to_list())
+    regioni = vt.sottolivelli("CIRCOSCRIZIONE", df_circ)
     df_reg = st.selectbox("Regione", ["TUTTE"] + regioni, key="df_reg")
 
     if df_reg == "TUTTE":
         votiPercDf = vt.voti_grouped_by("CIRCOSCRIZIONE", df_circ)
     else:
-        province = sorted(
-            vt.votiPerc
-            .filter(pl.col("REGIONE") == df_reg)
-            .get_column("PROVINCIA")
-            .unique().to_list())
+        province = vt.sottolivelli("REGIONE", df_reg)
         df_prov = st.selectbox("Provincia", ["TUTTE"] + province, key="df_prov")
 
         if df_prov == "TUTTE":
             votiPercDf = vt.voti_grouped_by("REGIONE", df_reg)
         else:
-            comuni = sorted(
-                vt.votiPerc
-                .filter(pl.col("PROVINCIA") == df_prov)
-                .get_column("COMUNE")
-                .unique().to_list())
+            comuni = vt.sottolivelli("PROVINCIA", df_prov)
             df_com = st.selectbox("Comune", ["TUTTI"] + comuni, key="df_com")
 
             if df_com == "TUTTI":
@@ -135,7 +117,7 @@ text_bar = (
 
 st.altair_chart(bar_chart + text_bar, use_container_width=True)
 if df_com  is not None and df_com != "TUTTI":
-    gemello = find_closer(df_com)
+    gemello = gemelli.find_closer(df_com)
     st.write(f"Il comune gemello è __{gemello[0].title()}__, nella provincia di {gemello[1].title()}")
 
 """
@@ -149,32 +131,13 @@ distribuzione è più alto. Per uniformità, sono riportati solo i partiti che h
 regioni = sorted(vt.votiPerc.get_column("REGIONE").unique().to_list())
 partitoDistr = st.selectbox("Ripartizione geografica", ["ITALIA"] + regioni, key="distr")
 
-votiPercPlot = (
-    vt.votiPerc.select(
-        ["REGIONE", "PROVINCIA", "COMUNE"] + vt.partitiPlot
-    ).unpivot(
-        on=vt.partitiPlot,
-        index=["REGIONE", "PROVINCIA", "COMUNE"],
-        variable_name="LISTA",
-        value_name="VOTI"
-    ).filter(
-        pl.col("LISTA").is_in(vt.partitiPlot)
-    )
-)
-
-# per "ITALIA" teniamo il dataframe intero, altrimenti lo filtriamo secondo quanto chiesto
-# usiamo nome diverso per evitare il rischio di riusare un dataframe filtrato più avanti
-votiReg = votiPercPlot
-if partitoDistr != "ITALIA":
-    votiReg = votiPercPlot.filter(pl.col("REGIONE") == partitoDistr)
+# le densità di ogni partito sono stimate lato server, una volta sola per ogni regione (vedi densita.get_densita),
+# così al browser vengono inviate solo le curve e non le percentuali di tutti i comuni
+votiReg = densita.get_densita()[partitoDistr]
 
 distrChart = (
     alt.Chart(votiReg)
-    .transform_density(
-        density="VOTI",
-        groupby=["LISTA"],
-        as_=["VOTI", "density"]
-    ).mark_area(
+    .mark_area(
         opacity=0.7
     ).encode(
         alt.X("VOTI:Q", title="Percentuale di voto", scale=alt.Scale(domain=[0, 60])),
@@ -232,7 +195,8 @@ considerando che le due coalizioni assieme raccolgono quasi il 90% dei consensi
 Con queste variabili esplicative, il modello completo risulta
 """
 partitoModel = st.selectbox("Partito di cui visualizzare il modello completo:", vt.partitiPlot, key="compl_model")
-st.write(mod.make_compl_model(partitoModel).summary())
+# il riepilogo è mostrato come testo preformattato, come farebbe st.write con il modello
+st.markdown(f"```\n{mod.riepilogo_compl_model(partitoModel)}\n```")
 """
 Il warning visualizzato non è rilevante ai nostri fini. Molti p-values sono vicini a 0, indicando che le variabili
 considerate sono significative globalmente. Per alcuni partiti, alcune esplicative non risultano significative,
@@ -258,6 +222,9 @@ m_perc = st.number_input("Percentuale di elettori maschi nel comune", min_value=
 affluenza = st.number_input("Affluenza registrata nel comune", min_value=0, max_value=100, value=50, key="mod_affl")
 # creazione e visualizzazione della pie chart
 st.altair_chart(mod.prediction(regione, elettori, m_perc, affluenza), use_container_width=True)
+# gli intervalli bootstrap sono calcolati solo su richiesta, una volta per regione
+if st.checkbox("Mostra gli intervalli di confidenza bootstrap al 95%", key="mod_boot"):
+    st.dataframe(mod.prediction_intervals(regione, elettori, m_perc, affluenza), use_container_width=True)
 """
 __Nota metodologica:__ L'idea di base sarebbe stata quella di modellare l'elettore medio in base alle sue caratteristiche.
 Tale analisi sarebbe possibile avendo a disposizione i valori di un campione di elettori.
@@ -270,6 +237,8 @@ In pratica, questo metodo permette di assumere solamente linearità nella relazi
 con una buona robustezza agli outliers, dovuta al fatto che stiamo stimando la mediana e non la media.
 Il modello non ammette interazione tra le variabili esplicative, dunque l'effetto, ad esempio, dell'aumento di un punto 
 dell'affluenza è considerato costante qualsiasi sia il valore assunto dalle altre esplicative.
+Gli intervalli di confidenza sono ottenuti tramite bootstrap non parametrico: i comuni della regione vengono
+ricampionati con reinserimento e i modelli riadattati su ogni campione (al più 200 campioni, entro un tempo massimo).
 """
 
 """
@@ -282,9 +251,10 @@ tutte le circoscrizioni.
 
 ### Analisi delle correlazioni
 
-Per prima cosa, vediamo quanto può dirci l'andamento di un partito sui risultati degli altri. Il seguente grafico è 
-eccessivamente complesso da ricreare in Python e richiede una ventina di secondi per l'elaborazione, dunque
-lo prendiamo in prestito da R.
+Per prima cosa, vediamo quanto può dirci l'andamento di un partito sui risultati degli altri. Il seguente grafico 
+riproduce quello ottenuto in R col codice qui sotto (che richiede una ventina di secondi per l'elaborazione). 
+Qui gli scatterplot sono sostituiti da istogrammi bidimensionali, più leggeri da visualizzare, e il grafico può essere 
+filtrato per regione.
 ```{r}
 europee <- read.csv("VotiPerc_R.csv", header=TRUE)
 X <- europee[,7:14]
@@ -297,7 +267,11 @@ ggpairs(X,
         diag = list(continuous = "density"))  # Densità
 ```
 """
-st.image("corr.png")
+corrReg = st.selectbox("Ripartizione geografica", ["ITALIA"] + regioni, key="corr")
+st.altair_chart(correlazioni.make_pairs_chart(corrReg))
+# i test sono calcolati solo su richiesta, una volta per ripartizione geografica
+if st.checkbox("Mostra test di permutazione e intervalli bootstrap al 95% delle correlazioni", key="corr_test"):
+    st.dataframe(correlazioni.test_correlazioni(corrReg), use_container_width=True)
 """
 Vediamo come quasi tutte le correlazioni siano significative. Vista la grande dimensione e l'eterogeneità delle unità 
 statistiche, anche correlazioni intorno allo 0.2 risultano interessanti. Notiamo, ad esempio, che un risultato migliore 
@@ -326,50 +300,23 @@ summary(pc_original)
 ## Cumulative Proportion   0.8586  0.91091 0.94866 0.96988 0.98346 0.99018 0.99587 1.00000
 ```
 
-Utilizzando i dati centrati ma non riscalati, come il default della funzione _PCA()_ 
-della libreria _scikit-learn_ in Python, otteniamo
+Utilizzando i dati centrati ma non riscalati, come in R con `prcomp(X, scale=F, center=T)`, otteniamo i risultati 
+seguenti, per l'Italia o per la sola regione selezionata (i commenti che seguono si riferiscono all'Italia)
 """
 
-votiPCA = vt.votiPerc.select(vt.partitiPlot)
+pcaReg = st.selectbox("Ripartizione geografica", ["ITALIA"] + regioni, key="pca_reg")
 
-# data una PCA (sklearn) restituisce un dataframe conentente varianza spiegata (assoluta, in proporzione e cumulativa)
-# da ognuna delle componenti principali
-def pca_expl_var(princomp):
-    expl_var = (
-        pl.DataFrame(
-            [
-                princomp.explained_variance_.tolist(),
-                princomp.explained_variance_ratio_.tolist(),
-                np.cumsum(princomp.explained_variance_ratio_).tolist()
-            ],
-            orient="row",
-            schema=["1", "2", "3", "4", "5", "6", "7", "8"]
-        )
-        .with_columns(
-                pl.Series("DESCR", ["VAR SPIEGATA", "PROP VAR SP", "CUM PROP VAR SP"])
-        )
-        .select(
-            ["DESCR", "1", "2", "3", "4", "5", "6", "7", "8"]
-        )
-    )
-    return expl_var
-
-# PCA e visualizzazione delle varianze spiegate da ogni PC
-pca = PCA()
-pca_result = pca.fit_transform(votiPCA)
-st.dataframe(pca_expl_var(pca),use_container_width=True)
+# PCA e visualizzazione delle varianze spiegate da ogni PC (le componenti restano in memoria per ogni ripartizione)
+st.dataframe(componenti.tabella_varianza(componenti.get_pca(False, pcaReg)),use_container_width=True)
 
 """
 Utilizzando, invece, i dati standardizzati facciamo emergere la relazione tra i partiti al netto delle loro percentuali medie
 e delle loro varianze. In pratica, diamo lo stesso peso ad ogni partito. Si ottiene
 """
 # con i dati standardizzati
-pca_std = PCA()
-scaler = StandardScaler()
-scaled = scaler.fit_transform(votiPCA)
-pca_std_res = pca_std.fit_transform(scaled)
+pca_std = componenti.get_pca(True, pcaReg)
 
-eigen_expl = pca_expl_var(pca_std)
+eigen_expl = componenti.tabella_varianza(pca_std)
 st.dataframe(eigen_expl,use_container_width=True)
 
 eigen_expl = (
@@ -411,32 +358,46 @@ molta meno varianza nei risultati, in termini assoluti, rispetto ai partiti magg
 
 #### Biplot
 """
-PC12 = pl.DataFrame(pca_std_res).select("column_0","column_1")
-
-# visualizzazione dei punti (ognuno è un comune)
-biplot = (
-    alt.Chart(PC12)
-    .mark_circle()
-    .encode(
-        alt.X("column_0", axis=alt.Axis(labelAngle=0), scale=alt.Scale(domain=[-12, 12]), title="PC1"),
-        alt.Y("column_1", scale=alt.Scale(domain=[-12, 12]), title="PC2")
-        # mettere tooltip
+PC12, binnato = componenti.punti_biplot(True, pcaReg)
+
+# visualizzazione dei punti (ognuno è un comune); con molti comuni si mostra invece l'istogramma bidimensionale
+if binnato:
+    biplot = (
+        alt.Chart(PC12)
+        .mark_rect()
+        .encode(
+            alt.X("X0:Q", axis=alt.Axis(labelAngle=0), scale=alt.Scale(domain=[-12, 12]), title="PC1"),
+            alt.X2("X1:Q"),
+            alt.Y("Y0:Q", scale=alt.Scale(domain=[-12, 12]), title="PC2"),
+            alt.Y2("Y1:Q"),
+            alt.Color("COMUNI:Q", scale=alt.Scale(type="log", scheme="greys"), legend=None),
+            tooltip=["COMUNI:Q"]
+        )
     )
-    .properties(
-        width=600,
-        height=600
+else:
+    biplot = (
+        alt.Chart(PC12)
+        .mark_circle()
+        .encode(
+            alt.X("PC1", axis=alt.Axis(labelAngle=0), scale=alt.Scale(domain=[-12, 12]), title="PC1"),
+            alt.Y("PC2", scale=alt.Scale(domain=[-12, 12]), title="PC2"),
+            alt.Tooltip("COMUNE")
+        )
     )
+biplot = biplot.properties(
+    width=600,
+    height=600
 )
 
 # definizione e visualizzazione delle frecce (ognuna è un partito)
 arrow_data = pl.DataFrame({
     "x": [0] * 8,
     "y": [0] * 8,
-    "x2": pca_std.components_[0, :]*15,
-    "y2": pca_std.components_[1, :]*15,
-    "x_txt":pca_std.components_[0, :]*16.5,
-    "y_txt":pca_std.components_[1, :]*16.5,
-    "part": ["FdI", "PD", "M5S", "FI", "Lega", "AVS", "SUE", "Azione"]
+    "x2": pca_std["componenti"][0, :]*15,
+    "y2": pca_std["componenti"][1, :]*15,
+    "x_txt":pca_std["componenti"][0, :]*16.5,
+    "y_txt":pca_std["componenti"][1, :]*16.5,
+    "part": correlazioni.sigle
 })
 
 arrows = (
@@ -483,38 +444,22 @@ La [_Factor Analysis_](https://en.wikipedia.org/wiki/Factor_analysis) (FA) è un
  simile alla PCA. Tuttavia, si differenza nel fatto che interpreta le p (nel nostro caso 8) variabili osservate come 
  risultato della realizzazione di m << p varaibili non osservabili (dette, appunto, fattori).
 
-```{r}
-factanal(X, 4)
-```
-```
-## 
-## Call:
-## factanal(x = X, factors = 4)
-## 
-## Uniquenesses:
-##    FdI     PD    M5S     FI   Lega    AVS    SUE Azione 
-##  0.419  0.005  0.688  0.005  0.678  0.005  0.788  0.898 
-## 
-## Loadings:
-##        Factor1 Factor2 Factor3 Factor4
-## FdI    -0.285  -0.345  -0.298  -0.540 
-## PD      0.979  -0.186                 
-## M5S     0.165   0.127           0.517 
-## FI              0.986  -0.110         
-## Lega   -0.419  -0.194  -0.237  -0.229 
-## AVS            -0.124   0.988         
-## SUE                             0.456 
-## Azione -0.109  -0.147           0.256 
-## 
-##                Factor1 Factor2 Factor3 Factor4
-## SS loadings      1.268   1.217   1.143   0.885
-## Proportion Var   0.158   0.152   0.143   0.111
-## Cumulative Var   0.158   0.311   0.454   0.564
-## 
-## Test of the hypothesis that 4 factors are sufficient.
-## The chi square statistic is 2822.55 on 2 degrees of freedom.
-## The p-value is 0
-```
+Riproduciamo in Python il procedimento di `factanal(X, m)` di R: stima di massima verosimiglianza delle unicità,
+rotazione varimax dei pesi fattoriali e test chi quadro sulla sufficienza di m fattori. Con 8 variabili si possono
+stimare al più 4 fattori. La verosimiglianza può avere più massimi locali: l'ottimizzazione parte dagli stessi valori 
+e con la stessa scala di R, così da arrivare allo stesso massimo, e per l'Italia i risultati coincidono con quelli di 
+`factanal(X, 4)` a meno degli arrotondamenti.
+"""
+faReg = st.selectbox("Ripartizione geografica", ["ITALIA"] + regioni, key="fa_reg")
+faFattori = st.selectbox("Numero di fattori", [1, 2, 3, 4], index=3, key="fa_fattori")
+faRis = fattoriale.analisi_fattoriale(faReg)[faFattori]
+st.dataframe(fattoriale.tabella_pesi(faRis), use_container_width=True)
+st.dataframe(fattoriale.tabella_varianza(faRis), use_container_width=True)
+st.write(
+    f"Test dell'ipotesi che {faFattori} fattori siano sufficienti: la statistica chi quadro è {faRis['chi2']:.2f} "
+    f"con {faRis['gdl']:.0f} gradi di libertà, _p-value_ {faRis['pvalue']:.3g}."
+)
+"""
 Ci si potrebbe perdere nell'interpretazione dei fattori, ma il test sulla bontà di questa riduzione di dimensionalità 
 ha _p-value_ indistinguibile da 0. Pertanto, l'analisi dei fattori non si presta bene a questo dataset.
 """
@@ -531,73 +476,98 @@ di voti compatibile con l'intervallo selezionato. È anche possibile visualizzar
 partitoMappa = st.selectbox("Partito", vt.partiti_ext, key="mappa")
 minPerc, maxPerc = st.slider("Seleziona l'intevallo percentuale", 0, 100, value=(0, 100))
 
-votiCoordFilter = (
-    mappe.votiCoord
-    .drop(["CIRCOSCRIZIONE", "ELETTORI_M"])
-    .filter(pl.col(partitoMappa) >= minPerc)
-    .filter(pl.col(partitoMappa) <= maxPerc)
-    .sort(["REGIONE", "PROVINCIA", "COMUNE"])
-)
+# l'intervallo viene risolto con una ricerca binaria sull'indice ordinato del partito (vedi mappe.get_indice_mappa)
+nComuniMappa = mappe.conteggio(partitoMappa, minPerc, maxPerc)
 
 # preventiamo che venga sollevata una eccezione nel tentativo di creare una mappa da un dataframe vuoto
-if votiCoordFilter.is_empty():
+if nComuniMappa == 0:
     st.write("Nessun comune corrispondente alla descrizione")
 else:
-    st.map(votiCoordFilter,
+    st.map(mappe.posizioni_intervallo(partitoMappa, minPerc, maxPerc),
            latitude="latitude",
            longitude="longitude")
-    st.write("Comuni corrispondenti e percentuale dei voto per partito")
-    st.write(votiCoordFilter.drop(["latitude", "longitude"]))
+    st.write(f"{nComuniMappa} comuni corrispondenti, per classe di percentuale di voto")
+    st.bar_chart(
+        mappe.istogramma(partitoMappa, minPerc, maxPerc).with_columns(pl.col("DA").round(1).cast(pl.String)),
+        x="DA",
+        y="COMUNI"
+    )
+    # la tabella completa viene costruita solo se richiesta
+    if st.checkbox("Mostra i comuni corrispondenti e la percentuale dei voto per partito", key="mappa_elenco"):
+        st.write(mappe.comuni_intervallo(partitoMappa, minPerc, maxPerc).drop(["latitude", "longitude"]))
+
+"""
+__Nota metodologica:__ Questa mappa è stata realizzata abbinando i dati dei risultati 
+elettorali a un database contenente i valori di latitudine e longitudine di (quasi) tutti i comuni italiani. 
+Poiché le due tabelle non riportano i codici ISTAT dei comuni, l'abbinamento avviene per nome: i nomi vengono 
+normalizzati (accenti, apostrofi, nomi bilingui, alcuni esonimi) e gli omonimi sono distinti in base alla provincia.
+I comuni rimasti sono abbinati al nome più simile nella stessa provincia, con una confidenza pari alla somiglianza 
+dei nomi (colonna _CONFIDENZA_, 1 per gli abbinamenti esatti). Al momento, circa 350 comuni non sono riportati, 
+quasi tutti nati da fusioni recenti o assenti dal database delle coordinate.
+
+### Autocorrelazione spaziale
+I risultati di un partito in comuni vicini tendono ad essere simili? L'[_I di Moran_](https://en.wikipedia.org/wiki/Moran%27s_I)
+misura questa somiglianza: vale circa 0 se i risultati sono distribuiti a caso sul territorio e si avvicina a 1 
+quanto più comuni vicini hanno risultati simili. Come vicini di ogni comune si considerano gli 8 comuni più vicini 
+oppure tutti i comuni entro 15 km, trovati tramite un indice spaziale (KD-tree) sulle coordinate dei comuni.
+La versione locale dell'indice (LISA) individua i gruppi di comuni con risultati significativamente alti 
+(alto-alto, in rosso) o bassi (basso-basso, in blu) circondati da comuni simili, e i comuni anomali rispetto ai 
+propri vicini (alto-basso in arancione, basso-alto in azzurro). La significatività è valutata con 999 permutazioni.
+"""
+partitoMoran = st.selectbox("Partito", vt.partiti_ext, key="moran")
+viciniMoran = st.radio("Vicini", ["8 comuni più vicini", "entro 15 km"], key="moran_vicini", horizontal=True)
+globaleMoran, localeMoran = spazio.autocorrelazione(partitoMoran, *((8, 0) if viciniMoran.startswith("8") else (0, 15)))
+st.write(
+    f"I di Moran: {globaleMoran['I']:.3f} (valore atteso in assenza di autocorrelazione {globaleMoran['atteso']:.4f}), "
+    f"_p-value_ {globaleMoran['pvalue']:.3f}"
+)
+st.map(localeMoran, latitude="latitude", longitude="longitude", color="COLORE", size=300)
+st.dataframe(localeMoran.group_by("CLUSTER").len("COMUNI").sort("CLUSTER"), use_container_width=True)
 
 """
-__Nota metodologica:__ Questa mappa è stata realizzata tramite un _inner join_ tra i dati dei risultati 
-elettorali e di un database contenente i valori di latitudine e longitudine di (quasi) tutti i comuni italiani. 
-Come è naturale, questo ha comportato una perdita di informazioni dovuta a qualche differenza nei nomi 
-come indicati nelle due tabelle. Si sono apportate alcune correzioni di base (e.g. accenti, omonimie) 
-e si è proceduto manualmente per alcuni comuni più grandi. Al momento, circa 700 comuni non sono riportati, 
-(quasi) tutti al di sotto dei 30 mila elettori totali. Alcuni rari casi di omonimia permangono e potrebbero causare 
-la visualizzazione di qualche punto anomalo.
-
 ### Risultati per partito, per regione o provincia
-Selezionando un livello si può modificare la visualizzazione tra regione o provincia.
+Selezionando un livello si può modificare la visualizzazione tra regione, provincia o comune.
 La scala dei colori visualizzata è relativa al massimo di ogni partito.
 Quando alcune aree geografiche non vengono visualizzate, ciò significa che il partito selezionato non vi era candidato.
 """
 
-chLiv = st.selectbox("Livello", ["REGIONE", "PROVINCIA"], key="chLivello")
-# il livello comune è tralasciato sia perché supera i 5000 elementi di limite di default di Altair, sia perché il
-# mismatch dei nomi tra i due dataframe renderebbe molti comuni non visualizzati
+chLiv = st.selectbox("Livello", ["REGIONE", "PROVINCIA", "COMUNE"], key="chLivello")
 chPart = st.selectbox("Partito", vt.partiti, key="chPartito").replace("'", "\\'")
 
 # raggruppiamo al livello richiesto
-votiPercPlot = (
-    vt.voti_grouped_by(chLiv)
-    .with_columns(
-        pl.col(chLiv).str.to_titlecase()
-    )
-)
-
-# alcune provincie hanno nomi non coincidenti nei due dataframe, modifichiamo per semplicità quelli in votiPercPlot
-votiPercPlot = mappe.reg_prov_fix(votiPercPlot)
+votiPercPlot = vt.voti_grouped_by(chLiv)
+if chLiv == "COMUNE":
+    # i confini dei comuni hanno come chiave il nome in maiuscolo, come in votiPerc. Alcuni rari casi di omonimia
+    # possono causare colori non corretti per uno dei comuni omonimi
+    votiPercPlot = votiPercPlot.select(["COMUNE", chPart.replace("\\'", "'")])
+else:
+    # alcune provincie hanno nomi non coincidenti nei due dataframe, modifichiamo per semplicità quelli in votiPercPlot
+    votiPercPlot = mappe.reg_prov_fix(votiPercPlot.with_columns(pl.col(chLiv).str.to_titlecase()))
 
 geoIT, labelLiv = mappe.get_topo_data(chLiv)
 
-choropleth = (
-    alt.Chart(geoIT)
-    .mark_geoshape()
-    .transform_lookup(
-        lookup=labelLiv,
-        from_=alt.LookupData(data=votiPercPlot, key=chLiv, fields=[chPart])
-    )
-    .encode(
-        alt.Color(f"{chPart}:Q", sort="descending").scale(scheme="viridis"),
-        tooltip=[
-            alt.Tooltip(f"{labelLiv}:N", title=chLiv),
-            alt.Tooltip(f"{chPart}:Q", title=f"% {chPart}", format=".2f")
-        ],
-    )
-)
-st.altair_chart(choropleth, use_container_width=True)
+if geoIT is None:
+    st.info("I confini dei comuni non sono disponibili: vanno prima scaricati e semplificati con "
+            "`python geometrie.py`.")
+else:
+    # a livello comunale i dati superano il limite di 5000 righe di Altair, che disattiviamo solo per questo grafico
+    with alt.data_transformers.disable_max_rows():
+        choropleth = (
+            alt.Chart(geoIT)
+            .mark_geoshape()
+            .transform_lookup(
+                lookup=labelLiv,
+                from_=alt.LookupData(data=votiPercPlot, key=chLiv, fields=[chPart])
+            )
+            .encode(
+                alt.Color(f"{chPart}:Q", sort="descending").scale(scheme="viridis"),
+                tooltip=[
+                    alt.Tooltip(f"{labelLiv}:N", title=chLiv),
+                    alt.Tooltip(f"{chPart}:Q", title=f"% {chPart}", format=".2f")
+                ],
+            )
+        )
+        st.altair_chart(choropleth, use_container_width=True)
 
 """
 ## Conclusioni e commenti
@@ -623,3 +593,7 @@ un bel po' di tempo per essere implementate in Python, pur affidando la parte pi
 a delle librerie apposite. L'esplorazione di questo dataset inoltre mi ha dato molti spunti su cui riflettere in vista
 della tesi che intendo sviluppare su argomenti sempre legati ai dati elettorali col Prof. Finos.
 """
+
+if avvio.PROFILO:
+    st.sidebar.markdown("### Tempi di avvio")
+    st.sidebar.dataframe(avvio.rapporto())
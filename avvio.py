@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import importlib.util
+import importlib.machinery
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+### Avvio rapido dell'app: librerie pesanti importate al primo utilizzo e profilo dei tempi di avvio
+
+# Con la variabile d'ambiente PROFILO_AVVIO=1 (e.g. `PROFILO_AVVIO=1 streamlit run app.py`) vengono misurati i tempi
+# di importazione dei moduli dell'app e delle librerie importate al primo utilizzo, i tempi di calcolo delle variabili
+# globali dei moduli (calcolate anch'esse al primo accesso) e il tempo che l'app impiega a mostrare il primo elemento.
+# Il rapporto viene stampato sul terminale e mostrato nella barra laterale dell'app
+PROFILO = os.environ.get("PROFILO_AVVIO", "0") not in ("", "0")
+# tempo massimo (in secondi) entro cui l'app deve mostrare il primo elemento
+OBIETTIVO_S = 3.0
+
+# voce -> secondi, accumulati dall'avvio del processo
+tempi = {}
+# istante di inizio dell'esecuzione dello script e secondi impiegati a mostrare il primo elemento
+_inizio = time.perf_counter()
+_primo = None
+
+
+# misura il tempo impiegato dal blocco, sommandolo a quello della voce
+@contextmanager
+def misura(voce):
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tempi[voce] = tempi.get(voce, 0) + time.perf_counter() - inizio
+
+
+# importa il modulo indicato in modo differito: il modulo viene restituito subito, ma eseguito solo al primo accesso
+# a un suo attributo (e.g. alt.Chart). Se il modulo è già stato importato viene restituito quello
+def importa(nome):
+    if nome in sys.modules:
+        return sys.modules[nome]
+    spec = importlib.util.find_spec(nome)
+    esegui = spec.loader.exec_module
+
+    def esegui_misurando(modulo):
+        with misura(f"import {nome}"):
+            esegui(modulo)
+
+    spec.loader.exec_module = esegui_misurando
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules[nome] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+### Profilo dei tempi di avvio
+
+# moduli dell'app, ovvero i file .py nella cartella di questo modulo
+_moduli_app = {file[:-3] for file in os.listdir(os.path.dirname(os.path.abspath(__file__))) if file.endswith(".py")}
+# moduli dell'app in corso di importazione, con i secondi spesi a importare altri moduli dell'app
+_in_corso = []
+
+
+# cerca i moduli dell'app come farebbe Python, ma misurandone l'importazione. A ogni modulo viene attribuito il solo
+# tempo proprio, escluse le importazioni di altri moduli dell'app (che hanno la loro voce)
+def _trova(nome, percorso=None, obiettivo=None):
+    if nome not in _moduli_app:
+        return None
+    spec = importlib.machinery.PathFinder.find_spec(nome, percorso)
+    if spec is None:
+        return None
+    esegui = spec.loader.exec_module
+
+    def esegui_misurando(modulo):
+        _in_corso.append(0.0)
+        inizio = time.perf_counter()
+        try:
+            esegui(modulo)
+        finally:
+            totale = time.perf_counter() - inizio
+            annidati = _in_corso.pop()
+            tempi[f"import {nome}"] = tempi.get(f"import {nome}", 0) + totale - annidati
+            if _in_corso:
+                _in_corso[-1] += totale
+
+    spec.loader.exec_module = esegui_misurando
+    return spec
+
+
+if PROFILO:
+    sys.meta_path.insert(0, SimpleNamespace(find_spec=_trova))
+
+
+# da chiamare all'inizio dello script dell'app, a ogni esecuzione
+def inizia():
+    global _inizio, _primo
+    _inizio, _primo = time.perf_counter(), None
+
+
+# da chiamare dopo il primo elemento mostrato dall'app
+def primo_elemento():
+    global _primo
+    if _primo is None:
+        _primo = time.perf_counter() - _inizio
+
+
+# rapporto dei tempi: una riga per voce, dalla più lenta, seguita dal tempo per il primo elemento e dal tempo totale
+# dell'esecuzione. Viene anche stampato sul terminale, con un avviso se il primo elemento supera OBIETTIVO_S
+def rapporto():
+    righe = sorted(tempi.items(), key=lambda voce: -voce[1])
+    righe += [("primo elemento", _primo), ("esecuzione completa", time.perf_counter() - _inizio)]
+    for voce, secondi in righe:
+        print(f"{voce:<40} {secondi:8.3f} s" if secondi is not None else f"{voce:<40}        -")
+    if _primo is not None and _primo > OBIETTIVO_S:
+        print(f"ATTENZIONE: primo elemento dopo {_primo:.2f} s, oltre l'obiettivo di {OBIETTIVO_S:.1f} s")
+    return {"VOCE": [voce for voce, _ in righe], "SECONDI": [secondi for _, secondi in righe]}
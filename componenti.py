@@ -0,0 +1,150 @@
+import threading
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+import istantanea
+
+### Analisi delle componenti principali tenuta in memoria per ripartizione geografica, aggiornabile incrementalmente
+
+# La PCA dipende dai dati solo tramite numero di osservazioni, medie e matrice degli scarti (somme dei prodotti degli
+# scarti dalla media): teniamo in memoria queste statistiche per ogni ripartizione, così che aggiungere nuovi comuni
+# (o i risultati di un'altra elezione) richieda solo di combinarle con quelle dei nuovi dati, senza riprendere i
+# dati già visti. Da queste si ricavano le componenti, con e senza standardizzazione, con un'autodecomposizione p x p.
+
+
+# statistiche per ripartizione ("ITALIA" o nome della regione) e componenti già calcolate per (scala, ripartizione),
+# condivise da tutte le sessioni dell'app, insieme al lock che ne protegge letture e aggiornamenti. Statistiche e
+# componenti non vengono mai modificate: un aggiornamento le sostituisce con oggetti nuovi, dunque quelle già
+# restituite a una sessione restano valide
+@st.cache_resource
+def _memoria():
+    return {"stati": {}, "modelli": {}}, threading.Lock()
+
+
+# statistiche sufficienti della matrice X (osservazioni x variabili)
+def statistiche(X):
+    X = np.asarray(X, dtype=np.float64)
+    media = X.mean(axis=0)
+    scarti = X - media
+    return {"n": X.shape[0], "media": media, "M2": scarti.T @ scarti}
+
+
+# combina le statistiche stato con quelle delle nuove osservazioni X (come partial_fit in scikit-learn), con la
+# formula di Chan et al. per medie e varianze di due gruppi. Restituisce un nuovo stato, quello vecchio non cambia
+def partial_fit(stato, X):
+    nuovo = statistiche(X)
+    if stato is None:
+        return nuovo
+    n = stato["n"] + nuovo["n"]
+    delta = nuovo["media"] - stato["media"]
+    return {
+        "n": n,
+        "media": stato["media"] + delta * nuovo["n"] / n,
+        "M2": stato["M2"] + nuovo["M2"] + np.outer(delta, delta) * stato["n"] * nuovo["n"] / n
+    }
+
+
+# componenti principali dalle statistiche, con gli stessi risultati di PCA() di scikit-learn sui dati centrati
+# (scala=False) o standardizzati con StandardScaler (scala=True), segni delle componenti compresi
+def _decomponi(stato, scala: bool):
+    n = stato["n"]
+    cov = stato["M2"] / (n - 1)
+    # StandardScaler divide per la deviazione standard con denominatore n, non n - 1
+    sd = np.sqrt(np.diag(stato["M2"]) / n) if scala else np.ones(len(stato["media"]))
+    valori, vettori = np.linalg.eigh(cov / np.outer(sd, sd))
+    valori, componenti = np.maximum(valori[::-1], 0), vettori[:, ::-1].T
+    # come in scikit-learn, il valore di modulo massimo di ogni componente è positivo
+    segni = np.sign(componenti[np.arange(len(componenti)), np.argmax(np.abs(componenti), axis=1)])
+    return {
+        "media": stato["media"],
+        "sd": sd,
+        "componenti": componenti * segni[:, None],
+        "varianza": valori,
+        "prop_varianza": valori / valori.sum()
+    }
+
+
+# statistiche della ripartizione salvate nell'istantanea, oppure None
+def _stato_salvato(reg: str):
+    salvate = istantanea.leggi_array("pca_statistiche")
+    if salvate is None or f"{reg}|n" not in salvate:
+        return None
+    return {"n": int(salvate[f"{reg}|n"]), "media": salvate[f"{reg}|media"], "M2": salvate[f"{reg}|M2"]}
+
+
+# dati della ripartizione indicata come matrice (comuni x partiti in vt.partitiPlot)
+def _matrice(reg: str):
+    voti = vt.votiPerc if reg == "ITALIA" else vt.votiPerc.filter(pl.col("REGIONE") == reg)
+    return voti.select(vt.partitiPlot).to_numpy().astype(np.float64)
+
+
+# restituisce la PCA (standardizzata se scala=True) dei partiti in vt.partitiPlot per l'Italia o per una regione.
+# Le statistiche vengono lette dall'istantanea o calcolate alla prima richiesta per la ripartizione, le componenti
+# alla prima richiesta per la coppia (scala, ripartizione); entrambe restano in memoria tra una esecuzione e l'altra
+# dell'app
+def get_pca(scala: bool = False, reg: str = "ITALIA"):
+    memoria, lock = _memoria()
+    with lock:
+        if reg not in memoria["stati"]:
+            memoria["stati"][reg] = _stato_salvato(reg) or statistiche(_matrice(reg))
+        if (scala, reg) not in memoria["modelli"]:
+            memoria["modelli"][(scala, reg)] = _decomponi(memoria["stati"][reg], scala)
+        return memoria["modelli"][(scala, reg)]
+
+
+# aggiunge alla PCA della regione reg (e a quella nazionale) le nuove osservazioni X, con le colonne nell'ordine di
+# vt.partitiPlot, per tutte le sessioni. Le componenti delle ripartizioni coinvolte verranno ricalcolate alla
+# prossima richiesta
+def aggiorna(X, reg: str = "ITALIA"):
+    memoria, lock = _memoria()
+    with lock:
+        stati, modelli = dict(memoria["stati"]), dict(memoria["modelli"])
+        for r in dict.fromkeys(["ITALIA", reg]):
+            stati[r] = partial_fit(stati.get(r) or _stato_salvato(r) or statistiche(_matrice(r)), X)
+            for scala in (False, True):
+                modelli.pop((scala, r), None)
+        memoria["stati"], memoria["modelli"] = stati, modelli
+
+
+# proiezione delle osservazioni X sulle componenti principali del modello (come PCA.transform)
+def proietta(modello, X):
+    return ((np.asarray(X, dtype=np.float64) - modello["media"]) / modello["sd"]) @ modello["componenti"].T
+
+
+# tabella con la varianza spiegata (assoluta, in proporzione e cumulativa) da ognuna delle componenti principali
+def tabella_varianza(modello):
+    nomi = [str(i + 1) for i in range(len(modello["varianza"]))]
+    return (
+        pl.DataFrame(
+            [
+                modello["varianza"].tolist(),
+                modello["prop_varianza"].tolist(),
+                np.cumsum(modello["prop_varianza"]).tolist()
+            ],
+            orient="row",
+            schema=nomi
+        )
+        .with_columns(
+            pl.Series("DESCR", ["VAR SPIEGATA", "PROP VAR SP", "CUM PROP VAR SP"])
+        )
+        .select(["DESCR"] + nomi)
+    )
+
+
+# punti del biplot (prime due componenti) per la ripartizione indicata. Se i comuni sono più di max_punti, invece
+# dei singoli punti restituisce l'istogramma bidimensionale (n_bin x n_bin celle non vuote), così da non inviare
+# al browser migliaia di punti. Restituisce il dataframe e True se si tratta delle celle dell'istogramma
+def punti_biplot(scala: bool = True, reg: str = "ITALIA", max_punti: int = 2000, n_bin: int = 60):
+    voti = vt.votiPerc if reg == "ITALIA" else vt.votiPerc.filter(pl.col("REGIONE") == reg)
+    pc = proietta(get_pca(scala, reg), voti.select(vt.partitiPlot).to_numpy())[:, :2]
+    if voti.height <= max_punti:
+        return pl.DataFrame({"COMUNE": voti.get_column("COMUNE"), "PC1": pc[:, 0], "PC2": pc[:, 1]}), False
+
+    conteggi, bordi_x, bordi_y = np.histogram2d(pc[:, 0], pc[:, 1], n_bin)
+    i, j = np.nonzero(conteggi)
+    return pl.DataFrame({
+        "X0": bordi_x[i], "X1": bordi_x[i + 1],
+        "Y0": bordi_y[j], "Y1": bordi_y[j + 1],
+        "COMUNI": conteggi[i, j].astype(np.int64)
+    }), True
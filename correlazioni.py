@@ -0,0 +1,204 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+import densita
+import istantanea
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+alt = avvio.importa("altair")
+
+### Matrice delle correlazioni tra partiti, con scatterplot binnati e densità marginali (come ggpairs in R)
+
+# sigle dei partiti in vt.partitiPlot, nello stesso ordine
+sigle = ["FdI", "PD", "M5S", "FI", "Lega", "AVS", "SUE", "Azione"]
+
+
+# restituisce la matrice (comuni x partiti) delle percentuali dei partiti in vt.partitiPlot per la regione indicata
+def _matrice(reg: str):
+    voti = vt.votiPerc if reg == "ITALIA" else vt.votiPerc.filter(pl.col("REGIONE") == reg)
+    return voti.select(vt.partitiPlot).to_numpy().astype(np.float64)
+
+
+# standardizza le colonne di X. Le colonne costanti (e.g. un partito a 0 in tutti i comuni di una regione) restano
+# nulle invece di diventare NaN, così che la loro correlazione con le altre colonne sia 0
+def _standardizza(X):
+    sd = X.std(axis=0)
+    return (X - X.mean(axis=0)) / np.where(sd > 0, sd, np.inf)
+
+
+# calcola la matrice di correlazione di Pearson di tutte le colonne di X con un solo prodotto matriciale.
+# Le colonne a varianza nulla hanno correlazione 0 con le altre e 1 con se stesse
+def matrice_correlazioni(X):
+    Z = _standardizza(X)
+    corr = Z.T @ Z / X.shape[0]
+    np.fill_diagonal(corr, 1.0)
+    return corr
+
+
+# calcola, per la regione indicata, tutto ciò che serve al grafico a coppie:
+# - la matrice delle correlazioni
+# - per ogni coppia di partiti l'istogramma bidimensionale delle percentuali (n_bin x n_bin celle), calcolato
+#   assegnando una sola volta ogni comune alla sua classe per ogni partito e contando le coppie di classi con bincount
+# - la densità marginale di ogni partito (vedi densita.kde_binned)
+@st.cache_data
+@istantanea.salvato("coppie_corr_{n_bin}", "npz", chiave="{reg}", converti=lambda corr, argomenti: (corr, *[
+    istantanea.scansiona(f"coppie_{nome}_{argomenti['n_bin']}")
+    .filter(pl.col("REGIONE") == argomenti["reg"]).drop("REGIONE").collect()
+    for nome in ("celle", "marginali")
+]))
+def dati_coppie(reg: str = "ITALIA", n_bin: int = 20):
+    X = _matrice(reg)
+    n, p = X.shape
+    bordi = [np.histogram_bin_edges(X[:, j], n_bin) for j in range(p)]
+    classi = np.column_stack([
+        np.clip(np.searchsorted(bordi[j], X[:, j], side="right") - 1, 0, n_bin - 1) for j in range(p)
+    ])
+
+    celle = []
+    for i in range(p):
+        for j in range(i):
+            conteggi = np.bincount(classi[:, i] * n_bin + classi[:, j], minlength=n_bin * n_bin)
+            ci, cj = np.divmod(np.flatnonzero(conteggi), n_bin)
+            celle.append(pl.DataFrame({
+                "RIGA": sigle[i], "COLONNA": sigle[j],
+                "X0": bordi[j][cj], "X1": bordi[j][cj + 1],
+                "Y0": bordi[i][ci], "Y1": bordi[i][ci + 1],
+                "COMUNI": conteggi[ci * n_bin + cj]
+            }))
+
+    marginali = pl.concat([
+        pl.DataFrame({
+            "PARTITO": sigle[j],
+            "VOTI": densita.griglia,
+            "density": densita.kde_binned(X[:, j], densita.griglia)
+        }).filter(pl.col("VOTI") <= X[:, j].max())
+        for j in range(p)
+    ])
+    return matrice_correlazioni(X), pl.concat(celle), marginali
+
+
+# crea il grafico a coppie: sotto la diagonale gli scatterplot binnati, sulla diagonale le densità marginali e
+# sopra la diagonale i coefficienti di correlazione
+def make_pairs_chart(reg: str = "ITALIA", lato: int = 90):
+    corr, celle, marginali = dati_coppie(reg)
+    righe = []
+    for i, riga in enumerate(sigle):
+        grafici = []
+        for j, colonna in enumerate(sigle):
+            asse_x = alt.Axis(title=colonna if i == len(sigle) - 1 else None, labels=i == len(sigle) - 1)
+            asse_y = alt.Axis(title=riga if j == 0 else None, labels=j == 0)
+            if j < i:
+                grafico = (
+                    alt.Chart(celle.filter((pl.col("RIGA") == riga) & (pl.col("COLONNA") == colonna)))
+                    .mark_rect()
+                    .encode(
+                        alt.X("X0:Q", axis=asse_x), alt.X2("X1:Q"),
+                        alt.Y("Y0:Q", axis=asse_y), alt.Y2("Y1:Q"),
+                        alt.Color("COMUNI:Q", scale=alt.Scale(type="log", scheme="greys"), legend=None),
+                        tooltip=["COMUNI:Q"]
+                    )
+                )
+            elif j == i:
+                grafico = (
+                    alt.Chart(marginali.filter(pl.col("PARTITO") == riga))
+                    .mark_area(opacity=0.7, color=vt.colors[i])
+                    .encode(
+                        alt.X("VOTI:Q", axis=asse_x),
+                        alt.Y("density:Q", axis=None)
+                    )
+                )
+            else:
+                grafico = (
+                    alt.Chart(pl.DataFrame({"CORR": [round(float(corr[i, j]), 3)]}))
+                    .mark_text(fontSize=14)
+                    .encode(
+                        alt.Text("CORR:Q", format=".3f"),
+                        alt.Color("CORR:Q", scale=alt.Scale(domain=[-1, 1], scheme="redblue"), legend=None)
+                    )
+                )
+            grafici.append(grafico.properties(width=lato, height=lato))
+        righe.append(alt.hconcat(*grafici, spacing=4))
+    return alt.vconcat(*righe, spacing=4)
+
+
+### Significatività delle correlazioni: test di permutazione e intervalli bootstrap, per tutte le coppie insieme
+
+# dati condivisi dai processi del pool, passati una sola volta all'avvio di ogni processo
+_X = None
+
+
+def _init_worker(X):
+    global _X
+    _X = X
+
+
+# correlazioni di un blocco di permutazioni: ogni colonna è permutata indipendentemente dalle altre, così che ogni
+# coppia di partiti sia, sotto l'ipotesi nulla, indipendente. Le colonne sono standardizzate una sola volta, dato che
+# media e varianza non cambiano permutando. Restituisce un array (permutazioni x partiti x partiti)
+def _blocco_permutazioni(seme, n_campioni):
+    rng = np.random.default_rng(seme)
+    n, p = _X.shape
+    Z = _standardizza(_X)
+    indici = rng.permuted(np.broadcast_to(np.arange(n)[None, :, None], (n_campioni, n, p)), axis=1)
+    Zp = np.take_along_axis(Z[None, :, :], indici, axis=1)
+    return np.einsum("rni,rnj->rij", Zp, Zp, optimize=True) / n
+
+
+# correlazioni di un blocco di campioni bootstrap, ognuno rappresentato dal numero di estrazioni di ogni comune
+# (riga di W), così da calcolare tutte le matrici di covarianza pesate con un'unica einsum. Come in
+# matrice_correlazioni, le colonne costanti in un campione hanno correlazione 0 con le altre.
+# Restituisce un array (campioni x partiti x partiti)
+def _blocco_bootstrap(seme, n_campioni):
+    rng = np.random.default_rng(seme)
+    n = _X.shape[0]
+    W = rng.multinomial(n, np.full(n, 1 / n), size=n_campioni) / n
+    medie = W @ _X
+    cov = np.einsum("bn,ni,nj->bij", W, _X, _X, optimize=True) - medie[:, :, None] * medie[:, None, :]
+    sd = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0))
+    # una colonna costante può avere una varianza appena positiva per gli errori di arrotondamento
+    sd = np.where(sd > 1e-6 * (1 + np.abs(medie)), sd, np.inf)
+    return cov / (sd[:, :, None] * sd[:, None, :])
+
+
+# esegue la funzione su n_campioni campioni, in blocchi di dimensione blocco, eventualmente su n_jobs processi
+def _esegui_blocchi(funzione, X, n_campioni, seme, blocco, n_jobs):
+    semi = np.random.SeedSequence(seme).spawn((n_campioni + blocco - 1) // blocco)
+    dimensioni = [min(blocco, n_campioni - i * blocco) for i in range(len(semi))]
+    if n_jobs == 1:
+        _init_worker(X)
+        return np.concatenate([funzione(s, d) for s, d in zip(semi, dimensioni)])
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(X,)) as pool:
+        return np.concatenate(list(pool.map(funzione, semi, dimensioni)))
+
+
+# per la regione indicata, calcola per tutte le coppie di partiti in vt.partitiPlot la correlazione, il p-value del
+# test di permutazione (bilaterale) con n_perm permutazioni e l'intervallo bootstrap percentile al livello indicato
+# con n_boot campioni. Con n_jobs > 1 i blocchi di campioni sono distribuiti su più processi
+@st.cache_data
+@istantanea.salvato("test_correlazioni_{n_perm}_{n_boot}_{livello:g}_{seme}", chiave=("REGIONE", "{reg}"))
+def test_correlazioni(reg: str = "ITALIA", n_perm: int = 999, n_boot: int = 999, livello: float = 0.95,
+                      seme: int = 0, blocco: int = 50, n_jobs: int = 1):
+    X = _matrice(reg)
+    n_jobs = n_jobs or os.cpu_count()
+    corr = matrice_correlazioni(X)
+    perm = _esegui_blocchi(_blocco_permutazioni, X, n_perm, seme, blocco, n_jobs)
+    boot = _esegui_blocchi(_blocco_bootstrap, X, n_boot, seme + 1, blocco, n_jobs)
+
+    pvalue = (1 + (np.abs(perm) >= np.abs(corr) - 1e-12).sum(axis=0)) / (1 + n_perm)
+    inf, sup = np.percentile(boot, [50 * (1 - livello), 50 * (1 + livello)], axis=0)
+
+    i, j = np.tril_indices(len(sigle), k=-1)
+    return pl.DataFrame({
+        "PARTITO_1": np.array(sigle)[j],
+        "PARTITO_2": np.array(sigle)[i],
+        "CORR": corr[i, j].round(3),
+        "P_VALUE": pvalue[i, j],
+        "INF": inf[i, j].round(3),
+        "SUP": sup[i, j].round(3)
+    })
@@ -0,0 +1,72 @@
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+import istantanea
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+signal = avvio.importa("scipy.signal")
+
+### Stime kernel della densità calcolate lato server, per il ridgeline plot
+
+# griglia su cui sono calcolate le densità e intervallo effettivamente mostrato nel grafico
+griglia = np.linspace(0, 100, 401)
+dominio = (0, 60)
+
+
+# banda secondo la regola empirica di Scott/Silverman, la stessa usata di default da transform_density di Vega.
+# Come in Vega (Math.min(d, h) || d || Math.abs(q1) || 1), se lo scarto interquartile è nullo (e.g. un partito con
+# quasi tutti i comuni a 0) si usa la deviazione standard, se anche questa è nulla il valore assoluto del primo
+# quartile e, se anche questo è nullo, 1
+def banda(x):
+    q1, q3 = np.percentile(x, [25, 75])
+    dev = np.std(x, ddof=1) if len(x) > 1 else 0.0
+    scala = min(dev, (q3 - q1) / 1.34) or dev or abs(q1) or 1.0
+    return 1.06 * scala * len(x) ** -0.2
+
+
+# stima kernel (gaussiano) della densità di x sui punti di griglia (equispaziati). Le osservazioni vengono prima
+# distribuite linearmente sui due punti di griglia più vicini e poi il kernel viene applicato con una convoluzione
+# tramite FFT, dunque il costo dipende dalla dimensione della griglia e non dal numero di osservazioni
+def kde_binned(x, griglia, bw=None):
+    x = x[np.isfinite(x)]
+    if bw is None:
+        bw = banda(x)
+    m = len(griglia)
+    passo = griglia[1] - griglia[0]
+
+    pos = np.clip((x - griglia[0]) / passo, 0, m - 1)
+    i = np.minimum(np.floor(pos).astype(np.int64), m - 2)
+    frazione = pos - i
+    conteggi = np.bincount(i, weights=1 - frazione, minlength=m) + np.bincount(i + 1, weights=frazione, minlength=m)
+
+    # kernel troncato a 4 deviazioni standard (e alla larghezza della griglia)
+    L = min(m - 1, int(np.ceil(4 * bw / passo)))
+    scarti = np.arange(-L, L + 1) * passo
+    kernel = np.exp(-0.5 * (scarti / bw) ** 2) / (bw * np.sqrt(2 * np.pi))
+    return np.maximum(signal.fftconvolve(conteggi, kernel, mode="same"), 0) / len(x)
+
+
+# calcola una volta sola le densità di ogni partito in vt.partitiPlot, per l'Italia e per ogni regione.
+# Restituisce un dizionario regione -> dataframe (LISTA, VOTI, density) con le sole curve nell'intervallo dominio
+@st.cache_resource
+@istantanea.salvato("densita", converti=lambda salvate, argomenti: {
+    reg: df.drop("REGIONE") for (reg,), df in salvate.partition_by("REGIONE", as_dict=True).items()
+})
+def get_densita():
+    mostrati = (griglia >= dominio[0]) & (griglia <= dominio[1])
+    gruppi = {"ITALIA": vt.votiPerc}
+    gruppi.update({reg: df for (reg,), df in vt.votiPerc.partition_by("REGIONE", as_dict=True).items()})
+
+    densita = {}
+    for reg, df in gruppi.items():
+        densita[reg] = pl.DataFrame({
+            "LISTA": np.repeat(vt.partitiPlot, mostrati.sum()),
+            "VOTI": np.tile(griglia[mostrati], len(vt.partitiPlot)),
+            "density": np.concatenate([
+                kde_binned(df.get_column(partito).to_numpy().astype(np.float64), griglia)[mostrati]
+                for partito in vt.partitiPlot
+            ])
+        })
+    return densita
@@ -0,0 +1,239 @@
+import os
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+import nomi
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+optimize = avvio.importa("scipy.optimize")
+
+### Risultati di più elezioni in un'unica tabella, con spostamenti di voto (swing) e flussi elettorali
+
+# elezioni da caricare: nome -> file scaricato da Eligendo. Vengono caricate solo quelle il cui file è presente
+fonti = {
+    "EUROPEE2019": "Europee2019.txt",
+    "POLITICHE2022": "Camera2022.txt",
+    "EUROPEE2024": vt.RAW_FILE,
+}
+
+# nomi delle colonne nei diversi formati di Eligendo: colonna armonizzata -> possibili nomi nel file
+_colonne = {
+    "REGIONE": ["DESCREGIONE", "REGIONE"],
+    "PROVINCIA": ["DESCPROVINCIA", "PROVINCIA"],
+    "COMUNE": ["DESCCOMUNE", "COMUNE"],
+    "ELETTORI": ["ELETTORI", "ELETTORI_TOTALI"],
+    "VOTANTI": ["VOTANTI", "VOTANTI_TOTALI"],
+    "LISTA": ["DESCLISTA", "LISTA"],
+    "VOTI": ["NUMVOTI", "VOTILISTA", "VOTI_LISTA"],
+}
+
+# famiglie politiche con cui confrontare liste di elezioni diverse: nome -> espressione regolare sul nome della lista.
+# Vale la prima famiglia che corrisponde; le liste che non corrispondono a nessuna finiscono in ALTRI
+famiglie = {
+    "FdI": r"^FRATELLI D'ITALIA",
+    "PD": r"^PARTITO DEMOCRATICO",
+    "M5S": r"^MOVIMENTO 5 STELLE",
+    "FI": r"^FORZA ITALIA",
+    "Lega": r"^LEGA",
+    "AVS": r"ALLEANZA VERDI|EUROPA VERDE|^LA SINISTRA|SINISTRA ITALIANA",
+    "SUE": r"STATI UNITI D'EUROPA|^\+ ?EUROPA|^PIU' EUROPA",
+    "Azione": r"^AZIONE",
+}
+ALTRI = "ALTRI"
+NON_VOTO = "NON VOTO"
+
+# file in cui è salvata la tabella di tutte le elezioni (vedi get_elezioni)
+ELEZIONI_FILE = "elezioni.parquet"
+
+
+# espressione che assegna ogni lista alla sua famiglia politica
+def _famiglia():
+    espressione = pl.lit(ALTRI)
+    for nome, regex in reversed(famiglie.items()):
+        espressione = pl.when(pl.col("LISTA").str.contains(regex)).then(pl.lit(nome)).otherwise(espressione)
+    return espressione.alias("PARTITO")
+
+
+# chiave del comune comune a tutte le elezioni: regione, provincia e comune normalizzati (vedi nomi.normalizza), dato
+# che nella stessa regione ci possono essere comuni omonimi in province diverse. Dei nomi bilingui (e.g.
+# "BOLZANO/BOZEN") si tiene solo la prima parte, la cui grafia è più stabile tra un'elezione e l'altra. I comuni di
+# province che hanno cambiato nome o confini tra due elezioni (e.g. in Sardegna) hanno chiavi diverse nelle due, e
+# vengono quindi esclusi dai confronti. Le normalizzazioni sono calcolate una volta per valore distinto
+def _chiave(voti):
+    def normalizzati(colonna):
+        valori = voti.get_column(colonna).unique().to_list()
+        return pl.col(colonna).replace_strict({v: nomi.normalizza(v.split("/")[0]) for v in valori})
+
+    return voti.with_columns(CHIAVE=pl.concat_str(
+        [normalizzati("REGIONE"), normalizzati("PROVINCIA"), normalizzati("COMUNE")], separator="|"
+    ))
+
+
+# legge un file di Eligendo e lo riporta al formato comune: una riga per comune e lista, con le colonne di _colonne
+def leggi(file, elezione):
+    voti = pl.scan_csv(file, separator=";", infer_schema_length=None)
+    presenti = voti.collect_schema().names()
+    rinomina = {}
+    for colonna, alias in _colonne.items():
+        trovati = [a for a in alias if a in presenti]
+        if not trovati:
+            raise ValueError(f"{file}: nessuna delle colonne {alias} per {colonna}")
+        rinomina[trovati[0]] = colonna
+
+    voti = (
+        voti
+        .select(rinomina.keys())
+        .rename(rinomina)
+        .filter(pl.col("VOTI").is_not_null())
+        .collect()
+    )
+    return _chiave(voti).select(
+        pl.lit(elezione).alias("ELEZIONE"),
+        "CHIAVE", "REGIONE", "PROVINCIA", "COMUNE",
+        pl.col("ELETTORI").cast(pl.Int32),
+        pl.col("VOTANTI").cast(pl.Int32),
+        pl.col("LISTA"),
+        _famiglia(),
+        pl.col("VOTI").cast(pl.Int32)
+    )
+
+
+# carica tutte le elezioni indicate (nome -> file) in un'unica tabella, una riga per elezione, comune e lista.
+# Le colonne testuali ripetute sono categoriche, le elezioni sono in ordine di elenco
+def carica(fonti_sel=None):
+    fonti_sel = fonti_sel or {nome: file for nome, file in fonti.items() if os.path.exists(file)}
+    tabella = pl.concat([leggi(file, nome) for nome, file in fonti_sel.items()])
+    return tabella.with_columns(
+        pl.col("ELEZIONE").cast(pl.Enum(list(fonti_sel))),
+        pl.col(["CHIAVE", "REGIONE", "PROVINCIA", "COMUNE", "LISTA", "PARTITO"]).cast(pl.Categorical)
+    )
+
+
+# tabella di tutte le elezioni disponibili, caricata una sola volta. Viene salvata in ELEZIONI_FILE, accanto ai file
+# sorgente, e riletta da lì finché nessun file sorgente è più recente e le elezioni disponibili sono le stesse
+@st.cache_resource
+def get_elezioni():
+    disponibili = {nome: file for nome, file in fonti.items() if os.path.exists(file)}
+    if os.path.exists(ELEZIONI_FILE) and all(
+        os.path.getmtime(ELEZIONI_FILE) >= os.path.getmtime(file) for file in disponibili.values()
+    ):
+        tabella = pl.read_parquet(ELEZIONI_FILE)
+        if tabella.schema["ELEZIONE"] == pl.Enum(list(disponibili)):
+            return tabella
+
+    tabella = carica(disponibili)
+    try:
+        tabella.write_parquet(ELEZIONI_FILE)
+    except OSError:
+        pass
+    return tabella
+
+
+# percentuali di voto (sui voti validi) di ogni famiglia politica per elezione e unità del livello indicato
+# (ITALIA, REGIONE, PROVINCIA o COMUNE; per i comuni l'unità è la CHIAVE), calcolate per tutte le elezioni con
+# un solo group_by. Oltre alle famiglie, la tabella contiene l'AFFLUENZA. PARTITO è testuale: la categoria AFFLUENZA
+# non fa parte di quelle della tabella, e unire due categoriche diverse richiederebbe di ricodificarle
+def quote(livello="COMUNE", tabella=None):
+    tabella = get_elezioni() if tabella is None else tabella
+    unita = {"ITALIA": [], "COMUNE": ["CHIAVE"]}.get(livello, [livello])
+    comuni = tabella.group_by(["ELEZIONE", "CHIAVE"]).agg(
+        pl.col(unita).first() if livello not in ("ITALIA", "COMUNE") else [],
+        pl.col("ELETTORI").first(), pl.col("VOTANTI").first()
+    )
+    partiti = (
+        tabella
+        .group_by(["ELEZIONE"] + unita + ["PARTITO"])
+        .agg(pl.col("VOTI").sum())
+        .with_columns(
+            pl.col("PARTITO").cast(pl.String),
+            (pl.col("VOTI") / pl.col("VOTI").sum().over(["ELEZIONE"] + unita) * 100).alias("QUOTA")
+        )
+    )
+    affluenza = (
+        comuni
+        .group_by(["ELEZIONE"] + unita)
+        .agg((pl.col("VOTANTI").sum() / pl.col("ELETTORI").sum() * 100).alias("QUOTA"))
+        .with_columns(pl.lit("AFFLUENZA").alias("PARTITO"))
+    )
+    return pl.concat([partiti.drop("VOTI"), affluenza.select(partiti.drop("VOTI").columns)])
+
+
+# spostamento di voto tra le elezioni da e a, in punti percentuali, per ogni famiglia politica (e l'affluenza) e
+# unità del livello indicato. Sono considerate solo le unità presenti in entrambe le elezioni (per i comuni,
+# sono esclusi quelli nati da fusioni o cambiati di regione o di provincia tra le due elezioni; per le province,
+# quelle che hanno cambiato nome o confini)
+def swing(da, a, livello="COMUNE", tabella=None):
+    q = quote(livello, tabella).filter(pl.col("ELEZIONE").is_in([da, a]))
+    unita = [c for c in q.columns if c not in ("ELEZIONE", "PARTITO", "QUOTA")]
+    larga = q.with_columns(pl.col("ELEZIONE").cast(pl.String)).pivot(
+        on="ELEZIONE", index=unita + ["PARTITO"], values="QUOTA"
+    )
+    if unita:
+        # l'affluenza c'è per ogni unità presente in un'elezione: se manca, l'unità non c'era
+        larga = larga.filter(*[
+            pl.col(e).filter(pl.col("PARTITO") == "AFFLUENZA").first().over(unita).is_not_null() for e in (da, a)
+        ])
+    return (
+        larga
+        .with_columns(pl.col(da).fill_null(0), pl.col(a).fill_null(0))
+        .select(unita + ["PARTITO", da, a, (pl.col(a) - pl.col(da)).alias("SWING")])
+        .sort(unita + ["PARTITO"])
+    )
+
+
+# matrice comuni x categorie delle quote sugli elettori (famiglie politiche più NON VOTO, che comprende anche
+# schede bianche e nulle) dell'elezione indicata
+def _quote_elettori(tabella, elezione, categorie):
+    voti = (
+        tabella
+        .filter(pl.col("ELEZIONE") == elezione)
+        .group_by(["CHIAVE", "PARTITO"])
+        .agg(pl.col("VOTI").sum())
+        .with_columns(pl.col("PARTITO").cast(pl.String))
+        .pivot(on="PARTITO", index="CHIAVE", values="VOTI")
+    )
+    elettori = tabella.filter(pl.col("ELEZIONE") == elezione).group_by("CHIAVE").agg(pl.col("ELETTORI").first())
+    voti = voti.join(elettori, on="CHIAVE")
+    presenti = [c for c in categorie if c in voti.columns]
+    return voti.select(
+        "CHIAVE", "ELETTORI",
+        *[(pl.col(c).fill_null(0) if c in presenti else pl.lit(0)).alias(c) for c in categorie],
+        (pl.col("ELETTORI") - pl.sum_horizontal(presenti)).alias(NON_VOTO)
+    )
+
+
+# stima dei flussi elettorali tra le elezioni da e a con il modello di Goodman: la quota sugli elettori di ogni
+# categoria in a è regredita (minimi quadrati non negativi, pesati con il numero di elettori) sulle quote delle
+# categorie in da, su tutti i comuni presenti in entrambe le elezioni o solo su quelli di un'unità (livello, nome).
+# Le righe della matrice stimata sono poi normalizzate a somma 1. Restituisce, per ogni coppia di categorie, la
+# quota degli elettori di DA che è passata ad A e il numero di elettori corrispondente
+def flussi(da, a, livello=None, nome=None, tabella=None):
+    tabella = get_elezioni() if tabella is None else tabella
+    if livello is not None:
+        chiavi = tabella.filter((pl.col("ELEZIONE") == a) & (pl.col(livello) == nome)).get_column("CHIAVE").unique()
+        tabella = tabella.filter(pl.col("CHIAVE").is_in(chiavi))
+    categorie = list(famiglie) + [ALTRI]
+    origine = _quote_elettori(tabella, da, categorie)
+    destinazione = _quote_elettori(tabella, a, categorie)
+    dati = origine.join(destinazione, on="CHIAVE", suffix="_A")
+
+    nomi_cat = categorie + [NON_VOTO]
+    elettori = dati.get_column("ELETTORI").to_numpy().astype(np.float64)
+    X = dati.select(nomi_cat).to_numpy() / elettori[:, None]
+    Y = dati.select([f"{c}_A" for c in nomi_cat]).to_numpy() / dati.get_column("ELETTORI_A").to_numpy()[:, None]
+    peso = np.sqrt(elettori)[:, None]
+
+    B = np.column_stack([optimize.nnls(X * peso, Y[:, j] * peso[:, 0])[0] for j in range(Y.shape[1])])
+    somme = B.sum(axis=1, keepdims=True)
+    B = np.divide(B, somme, out=np.zeros_like(B), where=somme > 0)
+    totali = (X * elettori[:, None]).sum(axis=0)
+
+    i, j = np.indices(B.shape)
+    return pl.DataFrame({
+        "DA": np.array(nomi_cat)[i.ravel()],
+        "A": np.array(nomi_cat)[j.ravel()],
+        "QUOTA": B.ravel(),
+        "ELETTORI": (B * totali[:, None]).ravel().round().astype(np.int64)
+    })
@@ -0,0 +1,140 @@
+import hashlib
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+from correlazioni import sigle
+import istantanea
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+optimize = avvio.importa("scipy.optimize")
+stats = avvio.importa("scipy.stats")
+
+### Analisi fattoriale di massima verosimiglianza, con lo stesso procedimento di factanal in R
+### (ottimizzazione sulle unicità, rotazione varimax e test chi quadro sul numero di fattori)
+
+
+# matrice di correlazione riscalata dalle unicità psi e relativi autovalori/autovettori (in ordine decrescente)
+def _autovalori(psi, S):
+    sc = 1 / np.sqrt(psi)
+    valori, vettori = np.linalg.eigh(S * sc[:, None] * sc[None, :])
+    return valori[::-1], vettori[:, ::-1]
+
+
+# funzione obiettivo della massima verosimiglianza, in funzione delle sole unicità (come FAfn in factanal)
+def _obiettivo(psi, S, m):
+    e = _autovalori(psi, S)[0][m:]
+    return -(np.sum(np.log(e) - e) - m + S.shape[0])
+
+
+# matrice dei pesi fattoriali corrispondente alle unicità psi (come FAout in factanal)
+def _pesi(psi, S, m):
+    valori, vettori = _autovalori(psi, S)
+    return np.sqrt(psi)[:, None] * vettori[:, :m] * np.sqrt(np.maximum(valori[:m] - 1, 0))
+
+
+# gradiente dell'obiettivo rispetto alle unicità (come FAgr in factanal)
+def _gradiente(psi, S, m):
+    L = _pesi(psi, S, m)
+    return np.diag(L @ L.T + np.diag(psi) - S) / psi ** 2
+
+
+# rotazione varimax con normalizzazione di Kaiser, come varimax in R
+def varimax(L, eps=1e-5):
+    if L.shape[1] < 2:
+        return L
+    sc = np.sqrt((L ** 2).sum(axis=1))
+    x = L / sc[:, None]
+    p, m = x.shape
+    T = np.eye(m)
+    d = 0
+    for _ in range(1000):
+        z = x @ T
+        B = x.T @ (z ** 3 - z * (z ** 2).sum(axis=0) / p)
+        u, s, vt_ = np.linalg.svd(B)
+        T = u @ vt_
+        d_prec, d = d, s.sum()
+        if d < d_prec * (1 + eps):
+            break
+    return x @ T * sc[:, None]
+
+
+# adatta il modello a m fattori sulla matrice di correlazione S di n osservazioni. Restituisce un dizionario con
+# unicità, pesi fattoriali ruotati (ordinati per somma dei quadrati decrescente), statistica chi quadro del test
+# sulla sufficienza di m fattori, gradi di libertà e p-value.
+# Come factanal, che chiama optim con parscale = 0.01, l'ottimizzazione avviene sulle unicità divise per SCALA: la
+# funzione obiettivo ha più minimi locali (e.g. unicità al limite inferiore di 0.005) e senza lo stesso riscalamento
+# L-BFGS-B ne raggiunge uno diverso da quello di R
+SCALA = 0.01
+
+
+def fit_fattori(S, n, m):
+    p = S.shape[0]
+    inizio = (1 - 0.5 * m / p) / np.diag(np.linalg.inv(S))
+    ottimo = optimize.minimize(lambda y: _obiettivo(y * SCALA, S, m), inizio / SCALA,
+                               jac=lambda y: _gradiente(y * SCALA, S, m) * SCALA,
+                               method="L-BFGS-B", bounds=[(0.005 / SCALA, 1 / SCALA)] * p)
+    psi = ottimo.x * SCALA
+
+    L = varimax(_pesi(psi, S, m))
+    L = L[:, np.argsort(-(L ** 2).sum(axis=0))]
+    L = L * np.where(L.sum(axis=0) < 0, -1, 1)
+
+    gdl = ((p - m) ** 2 - p - m) / 2
+    chi2 = (n - 1 - (2 * p + 5) / 6 - 2 * m / 3) * ottimo.fun
+    return {
+        "unicita": psi,
+        "pesi": L,
+        "chi2": chi2,
+        "gdl": gdl,
+        "pvalue": stats.chi2.sf(chi2, gdl) if gdl > 0 else np.nan
+    }
+
+
+# adatta i modelli da 1 a k fattori sulla matrice X, uno dopo l'altro: ogni adattamento (8 partiti) richiede pochi
+# millisecondi e l'ottimizzatore di scipy non rilascia il GIL, dunque più thread non porterebbero alcun vantaggio.
+# Il risultato è tenuto in cache in base all'hash dei dati (i dati stessi, con l'underscore, non vengono hashati da
+# streamlit) e alla ripartizione geografica
+@st.cache_data
+def _fit_cache(hash_dati: str, reg: str, k: int, _X):
+    S = np.corrcoef(_X, rowvar=False)
+    # il numero massimo di fattori è quello per cui i gradi di libertà del test non sono negativi
+    p = S.shape[0]
+    fattori = [m for m in range(1, k + 1) if (p - m) ** 2 >= p + m]
+    return {m: fit_fattori(S, _X.shape[0], m) for m in fattori}
+
+
+# analisi fattoriale con da 1 a k fattori dei partiti in vt.partitiPlot, per l'Italia o per una regione.
+# Restituisce un dizionario numero di fattori -> risultati di fit_fattori
+@istantanea.salvato("fattoriale_{k}", "json", chiave="{reg}", converti=lambda salvati, argomenti: {
+    int(m): {chiave: np.asarray(v) if isinstance(v, list) else v for chiave, v in risultato.items()}
+    for m, risultato in salvati.items()
+})
+def analisi_fattoriale(reg: str = "ITALIA", k: int = 4):
+    voti = vt.votiPerc if reg == "ITALIA" else vt.votiPerc.filter(pl.col("REGIONE") == reg)
+    X = voti.select(vt.partitiPlot).to_numpy().astype(np.float64)
+    return _fit_cache(hashlib.sha256(X.tobytes()).hexdigest(), reg, k, X)
+
+
+# tabella dei pesi fattoriali (una riga per partito) con unicità, come nell'output di factanal
+def tabella_pesi(risultato):
+    L = risultato["pesi"]
+    return pl.DataFrame(
+        {"PARTITO": sigle}
+        | {f"Factor{j + 1}": L[:, j].round(3) for j in range(L.shape[1])}
+        | {"UNICITA": risultato["unicita"].round(3)}
+    )
+
+
+# tabella della varianza spiegata da ogni fattore (somma dei quadrati dei pesi, in proporzione e cumulativa)
+def tabella_varianza(risultato):
+    ss = (risultato["pesi"] ** 2).sum(axis=0)
+    prop = ss / risultato["pesi"].shape[0]
+    return pl.DataFrame(
+        [ss.round(3).tolist(), prop.round(3).tolist(), np.cumsum(prop).round(3).tolist()],
+        orient="row",
+        schema=[f"Factor{j + 1}" for j in range(len(ss))]
+    ).with_columns(
+        pl.Series("DESCR", ["SS loadings", "Proportion Var", "Cumulative Var"])
+    ).select(["DESCR"] + [f"Factor{j + 1}" for j in range(len(ss))])
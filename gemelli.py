@@ -0,0 +1,174 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+import streamlit as st
+import voti_tidy as vt
+import istantanea
+
+### Ricerca dei "comuni gemelli", ovvero dei comuni con i risultati percentuali più simili
+
+# metriche disponibili: ognuna riceve la matrice delle percentuali (un comune per riga) e un profilo di voto
+# e restituisce il vettore delle distanze di ogni comune dal profilo
+metriche = {
+    "euclidea": lambda X, p: np.sqrt(((X - p) ** 2).sum(axis=1)),
+    "manhattan": lambda X, p: np.abs(X - p).sum(axis=1),
+    "chebyshev": lambda X, p: np.abs(X - p).max(axis=1),
+}
+
+
+# costruisce l'indice dei comuni: la matrice numpy delle percentuali dei partiti richiesti (selezionati per nome,
+# così l'ordine delle colonne di vt.votiPerc non conta), i nomi di comune e provincia e, per ogni nome di comune,
+# le righe corrispondenti (più di una in caso di omonimia)
+@st.cache_resource
+def get_indice(partiti: tuple = tuple(vt.partitiPlot)):
+    X = vt.votiPerc.select(partiti).to_numpy().astype(np.float64)
+    comuni = vt.votiPerc.get_column("COMUNE").to_numpy()
+    province = vt.votiPerc.get_column("PROVINCIA").to_numpy()
+    righe = {}
+    for i, comune in enumerate(comuni):
+        righe.setdefault(comune, []).append(i)
+    return X, comuni, province, righe
+
+
+# restituisce gli indici delle k distanze minori, ordinati per distanza (a parità, per ordine di riga)
+def _top_k(dist, k):
+    k = min(k, len(dist))
+    if k < len(dist):
+        idx = np.argpartition(dist, k - 1)[:k]
+    else:
+        idx = np.arange(len(dist))
+    return idx[np.lexsort((idx, dist[idx]))]
+
+
+# dato un profilo di voto qualsiasi (dizionario partito -> percentuale, oppure sequenza nell'ordine di partiti)
+# restituisce i k comuni più vicini come dataframe con COMUNE, PROVINCIA e DISTANZA.
+# Se escludi è il nome di un comune, tutte le righe con quel nome sono escluse dalla ricerca
+def gemelli_profilo(profilo, k: int = 1, metrica: str = "euclidea", escludi: str = None,
+                    partiti: tuple = tuple(vt.partitiPlot)):
+    X, comuni, province, righe = get_indice(partiti)
+    if isinstance(profilo, dict):
+        profilo = [profilo[partito] for partito in partiti]
+    dist = metriche[metrica](X, np.asarray(profilo, dtype=np.float64))
+    if escludi is not None:
+        dist[righe.get(escludi, [])] = np.inf
+
+    idx = _top_k(dist, k)
+    idx = idx[np.isfinite(dist[idx])]
+    return pl.DataFrame({
+        "COMUNE": comuni[idx],
+        "PROVINCIA": province[idx],
+        "DISTANZA": dist[idx]
+    })
+
+
+# restituisce i k comuni più simili al comune indicato (escluso il comune stesso).
+# In caso di omonimia si usa la prima riga, come in vt.votiPerc.filter(...).row(0)
+def gemelli(comune: str, k: int = 1, metrica: str = "euclidea", partiti: tuple = tuple(vt.partitiPlot)):
+    X, _, _, righe = get_indice(partiti)
+    return gemelli_profilo(X[righe[comune][0]], k, metrica, escludi=comune, partiti=partiti)
+
+
+### Tabella di tutti i gemelli, calcolata in blocco per ogni comune
+
+# calcola la matrice delle distanze tra i comuni del blocco A e tutti i comuni di X
+def _distanze_blocco(A, X, metrica):
+    if metrica == "euclidea":
+        # |a - x|^2 = |a|^2 + |x|^2 - 2 a.x, evitando la matrice tridimensionale delle differenze
+        d2 = (A ** 2).sum(axis=1)[:, None] + (X ** 2).sum(axis=1)[None, :] - 2 * A @ X.T
+        return np.sqrt(np.maximum(d2, 0))
+    diff = np.abs(A[:, None, :] - X[None, :, :])
+    return diff.sum(axis=2) if metrica == "manhattan" else diff.max(axis=2)
+
+
+# calcola i k gemelli dei comuni nelle righe [inizio, fine), escludendo i comuni con lo stesso nome
+def _gemelli_blocco(X, codici, k, metrica, inizio, fine):
+    dist = _distanze_blocco(X[inizio:fine], X, metrica)
+    dist[codici[inizio:fine, None] == codici[None, :]] = np.inf
+    k = min(k, X.shape[0])
+    idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    dist_k = np.take_along_axis(dist, idx, axis=1)
+    ordine = np.lexsort((idx, dist_k), axis=1)
+    return np.take_along_axis(idx, ordine, axis=1), np.take_along_axis(dist_k, ordine, axis=1)
+
+
+# calcola per ogni comune i k comuni più simili. Le distanze sono calcolate a blocchi di righe, di dimensione tale
+# da non superare circa memoria_mb megabyte per blocco, e i blocchi sono distribuiti su più thread (numpy rilascia
+# il GIL durante i calcoli, così la matrice X è condivisa senza copie). Restituisce un dataframe con una riga per
+# ogni coppia (comune, gemello), ordinato per RIGA (posizione del comune in vt.votiPerc) e RANGO
+def calcola_tabella_gemelli(k: int = 5, metrica: str = "euclidea", partiti: tuple = tuple(vt.partitiPlot),
+                            memoria_mb: float = 256, n_jobs: int = None):
+    X, comuni, province, _ = get_indice(partiti)
+    n, p = X.shape
+    _, codici = np.unique(comuni, return_inverse=True)
+
+    # byte per riga del blocco: matrice delle distanze, maschera e, per le metriche non euclidee, le differenze
+    byte_riga = n * (8 + 1 + (0 if metrica == "euclidea" else 8 * p))
+    blocco = max(1, min(n, int(memoria_mb * 2 ** 20 // byte_riga)))
+    inizi = range(0, n, blocco)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        risultati = list(pool.map(
+            lambda inizio: _gemelli_blocco(X, codici, k, metrica, inizio, min(inizio + blocco, n)),
+            inizi
+        ))
+    idx = np.concatenate([r[0] for r in risultati])
+    dist = np.concatenate([r[1] for r in risultati])
+
+    k = idx.shape[1]
+    righe = np.repeat(np.arange(n), k)
+    gemelli_idx = idx.ravel()
+    return pl.DataFrame({
+        "RIGA": righe,
+        "COMUNE": comuni[righe],
+        "PROVINCIA": province[righe],
+        "RANGO": np.tile(np.arange(1, k + 1), n),
+        "GEMELLO": comuni[gemelli_idx],
+        "PROVINCIA_GEMELLO": province[gemelli_idx],
+        "DISTANZA": dist.ravel()
+    })
+
+
+# percorso della tabella dei gemelli salvata su disco
+def _file_tabella(k, metrica):
+    return f"gemelli_{metrica}_{k}.parquet"
+
+
+# legge la tabella dei gemelli dall'istantanea o dal disco, calcolandola e salvandola se manca o se è stata calcolata
+# da un altro codice o file dei risultati (vedi istantanea.leggi_tabella)
+@st.cache_resource
+@istantanea.salvato("gemelli_{metrica}_{k}")
+def get_tabella_gemelli(k: int = 5, metrica: str = "euclidea"):
+    file = _file_tabella(k, metrica)
+    tabella = istantanea.leggi_tabella(file, vt.RAW_FILE)
+    if tabella is None:
+        tabella = calcola_tabella_gemelli(k, metrica)
+        istantanea.salva_tabella(file, tabella, vt.RAW_FILE)
+    return tabella
+
+
+# restituisce i k gemelli di un comune leggendoli dalla tabella precalcolata (k al massimo pari a quello della tabella)
+def gemelli_da_tabella(comune: str, k: int = 1, metrica: str = "euclidea", k_tabella: int = 5):
+    _, _, _, righe = get_indice()
+    tabella = get_tabella_gemelli(k_tabella, metrica)
+    riga = righe[comune][0]
+    return tabella.slice(riga * k_tabella, min(k, k_tabella))
+
+
+# dato un comune, trova e restituisce il comune con la minor distanza euclidea dei voti dei partiti in vt.partitiPlot
+# come tupla (comune, provincia). Il risultato è letto dalla tabella dei gemelli precalcolata
+def find_closer(comune: str):
+    closest = gemelli_da_tabella(comune)
+    if closest.is_empty():
+        return "NESSUNO"
+    return closest.select(["GEMELLO", "PROVINCIA_GEMELLO"]).row(0)
+
+
+if __name__ == "__main__":
+    # genera la tabella dei gemelli per tutti i comuni, ad esempio: python gemelli.py 10 manhattan
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    metrica = sys.argv[2] if len(sys.argv) > 2 else "euclidea"
+    tabella = calcola_tabella_gemelli(k, metrica)
+    istantanea.salva_tabella(_file_tabella(k, metrica), tabella, vt.RAW_FILE)
+    print(tabella)
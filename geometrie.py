@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import unicodedata
+import urllib.request
+import numpy as np
+import streamlit as st
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+alt = avvio.importa("altair")
+
+### Archivio locale dei confini per le mappe coropletiche, semplificati a più risoluzioni
+
+# Le geometrie originali (TopoJSON di openpolis) vengono scaricate una sola volta con `python geometrie.py` e salvate
+# in CARTELLA, semplificate a ognuna delle tolleranze indicate. La semplificazione lavora sugli archi del TopoJSON,
+# che sono condivisi tra aree confinanti, dunque i confini semplificati continuano a combaciare senza buchi.
+# L'archivio va salvato nel repository insieme al codice, così che l'app lo trovi senza bisogno della connessione.
+# Se non è presente, per regioni e province l'app usa direttamente i file remoti, come in precedenza; per i comuni no,
+# dato che il file originale pesa decine di megabyte e verrebbe scaricato dal browser a ogni visualizzazione.
+# La cartella è accanto a questo file, così che l'archivio del repository venga trovato da qualunque cartella corrente.
+
+CARTELLA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geometrie")
+URL_BASE = "https://raw.githubusercontent.com/openpolis/geojson-italy/master/topojson/"
+
+# per ogni livello: file sorgente, nome dell'oggetto nel TopoJSON e proprietà con il nome dell'area
+sorgenti = {
+    "REGIONE": ("limits_IT_regions.topo.json", "regions", "reg_name"),
+    "PROVINCIA": ("limits_IT_provinces.topo.json", "provinces", "prov_name"),
+    "COMUNE": ("limits_IT_municipalities.topo.json", "municipalities", "name"),
+}
+
+# tolleranze della semplificazione, in gradi (0.001 gradi sono circa 100 metri), dalla più fine alla più grossolana
+tolleranze = [0.0005, 0.002, 0.008]
+
+
+# nome del file dell'archivio per il livello e la tolleranza indicati
+def _file_geometria(livello, tolleranza):
+    return os.path.join(CARTELLA, f"{livello.lower()}_{tolleranza:g}.topo.json")
+
+
+# chiave con cui i comuni delle geometrie vengono associati a quelli dei risultati: maiuscolo, con le vocali
+# accentate scritte con l'apostrofo come in vt.votiPerc (e.g. "Forlì" -> "FORLI'") e senza altri diacritici
+def chiave_comune(nome):
+    nome = nome.upper()
+    for vocale in "AEIOU":
+        for accento in "\u0300\u0301":
+            nome = nome.replace(unicodedata.normalize("NFC", vocale + accento), vocale + "'")
+    return "".join(c for c in unicodedata.normalize("NFD", nome) if not unicodedata.combining(c))
+
+
+# decodifica gli archi del TopoJSON in coordinate assolute (uno array n x 2 per arco)
+def _decodifica_archi(topo):
+    trasformazione = topo.get("transform")
+    archi = []
+    for arco in topo["arcs"]:
+        punti = np.array(arco, dtype=np.float64)[:, :2]
+        if trasformazione is not None:
+            punti = np.cumsum(punti, axis=0) * trasformazione["scale"] + trasformazione["translate"]
+        archi.append(punti)
+    return archi
+
+
+# codifica gli archi quantizzando le coordinate su una griglia di passo pari a quantizzazione (in gradi), con le
+# differenze tra punti consecutivi come previsto dal formato. I punti che coincidono dopo la quantizzazione sono
+# rimossi, tranne gli estremi
+def _codifica_archi(archi, quantizzazione):
+    origine = np.min([a.min(axis=0) for a in archi], axis=0)
+    codificati = []
+    for punti in archi:
+        interi = np.round((punti - origine) / quantizzazione).astype(np.int64)
+        tieni = np.r_[True, np.any(interi[1:] != interi[:-1], axis=1)]
+        tieni[-1] = True
+        interi = interi[tieni]
+        codificati.append(np.vstack([interi[:1], np.diff(interi, axis=0)]).tolist())
+    return codificati, {"scale": [quantizzazione, quantizzazione], "translate": origine.tolist()}
+
+
+# semplificazione di Douglas-Peucker della spezzata punti: restituisce la maschera dei punti da tenere, in modo che
+# nessun punto rimosso disti più di tolleranza dalla spezzata semplificata. Gli estremi sono sempre tenuti
+def douglas_peucker(punti, tolleranza):
+    n = len(punti)
+    tieni = np.zeros(n, dtype=bool)
+    tieni[[0, n - 1]] = True
+    pila = [(0, n - 1)]
+    while pila:
+        i, j = pila.pop()
+        if j - i < 2:
+            continue
+        a, b = punti[i], punti[j]
+        interni = punti[i + 1:j]
+        ab = b - a
+        lung2 = ab @ ab
+        if lung2 == 0:
+            dist = np.hypot(*(interni - a).T)
+        else:
+            dist = np.abs(ab[0] * (interni[:, 1] - a[1]) - ab[1] * (interni[:, 0] - a[0])) / np.sqrt(lung2)
+        k = np.argmax(dist)
+        if dist[k] > tolleranza:
+            k += i + 1
+            tieni[k] = True
+            pila += [(i, k), (k, j)]
+    return tieni
+
+
+# semplifica un arco. Un arco chiuso (anello che non confina con altre aree, come un'isola) viene prima diviso nel
+# punto più lontano dall'inizio, altrimenti la semplificazione lo ridurrebbe a un solo punto
+def _semplifica_arco(punti, tolleranza):
+    n = len(punti)
+    if n > 3 and np.array_equal(punti[0], punti[-1]):
+        k = int(np.argmax(np.hypot(*(punti - punti[0]).T)))
+        if k == 0:
+            # anello degenere, con tutti i punti coincidenti
+            return punti
+        tieni = np.r_[douglas_peucker(punti[:k + 1], tolleranza)[:-1], douglas_peucker(punti[k:], tolleranza)]
+        # un anello deve avere almeno 4 punti (il primo ripetuto alla fine): oltre agli estremi e a k teniamo il punto
+        # a metà del più lungo dei due tratti in cui k divide l'anello, che è sempre distinto dagli altri tre
+        if tieni.sum() < 4:
+            tieni[[0, k, k // 2 if k >= n - 1 - k else (k + n - 1) // 2, n - 1]] = True
+    else:
+        tieni = douglas_peucker(punti, tolleranza)
+    return punti[tieni]
+
+
+# restituisce una copia del TopoJSON con tutti gli archi semplificati alla tolleranza indicata (in gradi)
+def semplifica(topo, tolleranza):
+    archi = [_semplifica_arco(punti, tolleranza) for punti in _decodifica_archi(topo)]
+    codificati, trasformazione = _codifica_archi(archi, tolleranza / 10)
+    return {
+        "type": "Topology",
+        "transform": trasformazione,
+        "objects": topo["objects"],
+        "arcs": codificati
+    }
+
+
+# aggiunge ai comuni la proprietà CHIAVE (vedi chiave_comune) su cui fare il lookup con i risultati
+def _aggiungi_chiavi(topo, oggetto):
+    for geometria in topo["objects"][oggetto]["geometries"]:
+        proprieta = geometria.setdefault("properties", {})
+        proprieta["CHIAVE"] = chiave_comune(proprieta.get("name", ""))
+    return topo
+
+
+# costruisce l'archivio per il livello indicato, leggendo il TopoJSON originale da sorgente (percorso locale o URL;
+# di default il file di openpolis) e scrivendo un file per ogni tolleranza
+def costruisci(livello, sorgente=None):
+    nome_file, oggetto, _ = sorgenti[livello]
+    sorgente = sorgente or URL_BASE + nome_file
+    if sorgente.startswith("http"):
+        with urllib.request.urlopen(sorgente) as risposta:
+            topo = json.load(risposta)
+    else:
+        with open(sorgente) as f:
+            topo = json.load(f)
+    if livello == "COMUNE":
+        topo = _aggiungi_chiavi(topo, oggetto)
+
+    os.makedirs(CARTELLA, exist_ok=True)
+    for tolleranza in tolleranze:
+        with open(_file_geometria(livello, tolleranza), "w") as f:
+            json.dump(semplifica(topo, tolleranza), f, separators=(",", ":"))
+
+
+# sceglie la geometria più leggera adeguata a una mappa larga larghezza pixel: la tolleranza più grossolana che non
+# superi mezzo pixel (l'Italia si estende per circa 12 gradi di longitudine). Restituisce i dati per Altair e la
+# proprietà su cui fare il lookup. Se l'archivio non contiene il livello, usa il file remoto non semplificato per
+# regioni e province e restituisce None come dati per i comuni
+@st.cache_data
+def get_geometria(livello: str, larghezza: int = 700):
+    nome_file, oggetto, etichetta = sorgenti[livello]
+    etichetta = "properties.CHIAVE" if livello == "COMUNE" else f"properties.{etichetta}"
+    mezzo_pixel = 12 / larghezza / 2
+    adeguate = [t for t in tolleranze if t <= mezzo_pixel] or tolleranze[:1]
+    disponibili = [t for t in adeguate[::-1] + tolleranze if os.path.exists(_file_geometria(livello, t))]
+    if not disponibili:
+        return (alt.topo_feature(URL_BASE + nome_file, oggetto) if livello != "COMUNE" else None), etichetta
+
+    with open(_file_geometria(livello, disponibili[0])) as f:
+        topo = json.load(f)
+    return alt.Data(values=topo, format=alt.DataFormat(type="topojson", feature=oggetto)), etichetta
+
+
+if __name__ == "__main__":
+    # uso: python geometrie.py [LIVELLO [sorgente]]
+    livelli = sys.argv[1:2] or list(sorgenti)
+    for livello in livelli:
+        costruisci(livello, sys.argv[2] if len(sys.argv) > 2 else None)
+        print(livello, [os.path.getsize(_file_geometria(livello, t)) for t in tolleranze])
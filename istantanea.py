@@ -0,0 +1,218 @@
+import os
+import json
+import inspect
+import hashlib
+import functools
+import numpy as np
+import polars as pl
+import streamlit as st
+
+### Lettura dell'istantanea dei risultati precalcolati (vedi precalcolo.py)
+
+# L'istantanea è una cartella con tutti i risultati delle analisi (aggregazioni, gemelli, coefficienti dei modelli,
+# componenti principali, dati dei grafici) calcolati una sola volta da `python precalcolo.py`. Ogni esecuzione crea
+# una nuova cartella CARTELLA/v<VERSIONE>-<hash del file dei risultati>-<data>, con un manifesto che descrive il
+# file sorgente e i file contenuti; il file CORRENTE indica quale cartella usare. L'app legge l'istantanea senza
+# mai modificarla: ogni funzione che trova il proprio risultato nell'istantanea lo restituisce invece di calcolarlo
+# (vedi salvato), altrimenti procede come di consueto. Un'istantanea vale finché non cambiano il file sorgente, il
+# codice dell'app o i file di configurazione che ne modificano i risultati.
+
+CARTELLA = "istantanea"
+# versione del formato dell'istantanea: va incrementata se cambia il contenuto o il formato di uno dei file
+VERSIONE = 2
+MANIFESTO = "manifesto.json"
+CORRENTE = "CORRENTE"
+# file che cambiano i risultati senza cambiare il codice (vedi voti_tidy.BLOCCHI_FILE)
+CONFIGURAZIONE = ["blocchi.json"]
+
+# con False l'istantanea viene ignorata e tutto viene ricalcolato (è il caso di precalcolo.py)
+USA = True
+
+
+# controlla che il file sorgente descritto nel manifesto non sia cambiato. Se il file non c'è (e.g. in produzione si
+# distribuisce solo l'istantanea) l'istantanea è comunque valida; se cambia solo la data di modifica, si confronta
+# l'hash del contenuto come per la cache dei dati grezzi
+def _sorgente_valida(sorgente):
+    if not os.path.exists(sorgente["file"]):
+        return True
+    stat = os.stat(sorgente["file"])
+    if stat.st_size != sorgente["size"]:
+        return False
+    if stat.st_mtime_ns == sorgente["mtime_ns"]:
+        return True
+    with open(sorgente["file"], "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest() == sorgente["sha256"]
+
+
+# hash del codice dell'app (i file .py nella cartella di questo modulo) e dei file di configurazione presenti,
+# salvato nel manifesto. Viene calcolato una volta per processo, come una volta per processo viene letto blocchi.json
+@functools.cache
+def impronta():
+    h = hashlib.sha256()
+    cartella = os.path.dirname(os.path.abspath(__file__))
+    codice = [os.path.join(cartella, file) for file in sorted(os.listdir(cartella)) if file.endswith(".py")]
+    for file in codice + CONFIGURAZIONE:
+        if os.path.exists(file):
+            h.update(os.path.basename(file).encode())
+            with open(file, "rb") as f:
+                h.update(hashlib.file_digest(f, "sha256").digest())
+    return h.hexdigest()
+
+
+# legge l'istantanea indicata dal file CORRENTE, letto con la data di modifica indicata (che fa da chiave della cache)
+@st.cache_resource
+def _leggi_corrente(cartella: str, modificato: int):
+    try:
+        with open(os.path.join(cartella, CORRENTE)) as f:
+            percorso = os.path.join(cartella, f.read().strip())
+        with open(os.path.join(percorso, MANIFESTO)) as f:
+            manifesto = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (manifesto.get("versione") != VERSIONE or manifesto.get("impronta") != impronta()
+            or not _sorgente_valida(manifesto["sorgente"])):
+        return None
+    return percorso, manifesto
+
+
+# restituisce la cartella dell'istantanea corrente e il suo manifesto, oppure None se non c'è un'istantanea valida.
+# A ogni chiamata si controlla solo la data di modifica di CORRENTE, così che una nuova istantanea creata con l'app
+# avviata venga usata senza rileggere ogni volta il manifesto
+def get_corrente(cartella: str = CARTELLA):
+    try:
+        modificato = os.stat(os.path.join(cartella, CORRENTE)).st_mtime_ns
+    except OSError:
+        return None
+    return _leggi_corrente(cartella, modificato)
+
+
+# percorso del file dell'artefatto nome nell'istantanea corrente, oppure None se l'istantanea non è in uso,
+# non c'è o non contiene l'artefatto
+def _file(nome):
+    if not USA:
+        return None
+    corrente = get_corrente()
+    if corrente is None:
+        return None
+    percorso, manifesto = corrente
+    file = manifesto["artefatti"].get(nome)
+    return os.path.join(percorso, file) if file is not None else None
+
+
+# tabella salvata come parquet, oppure None
+def leggi(nome):
+    file = _file(nome)
+    return pl.read_parquet(file) if file is not None else None
+
+
+# tabella salvata come parquet, in modo lazy: i filtri applicati in seguito (e.g. su una regione) vengono spinti
+# fino alla lettura. Oppure None
+def scansiona(nome):
+    file = _file(nome)
+    return pl.scan_parquet(file) if file is not None else None
+
+
+# oggetto salvato come json, oppure None
+def leggi_json(nome):
+    file = _file(nome)
+    if file is None:
+        return None
+    with open(file) as f:
+        return json.load(f)
+
+
+# dizionario di array salvato come npz, oppure None
+def leggi_array(nome):
+    file = _file(nome)
+    if file is None:
+        return None
+    with np.load(file, allow_pickle=False) as dati:
+        return dict(dati)
+
+
+# lettori dei formati degli artefatti
+_lettori = {"parquet": leggi, "json": leggi_json, "npz": leggi_array}
+
+
+# risultato salvato per la chiamata con gli argomenti indicati (per nome, compresi i predefiniti), oppure None.
+# Vedi salvato per il significato dei parametri
+def _cerca(nome, formato, chiave, argomenti):
+    if not isinstance(nome, str):
+        valori = tuple(_cerca(n, formato, chiave, argomenti) for n in nome)
+        return valori if all(valore is not None for valore in valori) else None
+    if chiave is not None and not isinstance(chiave, str) and not callable(chiave):
+        colonna, valore = chiave
+        tabella = scansiona(nome.format(**argomenti))
+        if tabella is None:
+            return None
+        tabella = tabella.filter(pl.col(colonna) == valore.format(**argomenti)).drop(colonna).collect()
+        return tabella if not tabella.is_empty() else None
+    salvato = _lettori[formato](nome.format(**argomenti))
+    if salvato is None or chiave is None:
+        return salvato
+    return salvato.get(chiave(argomenti) if callable(chiave) else chiave.format(**argomenti))
+
+
+# decoratore per le funzioni il cui risultato può essere salvato nell'istantanea: se l'artefatto c'è, la funzione
+# restituisce quello invece di calcolare il risultato. Il nome dell'artefatto e la chiave sono stringhe di formato
+# sugli argomenti della chiamata (e.g. "gemelli_{metrica}_{k}"); con più nomi, il risultato è la tupla degli
+# artefatti, che devono esserci tutti. La chiave indica:
+# - per gli artefatti json e npz (dizionari), la voce da restituire; può anche essere una funzione degli argomenti
+# - per le tabelle, una coppia (colonna, valore): si restituiscono le righe con quel valore, senza la colonna
+# Un artefatto o una voce mancante fanno calcolare il risultato. converti, se indicata, riceve il valore salvato e
+# gli argomenti e restituisce il risultato nel formato della funzione. Va applicato sotto i decoratori di cache
+def salvato(nome, formato="parquet", chiave=None, converti=None):
+    def decoratore(funzione):
+        firma = inspect.signature(funzione)
+
+        @functools.wraps(funzione)
+        def da_istantanea(*args, **kwargs):
+            argomenti = firma.bind(*args, **kwargs)
+            argomenti.apply_defaults()
+            valore = _cerca(nome, formato, chiave, argomenti.arguments)
+            if valore is None:
+                return funzione(*args, **kwargs)
+            return converti(valore, argomenti.arguments) if converti is not None else valore
+        return da_istantanea
+    return decoratore
+
+
+### Tabelle salvate su disco accanto ai dati (e.g. coeff_quantreg.parquet), fuori dall'istantanea
+
+# Le tabelle costose calcolate dall'app senza istantanea sono salvate nella cartella corrente, con accanto un file
+# <tabella>.json che descrive il codice (impronta) e il file sorgente da cui sono state ottenute, come il manifesto
+# dell'istantanea: una tabella è riusata solo se nessuno dei due è cambiato.
+
+
+# descrizione del file sorgente salvata nel manifesto: dimensione, data di modifica e hash del contenuto
+def descrivi_sorgente(file):
+    stat = os.stat(file)
+    with open(file, "rb") as f:
+        sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    return {"file": file, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+
+# tabella salvata da salva_tabella, se calcolata con il codice attuale e dal file sorgente indicato così com'è ora
+# (o se questo non c'è, come per l'istantanea), oppure None
+def leggi_tabella(file, sorgente):
+    try:
+        with open(f"{file}.json") as f:
+            descrizione = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (descrizione.get("versione") != VERSIONE or descrizione.get("impronta") != impronta()
+            or descrizione["sorgente"]["file"] != sorgente or not _sorgente_valida(descrizione["sorgente"])
+            or not os.path.exists(file)):
+        return None
+    return pl.read_parquet(file)
+
+
+# salva la tabella calcolata dal file sorgente, con la descrizione letta da leggi_tabella. Se la cartella non è
+# scrivibile non salva nulla
+def salva_tabella(file, tabella, sorgente):
+    try:
+        tabella.write_parquet(file)
+        with open(f"{file}.json", "w") as f:
+            json.dump({"versione": VERSIONE, "impronta": impronta(), "sorgente": descrivi_sorgente(sorgente)}, f)
+    except OSError:
+        pass
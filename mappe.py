@@ -1,75 +1,105 @@
+import numpy as np
 import polars as pl
-import altair as alt
 import streamlit as st
 import voti_tidy as vt
+import geometrie
+import nomi
+import istantanea
+import avvio
 
 ### Per mappa streamlit
 
-# effettua il preprocessing sul file contente le coordinate dei comuni italiani, correggendo accenti e alcune città
-# più grandi, in modo da rendere i dati compatibili a quelli contenuti nel DataFrame dei risultati (vt.votiPerc)
+# legge il file contente le coordinate dei comuni italiani ed estrae latitudine e longitudine. La correzione dei nomi
+# (accenti, esonimi, omonimie) è affidata all'abbinamento in nomi.py
 @st.cache_data
 def coord_preprocessing():
     cities = pl.read_csv("cities_coord.csv")
 
-    processed = cities.with_columns(
-        pl.col("name")
-        .str.replace_all(r"à", "a'")
-        .str.replace_all(r"è", "e'")
-        .str.replace_all(r"é", "e'")
-        .str.replace_all(r"ì", "i'")
-        .str.replace_all(r"ò", "o'")
-        .str.replace_all(r"ù", "u'")
-        .str.replace("Rome", "Roma")
-        .str.replace("Milan", "Milano")
-        .str.replace("Naples", "Napoli")
-        .str.replace("Turin", "Torino")
-        .str.replace("Genoa", "Genova")
-        .str.replace("Florence", "Firenze")
-        .str.replace("Venice", "Venezia")
-        .str.replace("Reggio Calabria", "Reggio di Calabria")
-        .str.replace("Bolzano", "Bolzano/Bozen")
-        .str.replace("Fiumicino-Isola Sacra", "Fiumicino")
-        .str.replace("Carpi Centro", "Carpi")
-        .str.replace("San Remo", "Sanremo")
-
+    processed = (
+        cities.with_columns(
+            pl.col("location").str.json_decode()
+        )
+        .unnest("location")
+        .drop("__type")
     )
 
     return processed
 
-# estrae nome e coordinate dai dati preprocessati e aggiunge a votiPerc tramite inner join
+# abbina i comuni di _df ai dati preprocessati (vedi nomi.abbina_coordinate) e aggiunge a _df coordinate e
+# confidenza dell'abbinamento tramite inner join su comune e provincia
 @st.cache_data
 def get_coord(_data, _df):
 
-    coord = (
-        _data.select(["name", "location"])
-        .with_columns(
-            pl.col("name").str.to_uppercase(),
-            pl.col("location").str.json_decode()
-        )
-        .unnest("location")
-        .drop("__type")
-        .unique(subset="name", keep="none")
-        .sort("name")
-    )
+    coord = nomi.abbina_coordinate(_df, _data).select(["COMUNE", "PROVINCIA", "latitude", "longitude", "CONFIDENZA"])
+
+    return _df.join(coord, on=["COMUNE", "PROVINCIA"])
+
+# risultati con le coordinate dei comuni (votiCoord): letti dall'istantanea se presente, altrimenti calcolati con
+# get_coord. Vengono calcolati alla prima richiesta, e non all'importazione del modulo, e poi restano in memoria come
+# variabile globale
+def get_voti_coord():
+    global votiCoord
+    if "votiCoord" not in globals():
+        with avvio.misura("mappe.votiCoord"):
+            salvati = istantanea.leggi("voti_coord")
+            votiCoord = salvati if salvati is not None else get_coord(coord_preprocessing(), vt.votiPerc)
+    return votiCoord
+
+# indice per il filtro della mappa: per ogni partito, l'ordine dei comuni (righe di base) per percentuale crescente
+# e le percentuali ordinate, senza i comuni in cui il partito non era candidato. Un intervallo di percentuali
+# corrisponde così a una fetta contigua dell'ordine, trovata con due ricerche binarie.
+# base contiene le colonne mostrate all'utente, con i comuni ordinati per regione, provincia e comune
+@st.cache_resource
+def get_indice_mappa():
+    base = get_voti_coord().drop(["CIRCOSCRIZIONE", "ELETTORI_M"]).sort(["REGIONE", "PROVINCIA", "COMUNE"])
+    posizioni = base.select(["latitude", "longitude"])
+    indice = {}
+    for partito in vt.partiti_ext:
+        valori = base.get_column(partito).cast(pl.Float64).to_numpy()
+        ordine = np.argsort(valori, kind="stable")[:base.get_column(partito).count()]
+        indice[partito] = (ordine, valori[ordine])
+    return base, posizioni, indice
+
+# estremi della fetta dell'ordine del partito con percentuali comprese tra minimo e massimo (inclusi)
+def intervallo(partito, minimo, massimo):
+    valori = get_indice_mappa()[2][partito][1]
+    return np.searchsorted(valori, minimo, side="left"), np.searchsorted(valori, massimo, side="right")
 
-    return _df.join(coord, left_on="COMUNE", right_on="name")
+# numero di comuni con percentuali del partito comprese tra minimo e massimo
+def conteggio(partito, minimo, massimo):
+    inizio, fine = intervallo(partito, minimo, massimo)
+    return max(fine - inizio, 0)
+
+# istogramma delle percentuali del partito comprese tra minimo e massimo, in n_bin classi di uguale ampiezza:
+# i conteggi si ottengono con una ricerca binaria per ogni estremo delle classi, senza scorrere i comuni
+def istogramma(partito, minimo, massimo, n_bin=20):
+    valori = get_indice_mappa()[2][partito][1]
+    bordi = np.linspace(minimo, massimo, n_bin + 1)
+    cumulati = np.searchsorted(valori, bordi, side="left")
+    cumulati[-1] = np.searchsorted(valori, massimo, side="right")
+    return pl.DataFrame({"DA": bordi[:-1], "A": bordi[1:], "COMUNI": np.diff(cumulati)})
+
+# righe di base (in ordine di regione, provincia e comune) dei comuni con percentuali del partito comprese
+# tra minimo e massimo
+def _righe(partito, minimo, massimo):
+    inizio, fine = intervallo(partito, minimo, massimo)
+    return np.sort(get_indice_mappa()[2][partito][0][inizio:fine])
+
+# coordinate dei comuni con percentuali del partito comprese tra minimo e massimo, per la mappa
+def posizioni_intervallo(partito, minimo, massimo):
+    return get_indice_mappa()[1][_righe(partito, minimo, massimo)]
+
+# tabella completa dei comuni con percentuali del partito comprese tra minimo e massimo: viene costruita solo se
+# richiesta, dato che la mappa ha bisogno delle sole coordinate
+def comuni_intervallo(partito, minimo, massimo):
+    return get_indice_mappa()[0][_righe(partito, minimo, massimo)]
 
 ### Per mappa Altair
 
-# scarica e preprocessa i dati geografici di tutte le regioni/provincie, a seconda del livello
-@st.cache_data
-def get_topo_data(livello):
-    if livello == "REGIONE":
-        geo = alt.topo_feature(
-            "https://raw.githubusercontent.com/openpolis/geojson-italy/master/topojson/limits_IT_regions.topo.json",
-            "regions")
-        label = "properties.reg_name"
-    else:  # elif chLiv == "COMUNE":
-        geo = alt.topo_feature(
-            "https://raw.githubusercontent.com/openpolis/geojson-italy/master/topojson/limits_IT_provinces.topo.json",
-            "provinces")
-        label = "properties.prov_name"
-    return geo, label
+# restituisce i dati geografici di tutte le regioni/provincie/comuni, a seconda del livello, e la proprietà con il
+# nome dell'area. Usa l'archivio locale delle geometrie semplificate, se presente (vedi geometrie.py)
+def get_topo_data(livello, larghezza=700):
+    return geometrie.get_geometria(livello, larghezza)
 
 
 # corregge nomi nel dataframe per renderli compatibili con il DataFrame dei risultati (vt.votiPerc)
@@ -93,6 +123,11 @@ def reg_prov_fix(voti):
     )
     return voti
 
-# assegnamo a variabile globale per poter riutilizzare comodamente
-dataCoord = coord_preprocessing()
-votiCoord = get_coord(dataCoord, vt.votiPerc)
+# mappe.votiCoord e mappe.dataCoord restano utilizzabili come variabili globali, calcolate al primo accesso
+# (vedi PEP 562)
+def __getattr__(nome):
+    if nome == "votiCoord":
+        return get_voti_coord()
+    if nome == "dataCoord":
+        return coord_preprocessing()
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
@@ -1,51 +1,170 @@
 import polars as pl
-import statsmodels.api as sm
-import altair as alt
 import streamlit as st
 import math
+import time
+import threading
+import numpy as np
 import voti_tidy as vt
+import regressione_quantile as rq
+import istantanea
+import avvio
 
-votiModel = vt.votiPerc.with_columns(
-    M_PERC=pl.col("ELETTORI_M") / pl.col("ELETTORI") * 100,
-    logELETTORI=pl.col("ELETTORI").log()
-)
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+sm = avvio.importa("statsmodels.api")
+alt = avvio.importa("altair")
+stats = avvio.importa("scipy.stats")
 
-# crea lo scatterplot dei punti (var, % voto partito), dove ogni punto è un comune.
-# size determina se i puntini sono proporzionali al numero di elettori nel comune
-def make_model_graph(var: str, log: bool, size: bool, title: str, partito: str):
+
+# dati dei modelli (votiModel): vt.votiPerc con la percentuale di elettori maschi e il logaritmo degli elettori.
+# Vengono calcolati alla prima richiesta, e non all'importazione del modulo, e poi restano in memoria come variabile
+# globale
+def get_voti_model():
     global votiModel
-    # se log=True crea una colonna denominata log{var} contenente i logaritimi della variabile
-    # ciò servirà a mantenere i valori originali della var sull'asse x, riscalando direttamente l'asse
+    if "votiModel" not in globals():
+        with avvio.misura("modelli.votiModel"):
+            votiModel = vt.votiPerc.with_columns(
+                M_PERC=pl.col("ELETTORI_M") / pl.col("ELETTORI") * 100,
+                logELETTORI=pl.col("ELETTORI").log()
+            )
+    return votiModel
+
+
+# mod.votiModel resta utilizzabile come variabile globale, calcolata al primo accesso (vedi PEP 562)
+def __getattr__(nome):
+    if nome == "votiModel":
+        return get_voti_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
+
+
+# adatta i modelli lineari semplici % voto partito ~ var (oppure ~ log(var)) per tutti i partiti in vt.partiti_ext
+# con un'unica risoluzione vettorizzata delle equazioni normali, una per partito. Ogni partito usa solo i comuni in cui
+# era candidato (ovvero con valore non nullo). Restituisce un dizionario partito -> intercetta, coefficiente angolare,
+# R^2 e p-value del coefficiente angolare, così che ogni combinazione (var, log, partito) sia già in cache
+@st.cache_data
+@istantanea.salvato("ols", "json", chiave="{var}|{log}")
+def fit_ols(var: str, log: bool):
+    voti = get_voti_model()
+    x = voti.get_column(var).to_numpy().astype(np.float64)
     if log:
-        votiModel = votiModel.with_columns(
-            pl.col(var).log().alias(f"log{var}"),
-        )
-    intercept = sm.add_constant(votiModel.get_column(f"log{var}" if log else var).to_list())
-    vote_share = votiModel.get_column(partito).to_list()
-    model = sm.OLS(vote_share, intercept).fit()
+        x = np.log(x)
+    Y = voti.select(vt.partiti_ext).to_numpy().astype(np.float64)
+    W = ~np.isnan(Y)
+    Y0 = np.where(W, Y, 0)
 
-    plot_prev = votiModel.with_columns(
-        prev=model.predict(intercept)
-    )
+    # matrice del disegno [1, x] e, per ogni partito j, X'W_jX e X'W_jy
+    X = np.column_stack([np.ones_like(x), x])
+    XtX = np.einsum("ik,il,ij->jkl", X, X, W)
+    Xty = np.einsum("ik,ij->jk", X, Y0)
+    beta = np.linalg.solve(XtX, Xty[..., None])[..., 0]
 
-    base = (
-        alt.Chart(plot_prev)
-        .mark_circle()
-        .encode(
-            alt.X(var, scale=alt.Scale(type='log') if log else alt.Scale(type="linear",zero=False),
-                  axis=alt.Axis(title=title)),
-            # altair ha bisogno di escapare le quotes altrimenti panica (closed issue 888), dunque sostiamo direttamente qua
-            alt.Y(partito.replace("'", "\\'"), axis=alt.Axis(title=f"% di {partito.title()}")),
-            alt.Size("ELETTORI") if size else alt.Size(),
-            alt.Tooltip("COMUNE")
+    n = W.sum(axis=0)
+    res = np.where(W, Y0 - X @ beta.T, 0)
+    ssr = (res ** 2).sum(axis=0)
+    media = Y0.sum(axis=0) / n
+    sst = (np.where(W, Y0 - media, 0) ** 2).sum(axis=0)
+    # errore standard del coefficiente angolare, dall'elemento [1, 1] di sigma^2 (X'WX)^-1
+    sigma2 = ssr / (n - 2)
+    se = np.sqrt(sigma2 * np.linalg.inv(XtX)[:, 1, 1])
+    pvalues = 2 * stats.t.sf(np.abs(beta[:, 1] / se), n - 2)
+
+    return {
+        partito: {
+            "intercetta": beta[j, 0],
+            "coeff": beta[j, 1],
+            "rsquared": 1 - ssr[j] / sst[j],
+            "pvalue": pvalues[j]
+        }
+        for j, partito in enumerate(vt.partiti_ext)
+    }
+
+
+# raggruppa i punti (x, y) in un istogramma bidimensionale di n_bin x n_bin celle, restituendo per ogni cella con
+# almeno min_comuni comuni gli estremi, il numero di comuni e il numero totale di elettori, insieme alla maschera dei
+# punti che cadono nelle celle con meno comuni (da mostrare singolarmente). Se log=True le celle sono equispaziate
+# sulla scala logaritmica di x, come l'asse del grafico
+def _bin_2d(x, y, elettori, n_bin: int, log: bool, min_comuni: int = 1):
+    bordi_x = np.histogram_bin_edges(np.log(x) if log else x, n_bin)
+    if log:
+        bordi_x = np.exp(bordi_x)
+        # exp(log(x)) può differire da x per errori di arrotondamento, lasciando i comuni estremi fuori dalle celle
+        bordi_x[0], bordi_x[-1] = x.min(), x.max()
+    bordi_y = np.histogram_bin_edges(y, n_bin)
+    # cella di ogni punto; come in np.histogram2d l'ultima cella include anche il suo estremo destro
+    cella_x = np.clip(np.searchsorted(bordi_x, x, side="right") - 1, 0, n_bin - 1)
+    cella_y = np.clip(np.searchsorted(bordi_y, y, side="right") - 1, 0, n_bin - 1)
+    cella = cella_x * n_bin + cella_y
+    comuni = np.bincount(cella, minlength=n_bin * n_bin)
+    pesi = np.bincount(cella, weights=elettori, minlength=n_bin * n_bin)
+    piene = np.flatnonzero(comuni >= max(min_comuni, 1))
+    i, j = piene // n_bin, piene % n_bin
+    celle = pl.DataFrame({
+        "X0": bordi_x[i], "X1": bordi_x[i + 1],
+        "Y0": bordi_y[j], "Y1": bordi_y[j + 1],
+        "COMUNI": comuni[piene].astype(np.int64),
+        "ELETTORI": pesi[piene]
+    })
+    return celle, comuni[cella] < min_comuni
+
+
+# crea lo scatterplot dei punti (var, % voto partito), dove ogni punto è un comune.
+# size determina se i puntini sono proporzionali al numero di elettori nel comune.
+# Se i comuni sono più di max_punti, invece dei singoli punti si mostra un istogramma bidimensionale calcolato qui,
+# colorato per numero di comuni (o di elettori, se size=True), così da non inviare al browser migliaia di punti.
+# I comuni nelle celle con meno di min_comuni comuni (tipicamente quelli anomali) restano comunque punti singoli,
+# con il nome del comune nel tooltip.
+# La retta di regressione è in ogni caso esatta: essendo una retta (anche sull'asse logaritmico, dato che è stimata
+# sul logaritmo della variabile) bastano i suoi due estremi
+def make_model_graph(var: str, log: bool, size: bool, title: str, partito: str, max_punti: int = 2000,
+                     n_bin: int = 60, min_comuni: int = 3):
+    model = fit_ols(var, log)[partito]
+    dati = get_voti_model().select(list(dict.fromkeys(["COMUNE", "ELETTORI", var, partito]))).drop_nulls()
+    scala_x = alt.Scale(type="log") if log else alt.Scale(type="linear", zero=False)
+    titolo_y = f"% di {partito.title()}"
+
+    # grafico dei singoli comuni
+    def punti(comuni):
+        return (
+            alt.Chart(comuni)
+            .mark_circle()
+            .encode(
+                alt.X(var, scale=scala_x, axis=alt.Axis(title=title)),
+                # altair ha bisogno di escapare le quotes altrimenti panica (closed issue 888), dunque sostiamo direttamente qua
+                alt.Y(partito.replace("'", "\\'"), axis=alt.Axis(title=titolo_y)),
+                alt.Size("ELETTORI") if size else alt.Size(),
+                alt.Tooltip("COMUNE")
+            )
         )
-    )
 
+    if dati.height <= max_punti:
+        base = punti(dati)
+    else:
+        celle, isolati = _bin_2d(dati.get_column(var).to_numpy(), dati.get_column(partito).to_numpy(),
+                                 dati.get_column("ELETTORI").to_numpy(), n_bin, log, min_comuni)
+        base = (
+            alt.Chart(celle)
+            .mark_rect()
+            .encode(
+                alt.X("X0:Q", scale=scala_x, axis=alt.Axis(title=title)),
+                alt.X2("X1:Q"),
+                alt.Y("Y0:Q", axis=alt.Axis(title=titolo_y)),
+                alt.Y2("Y1:Q"),
+                alt.Color("ELETTORI:Q" if size else "COMUNI:Q", scale=alt.Scale(type="log", scheme="greys")),
+                tooltip=["COMUNI:Q", alt.Tooltip("ELETTORI:Q", format=",.0f")]
+            )
+        ) + punti(dati.filter(isolati))
+
+    # se log=True la retta è stimata sul logaritmo della variabile, ma manteniamo i valori originali della var
+    # sull'asse x, riscalando direttamente l'asse
+    estremi = np.array([dati.get_column(var).min(), dati.get_column(var).max()])
+    retta = pl.DataFrame({
+        var: estremi,
+        "prev": model["intercetta"] + model["coeff"] * (np.log(estremi) if log else estremi)
+    })
     trend = (
-        alt.Chart(plot_prev)
+        alt.Chart(retta)
         .mark_line(color="red")
         .encode(
-            alt.X(var, scale=alt.Scale(type="log")) if log else alt.X(var),
+            alt.X(var, scale=scala_x),
             alt.Y("prev")
         )
     )
@@ -53,30 +172,67 @@ def make_model_graph(var: str, log: bool, size: bool, title: str, partito: str):
     st.altair_chart(base + trend, use_container_width=True)
     st.latex(
         rf"""
-        R^2: {model.rsquared:.3f} \quad
-        p\text{{-value dell'esplicativa: }} {model.pvalues[1]:.2e} \quad
-        \text{{coeff. angolare: }} {model.params[1]:.2f} 
+        R^2: {model["rsquared"]:.3f} \quad
+        p\text{{-value dell'esplicativa: }} {model["pvalue"]:.2e} \quad
+        \text{{coeff. angolare: }} {model["coeff"]:.2f} 
         """
     )
 
 
-# crea predizione del comune medio e relativo pie plot
+# esplicative del modello completo
+esplicative = ["logELETTORI", "M_PERC", "AFFLUENZA"]
+# file in cui è salvata la tabella dei coefficienti della regressione quantile
+COEFF_FILE = "coeff_quantreg.parquet"
+
+
+# adatta la regressione quantile (mediana) di ogni partito in vt.partitiPlot sulle esplicative, per l'Italia intera e
+# per ogni regione, distribuendo i modelli su n_jobs processi (vedi regressione_quantile.fit_quantreg).
+# Di default non si usa il warm start, così che i coefficienti coincidano con quelli di sm.QuantReg.
+# Restituisce una tabella con una riga per (REGIONE, PARTITO) e una colonna per coefficiente; se tempi=True
+# restituisce anche la tabella dei tempi di ogni adattamento
+def calcola_coeff_quantreg(tempi: bool = False, n_jobs: int = None, warm_start: bool = False):
+    voti = get_voti_model()
+    X = sm.add_constant(voti.select(esplicative).to_numpy())
+    Y = voti.select(vt.partitiPlot).to_numpy()
+    regioni = voti.get_column("REGIONE")
+    gruppi = {reg: np.flatnonzero(regioni == reg) for reg in sorted(regioni.unique().to_list())}
+    coeff, tempi_fit = rq.fit_quantreg(X, Y, vt.partitiPlot, gruppi, ["const"] + esplicative, n_jobs,
+                                     warm_start)
+    return (coeff, tempi_fit) if tempi else coeff
+
+
+# legge la tabella dei coefficienti dall'istantanea o dal disco, calcolandola e salvandola se manca o se è stata
+# calcolata da un altro codice o file dei risultati (vedi istantanea.leggi_tabella). Dall'app il calcolo avviene nel
+# processo corrente (n_jobs=1). Restituisce un dizionario regione -> matrice dei coefficienti (partiti in
+# vt.partitiPlot per riga)
+@st.cache_resource
+def get_coeff_quantreg():
+    coeff = istantanea.leggi("coeff_quantreg")
+    if coeff is None:
+        coeff = istantanea.leggi_tabella(COEFF_FILE, vt.RAW_FILE)
+    if coeff is None:
+        coeff = calcola_coeff_quantreg(n_jobs=1)
+        istantanea.salva_tabella(COEFF_FILE, coeff, vt.RAW_FILE)
+
+    matrici = {}
+    for (reg,), tab in coeff.partition_by("REGIONE", as_dict=True).items():
+        # riordiniamo le righe secondo vt.partitiPlot, indipendentemente dall'ordine nel file
+        beta = dict(zip(tab.get_column("PARTITO"), tab.select(["const"] + esplicative).to_numpy()))
+        matrici[reg] = np.array([beta[partito] for partito in vt.partitiPlot])
+    return matrici
+
+
+# previsione per ogni partito, arrotondata alla seconda cifra decimale, e per gli altri, come differenza da 100 delle
+# previsioni arrotondate. Con beta di dimensione campioni x partiti x coefficienti si ottiene una riga per campione
+def _previsione(beta, x):
+    pred = np.round(beta @ x, 2)
+    return np.concatenate([pred, 100 - pred.sum(axis=-1, keepdims=True)], axis=-1)
+
+
+# crea predizione del comune medio e relativo pie plot. I coefficienti dipendono solo dalla regione, dunque la
+# previsione è un semplice prodotto matrice-vettore con la tabella precalcolata
 def prediction(reg: str, elett: int, m_perc: float, affl: float):
-    if reg == "ITALIA":
-        voti_pred = votiModel
-    else:
-        voti_pred = votiModel.filter(pl.col("REGIONE") == reg)
-
-    pred = []
-    for i in range(len(vt.partitiPlot)):
-        partito = vt.partiti[i]
-        vote_share = voti_pred.get_column(partito).to_list()
-        espl = sm.add_constant(voti_pred.select(["logELETTORI", "M_PERC", "AFFLUENZA"]))
-        mod_compl = sm.QuantReg(vote_share, espl).fit()
-        beta = mod_compl.params
-
-        pred.append(round(beta[0] + beta[1] * math.log(elett) + beta[2] * m_perc + beta[3] * affl, 2))
-    pred.append(100-sum(pred))
+    pred = _previsione(get_coeff_quantreg()[reg], np.array([1, math.log(elett), m_perc, affl])).tolist()
     pred_df = pl.DataFrame(
         {
             "PARTITO" : vt.partitiPlot + ["ALTRI"],
@@ -96,9 +252,86 @@ def prediction(reg: str, elett: int, m_perc: float, affl: float):
     return pie
 
 
+# campioni bootstrap già calcolati, per regione e numero di campioni richiesto, e un lock per ognuna di queste coppie,
+# così che le sessioni attendano solo il bootstrap della stessa regione. L'ultimo lock protegge i due dizionari
+@st.cache_resource
+def _campioni_bootstrap():
+    return {}, {}, threading.Lock()
+
+
+# stima la distribuzione bootstrap dei coefficienti delle regressioni quantili della regione (vedi
+# regressione_quantile.bootstrap_quantreg), partendo dai coefficienti precalcolati. I campioni sono tenuti in memoria
+# per regione, così che cambiare i valori delle esplicative non richieda di rifare il bootstrap. Se allo scadere di
+# tempo_max non sono stati calcolati tutti gli n_boot campioni, le richieste successive riprendono da quelli già
+# calcolati: dato che i campioni sono sempre i primi della stessa sequenza, lo stesso numero di campioni dà sempre lo
+# stesso risultato. Se l'istantanea contiene i campioni (calcolati senza tempo massimo) si usano quelli.
+# Il bootstrap viene eseguito nel processo corrente (n_jobs=1): dall'app non si possono avviare processi con spawn
+@istantanea.salvato("bootstrap_{n_boot}", "npz", chiave="{reg}")
+def get_bootstrap(reg: str, n_boot: int = 200, tempo_max: float = 10.0):
+    campioni, lock_coppie, lock = _campioni_bootstrap()
+    with lock:
+        lock_coppia = lock_coppie.setdefault((reg, n_boot), threading.Lock())
+    with lock_coppia:
+        fatti = campioni.get((reg, n_boot))
+        if fatti is None or fatti.shape[0] < n_boot:
+            voti_reg = get_voti_model() if reg == "ITALIA" else get_voti_model().filter(pl.col("REGIONE") == reg)
+            X = sm.add_constant(voti_reg.select(esplicative).to_numpy(), has_constant="add")
+            Y = voti_reg.select(vt.partitiPlot).to_numpy()
+            nuovi = rq.bootstrap_quantreg(X, Y, get_coeff_quantreg()[reg], n_boot, tempo_max=tempo_max, n_jobs=1,
+                                          salta=0 if fatti is None else fatti.shape[0])
+            # un nuovo array, e non una modifica di quello già restituito ad altre sessioni
+            fatti = nuovi if fatti is None else np.concatenate([fatti, nuovi])
+            with lock:
+                campioni[(reg, n_boot)] = fatti
+    return fatti
+
+
+# restituisce, per ogni partito e per gli altri, la previsione del comune mediano e l'intervallo bootstrap al livello
+# indicato. Come per la previsione, gli intervalli sono un prodotto tra i coefficienti dei campioni e le esplicative.
+# Se non è stato completato alcun campione entro il tempo massimo gli estremi sono nulli
+def prediction_intervals(reg: str, elett: int, m_perc: float, affl: float, livello: float = 0.95,
+                         n_boot: int = 200, tempo_max: float = 10.0):
+    x = np.array([1, math.log(elett), m_perc, affl])
+    pred = _previsione(get_coeff_quantreg()[reg], x)
+    pred_boot = _previsione(get_bootstrap(reg, n_boot, tempo_max), x)
+    if pred_boot.shape[0] > 0:
+        inf, sup = np.percentile(pred_boot, [50 * (1 - livello), 50 * (1 + livello)], axis=0)
+    else:
+        inf = sup = [None] * len(pred)
+
+    return pl.DataFrame(
+        {
+            "PARTITO": vt.partitiPlot + ["ALTRI"],
+            "PREVISIONE": pred.round(2),
+            "INF": pl.Series(inf, dtype=pl.Float64).round(2),
+            "SUP": pl.Series(sup, dtype=pl.Float64).round(2),
+            "CAMPIONI": [pred_boot.shape[0]] * len(pred)
+        }
+    )
+
+
 # adatta e restituisce il modello completo (con le tre esplicative considerate nella discussione)
+@st.cache_resource
 def make_compl_model(partito: str):
-    vote_share = votiModel.get_column(partito).to_list()
-    espl = sm.add_constant(votiModel.select(["logELETTORI", "M_PERC", "AFFLUENZA"]).to_pandas())
+    voti = get_voti_model()
+    vote_share = voti.get_column(partito).to_list()
+    espl = sm.add_constant(voti.select(["logELETTORI", "M_PERC", "AFFLUENZA"]).to_pandas())
     mod_compl = sm.QuantReg(vote_share, espl).fit()
     return mod_compl
+
+
+# riepilogo testuale del modello completo, come mostrato nell'app: letto dall'istantanea se presente, così da non
+# dover adattare il modello
+@istantanea.salvato("modello_completo", "json", chiave="{partito}")
+def riepilogo_compl_model(partito: str):
+    return str(make_compl_model(partito).summary())
+
+
+if __name__ == "__main__":
+    # ricalcola e salva la tabella dei coefficienti della regressione quantile, riportando i tempi
+    inizio = time.perf_counter()
+    coeff, tempi = calcola_coeff_quantreg(tempi=True)
+    istantanea.salva_tabella(COEFF_FILE, coeff, vt.RAW_FILE)
+    print(coeff)
+    print(tempi.sort("SECONDI", descending=True))
+    print(f"Tempo totale: {time.perf_counter() - inizio:.2f} s, somma dei singoli adattamenti: {tempi['SECONDI'].sum():.2f} s")
@@ -0,0 +1,177 @@
+import unicodedata
+from collections import Counter
+import numpy as np
+import polars as pl
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+sparse = avvio.importa("scipy.sparse")
+
+### Normalizzazione e abbinamento dei nomi dei comuni tra i risultati elettorali e altre tabelle (e.g. coordinate)
+
+# tabella di traduzione precompilata: lettere accentate -> lettera base, punteggiatura -> spazio. Così "Forlì" e
+# "FORLI'" o "Sant'Agata" e "SANT'AGATA" hanno la stessa forma normalizzata
+_tabella = str.maketrans(
+    {c: unicodedata.normalize("NFD", c)[0] for c in map(chr, range(0xC0, 0x250))
+     if unicodedata.normalize("NFD", c)[0].isascii()}
+    | {c: " " for c in "'’`´-.,;:()\""}
+)
+
+# nomi (già normalizzati) che differiscono non solo per accenti e punteggiatura: esonimi inglesi e nomi di frazioni
+# usati al posto del comune nella tabella delle coordinate
+sinonimi = {
+    "ROME": "ROMA",
+    "MILAN": "MILANO",
+    "NAPLES": "NAPOLI",
+    "TURIN": "TORINO",
+    "GENOA": "GENOVA",
+    "FLORENCE": "FIRENZE",
+    "VENICE": "VENEZIA",
+    "REGGIO CALABRIA": "REGGIO DI CALABRIA",
+    "FIUMICINO ISOLA SACRA": "FIUMICINO",
+    "CARPI CENTRO": "CARPI",
+    "SAN REMO": "SANREMO",
+}
+
+# priorità dei tipi di località di GeoNames: a parità di nome si preferisce il capoluogo del comune a una frazione
+_priorita = {"PPLC": 0, "PPLA": 1, "PPLA2": 2, "PPLA3": 3}
+
+
+# forma normalizzata di un nome: maiuscolo, senza accenti né punteggiatura, spazi singoli, sinonimi sostituiti
+def normalizza(nome):
+    nome = " ".join(nome.translate(_tabella).upper().split())
+    return sinonimi.get(nome, nome)
+
+
+# forme alternative di un nome: i comuni bilingui (e.g. "BOLZANO/BOZEN") possono comparire con una sola delle due
+def varianti(nome):
+    return list(dict.fromkeys([normalizza(nome)] + [normalizza(parte) for parte in nome.split("/")]))
+
+
+# trigrammi di un nome normalizzato, con uno spazio all'inizio e alla fine per dare peso alle estremità
+def trigrammi(nome):
+    nome = f" {nome} "
+    return {nome[i:i + 3] for i in range(len(nome) - 2)}
+
+
+# matrice sparsa binaria (nomi x trigrammi del vocabolario); il vocabolario viene esteso con i nuovi trigrammi
+def _matrice_trigrammi(nomi, vocabolario):
+    righe, colonne = [], []
+    for i, nome in enumerate(nomi):
+        for t in trigrammi(nome):
+            righe.append(i)
+            colonne.append(vocabolario.setdefault(t, len(vocabolario)))
+    return righe, colonne
+
+
+# abbina ogni comune (nome e provincia) a una riga della tabella di riferimento (nomi, codici di provincia, tipi di
+# località e popolazione). Procede in tre passi:
+# 1. corrispondenza esatta dei nomi normalizzati (comprese le varianti bilingui);
+# 2. dalle corrispondenze esatte non ambigue ricava a quale provincia corrisponde ogni codice di provincia della
+#    tabella di riferimento (quello più frequente), e con questo sceglie tra gli omonimi quello della provincia giusta.
+#    Se sono indicate le posizioni (latitudine, longitudine) della tabella di riferimento, un nome trovato solo in
+#    un'altra provincia viene accettato con confidenza 0.8 se dista meno di raggio_km dal baricentro dei comuni già
+#    abbinati della provincia (e.g. comuni passati di recente a un'altra provincia);
+# 3. per i comuni rimasti, cerca il nome più simile nella stessa provincia tramite un indice di trigrammi (matrice
+#    sparsa, confrontata a blocchi di righe), con similarità di Dice almeno pari a soglia.
+# Restituisce, per ogni comune, l'indice della riga abbinata (-1 se nessuna), la confidenza (1 per le
+# corrispondenze esatte, la similarità per le altre) e il metodo usato
+def abbina(comuni, province, nomi_rif, codici_rif, tipi_rif, popolazione_rif, posizioni_rif=None, soglia=0.7,
+           raggio_km=60, blocco=500):
+    n = len(comuni)
+    chiavi_rif = [normalizza(nome) for nome in nomi_rif]
+    ordine = sorted(range(len(nomi_rif)), key=lambda j: (_priorita.get(tipi_rif[j], 9), -popolazione_rif[j]))
+    indice = {}
+    for j in ordine:
+        indice.setdefault(chiavi_rif[j], []).append(j)
+
+    candidati = []
+    for comune in comuni:
+        trovati = [j for chiave in varianti(comune) for j in indice.get(chiave, [])]
+        candidati.append(list(dict.fromkeys(trovati)))
+
+    # codice di provincia della tabella di riferimento -> provincia dei risultati, a maggioranza
+    conteggi = Counter(
+        (codici_rif[c[0]], prov) for c, prov in zip(candidati, province) if len({codici_rif[j] for j in c}) == 1
+    )
+    provincia_di = {}
+    for (codice, prov), _ in conteggi.most_common():
+        provincia_di.setdefault(codice, prov)
+
+    scelta = np.full(n, -1)
+    confidenza = np.zeros(n)
+    metodo = np.full(n, "nessuno", dtype=object)
+    for i, c in enumerate(candidati):
+        stessa = [j for j in c if provincia_di.get(codici_rif[j]) == province[i]]
+        if stessa:
+            scelta[i], confidenza[i], metodo[i] = stessa[0], 1.0, "esatto"
+        elif c and len({codici_rif[j] for j in c}) == 1 and codici_rif[c[0]] not in provincia_di:
+            # codice di provincia mai visto: accettiamo l'omonimo solo se non ambiguo
+            scelta[i], confidenza[i], metodo[i] = c[0], 1.0, "esatto"
+
+    if posizioni_rif is not None:
+        posizioni_rif = np.radians(np.asarray(posizioni_rif, dtype=np.float64))
+        abbinati = np.flatnonzero(scelta >= 0)
+        prov_abbinati = np.array([province[i] for i in abbinati], dtype=object)
+        baricentri = {
+            prov: posizioni_rif[scelta[abbinati[prov_abbinati == prov]]].mean(axis=0) for prov in set(prov_abbinati)
+        }
+        for i, c in enumerate(candidati):
+            if scelta[i] >= 0 or not c or province[i] not in baricentri:
+                continue
+            # distanza dal baricentro con l'approssimazione equirettangolare, sufficiente a queste distanze
+            dlat, dlon = (posizioni_rif[c] - baricentri[province[i]]).T
+            km = 6371 * np.hypot(dlat, dlon * np.cos(posizioni_rif[c, 0]))
+            if km.min() < raggio_km:
+                scelta[i], confidenza[i], metodo[i] = c[int(np.argmin(km))], 0.8, "altra provincia"
+
+    mancanti = np.flatnonzero(scelta < 0)
+    if mancanti.size > 0:
+        vocabolario = {}
+        r_rif, c_rif = _matrice_trigrammi(chiavi_rif, vocabolario)
+        nomi_q = [normalizza(comuni[i].split("/")[0]) for i in mancanti]
+        r_q, c_q = _matrice_trigrammi(nomi_q, vocabolario)
+        A = sparse.csr_matrix((np.ones(len(r_q)), (r_q, c_q)), shape=(len(nomi_q), len(vocabolario)))
+        B = sparse.csr_matrix((np.ones(len(r_rif)), (r_rif, c_rif)), shape=(len(chiavi_rif), len(vocabolario)))
+        lung_q, lung_rif = np.asarray(A.sum(axis=1)), np.asarray(B.sum(axis=1)).T
+        # province come codici interi, così che il confronto di ogni blocco sia tra interi e non tra stringhe
+        # (-1 per i codici della tabella di riferimento senza provincia, che non corrisponde a nessun comune)
+        codice_provincia = {}
+        prov_q = np.array([codice_provincia.setdefault(province[i], len(codice_provincia)) for i in mancanti])
+        prov_rif = np.array([codice_provincia.get(provincia_di.get(codice), -1) for codice in codici_rif])
+
+        # a blocchi di righe, per non costruire l'intera matrice densa delle similarità
+        for inizio in range(0, len(mancanti), blocco):
+            fine = min(inizio + blocco, len(mancanti))
+            dice = 2 * (A[inizio:fine] @ B.T).toarray() / (lung_q[inizio:fine] + lung_rif)
+            stessa = prov_rif[None, :] == prov_q[inizio:fine, None]
+            punteggi = np.where(stessa, dice, 0)
+            migliori = np.argmax(punteggi, axis=1)
+            for k, j in enumerate(migliori):
+                if punteggi[k, j] >= soglia:
+                    i = mancanti[inizio + k]
+                    scelta[i], confidenza[i], metodo[i] = j, punteggi[k, j], "simile"
+
+    return scelta, confidenza, metodo
+
+
+# abbina i comuni di voti (colonne COMUNE e PROVINCIA) alla tabella delle coordinate (colonne name, muni, featureCode,
+# population, latitude, longitude; le prime tre cifre del codice ISTAT muni indicano la provincia). Restituisce una
+# riga per comune abbinato con nome corrispondente, coordinate, confidenza e metodo dell'abbinamento
+def abbina_coordinate(voti, coord, soglia=0.7):
+    scelta, confidenza, metodo = abbina(
+        voti.get_column("COMUNE").to_list(),
+        voti.get_column("PROVINCIA").to_list(),
+        coord.get_column("name").to_list(),
+        (coord.get_column("muni") // 1000).to_list(),
+        coord.get_column("featureCode").to_list(),
+        coord.get_column("population").fill_null(0).to_list(),
+        coord.select(["latitude", "longitude"]).to_numpy(),
+        soglia
+    )
+    trovati = scelta >= 0
+    return pl.concat([
+        voti.select(["COMUNE", "PROVINCIA"]).filter(pl.Series(trovati)),
+        coord[scelta[trovati]].select(pl.col("name").alias("NOME_COORD"), "latitude", "longitude"),
+        pl.DataFrame({"CONFIDENZA": confidenza[trovati], "METODO": metodo[trovati].astype(str)})
+    ], how="horizontal")
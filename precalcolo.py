@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import shutil
+from datetime import datetime
+import numpy as np
+import polars as pl
+import istantanea
+
+# i risultati vanno ricalcolati, non letti dall'istantanea precedente: va disattivata prima di importare gli altri
+# moduli, che calcolano parte dei risultati già all'importazione
+istantanea.USA = False
+
+import voti_tidy as vt
+import mappe
+import modelli as mod
+import gemelli
+import densita
+import correlazioni
+import fattoriale
+import componenti
+import spazio
+
+### Calcolo di tutti i risultati mostrati dall'app, una volta sola e senza Streamlit, salvati in una nuova istantanea
+### (vedi istantanea.py). Uso: python precalcolo.py [--tutto]
+### Con --tutto si calcolano anche i risultati che l'app mostra solo su richiesta (test delle correlazioni e
+### intervalli bootstrap), che richiedono diversi minuti
+
+# modelli lineari semplici mostrati nell'app: (esplicativa, logaritmo)
+modelli_ols = [("ELETTORI", True), ("M_PERC", False), ("AFFLUENZA", False)]
+# vicini usati per l'autocorrelazione spaziale nell'app: (k, raggio_km)
+vicini_moran = [(8, 0), (0, 15)]
+# istantanee precedenti da conservare, oltre a quella nuova
+CONSERVA = 2
+
+
+# salva un artefatto nella cartella in base al tipo: tabelle come parquet, dizionari di array come npz, il resto
+# come json. Restituisce il nome del file
+def _scrivi(cartella, nome, oggetto):
+    if isinstance(oggetto, pl.DataFrame):
+        file = f"{nome}.parquet"
+        oggetto.write_parquet(os.path.join(cartella, file))
+    elif isinstance(oggetto, dict) and oggetto and all(isinstance(v, np.ndarray) for v in oggetto.values()):
+        file = f"{nome}.npz"
+        np.savez(os.path.join(cartella, file), **oggetto)
+    else:
+        file = f"{nome}.json"
+        with open(os.path.join(cartella, file), "w") as f:
+            json.dump(oggetto, f, ensure_ascii=False)
+    return file
+
+
+# converte i risultati di fit_fattori (array e numeri numpy) in oggetti salvabili come json
+def _json_fattori(risultati):
+    return {
+        m: {chiave: v.tolist() if isinstance(v, np.ndarray) else float(v) for chiave, v in risultato.items()}
+        for m, risultato in risultati.items()
+    }
+
+
+# calcola tutti i risultati e li salva nella cartella. Restituisce, per ogni artefatto, il file e i secondi impiegati
+def calcola(cartella, tutto=False):
+    artefatti, secondi = {}, {}
+    inizio = time.perf_counter()
+
+    def salva(nome, oggetto):
+        nonlocal inizio
+        artefatti[nome] = _scrivi(cartella, nome, oggetto)
+        secondi[nome] = round(time.perf_counter() - inizio, 3)
+        print(f"{nome}: {secondi[nome]:.2f} s")
+        inizio = time.perf_counter()
+
+    ripartizioni = ["ITALIA"] + sorted(vt.votiPerc.get_column("REGIONE").unique().to_list())
+
+    # dati e aggregazioni
+    salva("anteprima_raw", vt.get_raw_data().head(100))
+    salva("voti_abs", vt.votiAbs)
+    salva("voti_perc", vt.votiPerc)
+    tabelle, _, figli = vt.voti_cube()
+    for livello, tabella in tabelle.items():
+        salva(f"cubo_{livello}", tabella)
+    salva("cubo_figli", [[livello, nome, sotto] for (livello, nome), sotto in figli.items()])
+    salva("voti_coord", mappe.votiCoord)
+    salva("gemelli_euclidea_5", gemelli.calcola_tabella_gemelli(5, "euclidea"))
+
+    # modelli
+    salva("ols", {
+        f"{var}|{log}": {
+            partito: {c: float(v) for c, v in modello.items()} for partito, modello in mod.fit_ols(var, log).items()
+        }
+        for var, log in modelli_ols
+    })
+    salva("coeff_quantreg", mod.calcola_coeff_quantreg())
+    salva("modello_completo", {partito: mod.riepilogo_compl_model(partito) for partito in vt.partitiPlot})
+
+    # analisi multivariate e dati dei grafici
+    salva("pca_statistiche", {
+        f"{reg}|{campo}": np.asarray(valore)
+        for reg in ripartizioni
+        for campo, valore in componenti.statistiche(componenti._matrice(reg)).items()
+    })
+    salva("densita", pl.concat([
+        df.select(pl.lit(reg).alias("REGIONE"), pl.all()) for reg, df in densita.get_densita().items()
+    ]))
+    coppie = {reg: correlazioni.dati_coppie(reg) for reg in ripartizioni}
+    salva("coppie_corr_20", {reg: corr for reg, (corr, _, _) in coppie.items()})
+    for i, nome in [(1, "celle"), (2, "marginali")]:
+        salva(f"coppie_{nome}_20", pl.concat([
+            dati[i].select(pl.lit(reg).alias("REGIONE"), pl.all()) for reg, dati in coppie.items()
+        ]))
+    salva("fattoriale_4", {reg: _json_fattori(fattoriale.analisi_fattoriale(reg)) for reg in ripartizioni})
+
+    # autocorrelazione spaziale
+    globali, locali = {}, []
+    for partito in vt.partiti_ext:
+        for k, raggio_km in vicini_moran:
+            chiave = spazio.chiave_moran(partito, k, raggio_km)
+            globale, locale = spazio.autocorrelazione(partito, k, raggio_km)
+            globali[chiave] = {c: float(v) for c, v in globale.items()}
+            locali.append(locale.rename({partito: "VALORE"}).select(pl.lit(chiave).alias("CHIAVE"), pl.all()))
+    salva("moran_globale_999", globali)
+    salva("moran_locale_999", pl.concat(locali))
+
+    if tutto:
+        salva("test_correlazioni_999_999_0.95_0", pl.concat([
+            correlazioni.test_correlazioni(reg, n_jobs=None).select(pl.lit(reg).alias("REGIONE"), pl.all())
+            for reg in ripartizioni
+        ]))
+        salva("bootstrap_200", {reg: mod.get_bootstrap(reg, 200, tempo_max=None) for reg in ripartizioni})
+
+    return artefatti, secondi
+
+
+# calcola una nuova istantanea in una cartella temporanea, la rinomina e la rende quella corrente aggiornando il
+# file CORRENTE (in modo atomico, così che l'app legga sempre un'istantanea completa). Le istantanee più vecchie
+# oltre le ultime CONSERVA vengono cancellate. Restituisce il percorso della nuova istantanea
+def crea(tutto=False, base=istantanea.CARTELLA):
+    os.makedirs(base, exist_ok=True)
+    stat = os.stat(vt.RAW_FILE)
+    sorgente = {
+        "file": vt.RAW_FILE,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": vt._file_hash(vt.RAW_FILE)
+    }
+    creata = datetime.now()
+    temporanea = os.path.join(base, f".in_corso_{os.getpid()}")
+    os.makedirs(temporanea)
+    try:
+        artefatti, secondi = calcola(temporanea, tutto)
+        with open(os.path.join(temporanea, istantanea.MANIFESTO), "w") as f:
+            json.dump({
+                "versione": istantanea.VERSIONE,
+                "creata": creata.isoformat(timespec="seconds"),
+                "polars": pl.__version__,
+                "sorgente": sorgente,
+                "impronta": istantanea.impronta(),
+                "artefatti": artefatti,
+                "secondi": secondi
+            }, f, indent=2, ensure_ascii=False)
+    except BaseException:
+        shutil.rmtree(temporanea, ignore_errors=True)
+        raise
+
+    nome = f"v{istantanea.VERSIONE}-{sorgente['sha256'][:12]}-{creata:%Y%m%dT%H%M%S}"
+    os.replace(temporanea, os.path.join(base, nome))
+    with open(os.path.join(base, istantanea.CORRENTE + ".tmp"), "w") as f:
+        f.write(nome)
+    os.replace(os.path.join(base, istantanea.CORRENTE + ".tmp"), os.path.join(base, istantanea.CORRENTE))
+
+    precedenti = sorted(
+        (d for d in os.listdir(base) if d.startswith("v") and d != nome),
+        key=lambda d: os.path.getmtime(os.path.join(base, d))
+    )
+    for vecchia in precedenti[:max(0, len(precedenti) - CONSERVA)]:
+        shutil.rmtree(os.path.join(base, vecchia), ignore_errors=True)
+    return os.path.join(base, nome)
+
+
+if __name__ == "__main__":
+    inizio = time.perf_counter()
+    percorso = crea(tutto="--tutto" in sys.argv)
+    print(f"Istantanea {percorso} creata in {time.perf_counter() - inizio:.1f} s")
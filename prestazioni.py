@@ -0,0 +1,308 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import numpy as np
+import polars as pl
+import istantanea
+
+# si misurano i calcoli, non la lettura dell'istantanea: va disattivata prima di importare gli altri moduli
+istantanea.USA = False
+
+import voti_tidy as vt
+import mappe
+import modelli as mod
+import gemelli
+
+### Benchmark dei percorsi critici dell'app, eseguibili senza Streamlit su file sintetici in formato Eligendo.
+### Uso: python prestazioni.py [--scale 1 10 100] [--ripetizioni 5] [--casi ...] [--confronta risultati.json]
+
+# I file sintetici vengono generati (una volta sola) a partire dal file dei risultati, replicandone i comuni: a scala
+# k ogni comune compare k volte, la prima identica all'originale e le altre con un nome diverso e voti perturbati.
+# Ogni caso viene misurato in un processo nuovo, eseguito nella cartella del file sintetico (così che l'app lo legga
+# al posto di quello vero): la preparazione (e.g. la tabella dei gemelli per find_closer) non viene misurata, poi
+# ogni ripetizione svuota le cache coinvolte ed esegue la chiamata. Per ogni caso vengono salvati i tempi delle
+# ripetizioni e il picco della memoria residente durante le ripetizioni, in un file JSON che può essere confrontato
+# con quello di un'esecuzione precedente per trovare le regressioni
+
+CARTELLA = "prestazioni"
+# scale predefinite, in multipli del numero di comuni del file dei risultati
+SCALE = [1, 10, 100]
+# numero massimo di comuni per i casi la cui preparazione è quadratica nel numero di comuni (la tabella dei gemelli
+# confronta ogni comune con tutti gli altri): oltre il limite il caso viene saltato
+limiti = {"find_closer": 100_000}
+
+
+### Generazione dei file sintetici
+
+# colonne del file di Eligendo (prima di vt._rinomina) usate dal generatore
+_col_provincia = "DESCPROVINCIA"
+_col_comune = "DESCCOMUNE"
+_col_voti = "NUMVOTI"
+
+
+# scrive in file la versione a scala fattore del file sorgente. Le copie di ogni comune oltre la prima hanno il nome
+# seguito dal numero della copia, elettori e votanti moltiplicati per un fattore casuale tra 0.5 e 1.5 (lo stesso
+# per tutte le righe del comune) e i voti di ogni lista moltiplicati anche per un fattore casuale tra 0.8 e 1: così
+# i voti restano al più pari ai votanti e le percentuali cambiano da una copia all'altra. Le copie sono scritte una
+# alla volta, senza tenere in memoria l'intero file generato
+def genera(file, fattore: int, sorgente: str = vt.RAW_FILE, seme: int = 0):
+    voti = pl.read_csv(sorgente, separator=";", infer_schema_length=None)
+    attributi = [c for c in vt._attributi if c in voti.columns]
+    comuni = voti.select([_col_provincia, _col_comune]).unique(maintain_order=True)
+    rng = np.random.default_rng(seme)
+
+    with open(file, "wb") as f:
+        voti.write_csv(f, separator=";")
+        for copia in range(2, fattore + 1):
+            fattori = comuni.with_columns(pl.Series("FATTORE", rng.uniform(0.5, 1.5, comuni.height)))
+            (
+                voti
+                .join(fattori, on=[_col_provincia, _col_comune], how="left")
+                .with_columns(
+                    pl.col(_col_comune) + pl.lit(f" {copia}"),
+                    *[(pl.col(c) * pl.col("FATTORE")).floor().cast(pl.Int64) for c in attributi],
+                    (pl.col(_col_voti) * pl.col("FATTORE") * pl.Series(rng.uniform(0.8, 1, voti.height)))
+                    .floor().cast(pl.Int64)
+                )
+                .drop("FATTORE")
+                .write_csv(f, separator=";", include_header=False)
+            )
+    return comuni.height * fattore
+
+
+# cartella con il file sintetico a scala fattore, generandolo se manca o se è più vecchio del file sorgente. Nella
+# cartella viene anche collegato il file delle coordinate, necessario a get_coord. Restituisce la cartella e il
+# numero di comuni del file
+def prepara_dati(fattore: int, cartella: str = CARTELLA):
+    dati = os.path.abspath(os.path.join(cartella, f"scala_{fattore}"))
+    file = os.path.join(dati, vt.RAW_FILE)
+    info = os.path.join(dati, "comuni.json")
+    os.makedirs(dati, exist_ok=True)
+    if not os.path.exists(info) or os.path.getmtime(info) < os.path.getmtime(vt.RAW_FILE):
+        inizio = time.perf_counter()
+        comuni = genera(file, fattore)
+        with open(info, "w") as f:
+            json.dump({"comuni": comuni}, f)
+        print(f"generato {file} ({comuni} comuni) in {time.perf_counter() - inizio:.1f} s")
+    coord = os.path.join(dati, "cities_coord.csv")
+    if not os.path.exists(coord):
+        os.symlink(os.path.abspath("cities_coord.csv"), coord)
+    with open(info) as f:
+        return dati, json.load(f)["comuni"]
+
+
+### Casi misurati
+
+# Ogni caso prepara ciò che serve (senza misurarlo) e restituisce la coppia (azzera, esegui): azzera viene chiamata
+# prima di ogni ripetizione, senza misurarla, e svuota le cache da cui dipende la chiamata; esegui è la chiamata
+# misurata. Gli argomenti sono quelli predefiniti dell'app
+
+def _nessuna():
+    pass
+
+
+# lettura e preprocessing del file di Eligendo, con salvataggio della cache colonnare
+def _caso_get_raw_data():
+    def azzera():
+        for file in vt._cache_paths(vt.RAW_FILE):
+            if os.path.exists(file):
+                os.remove(file)
+
+    return azzera, vt.get_raw_data
+
+
+# lettura dalla cache colonnare già presente
+def _caso_get_raw_data_cache():
+    vt.get_raw_data()
+    return _nessuna, vt.get_raw_data
+
+
+# pivot dei dati grezzi, dalla cache colonnare già presente
+def _caso_data_preprocessing():
+    vt.get_raw_data()
+    return vt.data_preprocessing.clear, vt.data_preprocessing
+
+
+# costruzione del cubo delle aggregazioni e richiesta di una provincia
+def _caso_voti_grouped_by():
+    provincia = vt.votiAbs.item(0, "PROVINCIA")
+    return vt.voti_cube.clear, lambda: vt.voti_grouped_by("PROVINCIA", provincia)
+
+
+# gemello di un comune, dalla tabella dei gemelli (calcolata nella preparazione)
+def _caso_find_closer():
+    gemelli.get_tabella_gemelli()
+    comune = vt.votiPerc.item(0, "COMUNE")
+    return _nessuna, lambda: gemelli.find_closer(comune)
+
+
+# modelli lineari semplici e grafico (senza Streamlit in esecuzione, st.altair_chart prepara comunque la specifica
+# Vega-Lite da inviare al browser)
+def _caso_make_model_graph():
+    mod.get_voti_model()
+    return mod.fit_ols.clear, lambda: mod.make_model_graph(
+        "ELETTORI", True, True, "Numero di elettori (scala logaritmica)", "PARTITO DEMOCRATICO"
+    )
+
+
+# previsione del comune medio e grafico, dai coefficienti della regressione quantile (calcolati nella preparazione)
+def _caso_prediction():
+    mod.get_coeff_quantreg()
+    return _nessuna, lambda: mod.prediction("ITALIA", 100000, 50, 50).to_dict()
+
+
+# abbinamento dei comuni alle coordinate
+def _caso_get_coord():
+    dati, voti = mappe.coord_preprocessing(), vt.votiPerc
+    return mappe.get_coord.clear, lambda: mappe.get_coord(dati, voti)
+
+
+casi = {
+    "get_raw_data": _caso_get_raw_data,
+    "get_raw_data (cache)": _caso_get_raw_data_cache,
+    "data_preprocessing": _caso_data_preprocessing,
+    "voti_grouped_by": _caso_voti_grouped_by,
+    "find_closer": _caso_find_closer,
+    "make_model_graph": _caso_make_model_graph,
+    "prediction": _caso_prediction,
+    "get_coord": _caso_get_coord,
+}
+
+
+### Misura
+
+# memoria residente attuale e suo picco (VmHWM), in MB. Su Linux si leggono da /proc; altrove è disponibile solo il
+# picco dall'avvio del processo
+def _memoria():
+    try:
+        with open("/proc/self/status") as f:
+            campi = dict(riga.split(":", 1) for riga in f if ":" in riga)
+        return int(campi["VmRSS"].split()[0]) / 1024, int(campi["VmHWM"].split()[0]) / 1024
+    except OSError:
+        import resource
+        picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        picco /= 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+        return picco, picco
+
+
+# azzera il picco della memoria residente, così che _memoria restituisca solo quello successivo (Linux)
+def _azzera_picco():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# esegue il caso nella cartella indicata e restituisce i tempi delle ripetizioni, la memoria residente dopo la
+# preparazione e il picco durante le ripetizioni. Viene eseguita in un processo nuovo (vedi misura)
+def _misura_caso(cartella, nome, ripetizioni):
+    os.chdir(cartella)
+    azzera, esegui = casi[nome]()
+    base, _ = _memoria()
+    secondi = []
+    _azzera_picco()
+    for _ in range(ripetizioni):
+        azzera()
+        inizio = time.perf_counter()
+        esegui()
+        secondi.append(time.perf_counter() - inizio)
+    _, picco = _memoria()
+    return secondi, base, picco
+
+
+# misura tutti i casi indicati sui file sintetici alle scale indicate. Ogni caso è eseguito in un processo nuovo,
+# così che cache e memoria non dipendano dai casi precedenti. Restituisce una riga per (caso, scala)
+def misura(scale=SCALE, ripetizioni: int = 5, casi_sel=None, cartella: str = CARTELLA):
+    risultati = []
+    for fattore in scale:
+        dati, comuni = prepara_dati(fattore, cartella)
+        for nome in casi_sel or casi:
+            riga = {"caso": nome, "scala": fattore, "comuni": comuni}
+            if comuni > limiti.get(nome, comuni):
+                riga["stato"] = f"saltato: oltre {limiti[nome]} comuni"
+            else:
+                contesto = multiprocessing.get_context("spawn")
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=contesto) as pool:
+                        secondi, base, picco = pool.submit(_misura_caso, dati, nome, ripetizioni).result()
+                    riga.update({
+                        "stato": "ok",
+                        "secondi": [round(s, 6) for s in secondi],
+                        "mediana_s": round(float(np.median(secondi)), 6),
+                        "min_s": round(min(secondi), 6),
+                        "base_mb": round(base, 1),
+                        "picco_mb": round(picco, 1),
+                        "incremento_mb": round(max(picco - base, 0), 1)
+                    })
+                except BrokenProcessPool:
+                    riga["stato"] = "errore: processo terminato (e.g. memoria esaurita)"
+                except Exception as e:
+                    riga["stato"] = f"errore: {e!r}"
+            risultati.append(riga)
+            print(f"{nome:<22} x{fattore:<4} " + (
+                f"{riga['mediana_s']:10.4f} s {riga['picco_mb']:9.1f} MB" if riga["stato"] == "ok" else riga["stato"]
+            ))
+    return risultati
+
+
+# confronta i risultati con quelli di un'esecuzione precedente: c'è una regressione se un caso riuscito prima ora
+# non riesce (errore o processo terminato), oppure se la mediana dei tempi o il picco di memoria superano quelli
+# precedenti di oltre la tolleranza (relativa), ignorando le differenze sotto min_s secondi e min_mb MB, dovute al
+# rumore della misura. Restituisce l'elenco delle regressioni
+def confronta(risultati, precedenti, tolleranza: float = 0.2, min_s: float = 0.01, min_mb: float = 20):
+    prima = {(r["caso"], r["scala"]): r for r in precedenti if r["stato"] == "ok"}
+    regressioni = []
+    for r in risultati:
+        p = prima.get((r["caso"], r["scala"]))
+        if p is None:
+            continue
+        if r["stato"] != "ok":
+            regressioni.append(f"{r['caso']} x{r['scala']}: ok -> {r['stato']}")
+            continue
+        for campo, minimo in (("mediana_s", min_s), ("picco_mb", min_mb)):
+            if r[campo] > p[campo] * (1 + tolleranza) and r[campo] - p[campo] > minimo:
+                regressioni.append(f"{r['caso']} x{r['scala']}: {campo} {p[campo]} -> {r[campo]}")
+    return regressioni
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi critici dell'app su file sintetici")
+    parser.add_argument("--scale", type=int, nargs="+", default=SCALE)
+    parser.add_argument("--ripetizioni", type=int, default=5)
+    parser.add_argument("--casi", nargs="+", choices=list(casi), default=None)
+    parser.add_argument("--output", default=None, help="file JSON dei risultati (predefinito: nella cartella "
+                                                       f"{CARTELLA}, con data e ora)")
+    parser.add_argument("--confronta", default=None, help="file JSON di un'esecuzione precedente")
+    parser.add_argument("--tolleranza", type=float, default=0.2)
+    args = parser.parse_args()
+
+    creato = datetime.now()
+    risultati = misura(args.scale, args.ripetizioni, args.casi)
+    output = args.output or os.path.join(CARTELLA, f"risultati_{creato:%Y%m%dT%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump({
+            "creato": creato.isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "numpy": np.__version__,
+            "sistema": platform.platform(),
+            "cpu": os.cpu_count(),
+            "ripetizioni": args.ripetizioni,
+            "risultati": risultati
+        }, f, indent=2, ensure_ascii=False)
+    print(f"risultati salvati in {output}")
+
+    if args.confronta:
+        with open(args.confronta) as f:
+            regressioni = confronta(risultati, json.load(f)["risultati"], args.tolleranza)
+        for regressione in regressioni:
+            print("REGRESSIONE:", regressione)
+        sys.exit(1 if regressioni else 0)
@@ -0,0 +1,212 @@
+import os
+import multiprocessing
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import polars as pl
+
+### Motore per adattare in parallelo le regressioni quantili di tutti i partiti in tutte le regioni
+
+# dati condivisi da ogni processo del pool: vengono passati una sola volta, all'avvio del processo,
+# invece di essere serializzati con ogni singolo adattamento
+_X = None
+_Y = None
+_gruppi = None
+
+
+def _init_worker(X, Y, gruppi):
+    global _X, _Y, _gruppi
+    _X, _Y, _gruppi = X, Y, gruppi
+
+
+# regressione quantile tramite minimi quadrati pesati iterati, con lo stesso algoritmo di sm.QuantReg.fit.
+# Se beta_start è indicato, i pesi della prima iterazione sono calcolati dai suoi residui invece di partire
+# dalla soluzione OLS (warm start), il che riduce il numero di iterazioni se beta_start è vicino alla soluzione.
+# Restituisce i coefficienti e il numero di iterazioni
+def quantreg_irls(y, X, q=0.5, beta_start=None, max_iter=1000, p_tol=1e-6):
+    def pesi(beta):
+        resid = y - X @ beta
+        mask = np.abs(resid) < 0.000001
+        resid[mask] = ((resid[mask] >= 0) * 2 - 1) * 0.000001
+        resid = np.abs(np.where(resid < 0, q * resid, (1 - q) * resid))
+        return X / resid[:, None]
+
+    if beta_start is None:
+        beta, xstar = np.ones(X.shape[1]), X
+    else:
+        beta, xstar = np.asarray(beta_start, dtype=np.float64), pesi(beta_start)
+
+    n_iter = 0
+    diff = 10
+    while n_iter < max_iter and diff > p_tol:
+        n_iter += 1
+        beta0 = beta
+        beta = np.linalg.pinv(xstar.T @ X) @ (xstar.T @ y)
+        xstar = pesi(beta)
+        diff = np.max(np.abs(beta - beta0))
+
+    if n_iter == max_iter:
+        warnings.warn(f"Raggiunto il numero massimo di iterazioni ({max_iter})")
+    return beta, n_iter
+
+
+# adatta un singolo modello (gruppo di comuni, colonna del partito) nel processo del pool e ne misura il tempo
+def _fit(gruppo, j, beta_start):
+    inizio = time.perf_counter()
+    righe = _gruppi[gruppo]
+    beta, n_iter = quantreg_irls(_Y[righe, j], _X[righe], beta_start=beta_start)
+    return gruppo, j, beta, n_iter, time.perf_counter() - inizio
+
+
+# adatta le regressioni quantili di ogni partito su tutti i comuni (gruppo "ITALIA") e su ogni gruppo di comuni
+# indicato in gruppi (dizionario nome -> indici di riga), distribuendo i modelli su n_jobs processi. Con n_jobs=1 i
+# modelli sono adattati uno dopo l'altro nel processo corrente, senza creare il pool: è il caso dell'app, da cui non
+# si possono avviare processi con spawn (Streamlit imposta app.py come __main__, che ogni processo rieseguirebbe)
+# - X: matrice delle esplicative, costante inclusa
+# - Y: matrice delle risposte, una colonna per partito
+# - warm_start: se True le stime nazionali sono usate come punto di partenza per quelle dei singoli gruppi.
+#   La funzione obiettivo della regressione mediana è piatta vicino all'ottimo, dunque in questo caso i coefficienti
+#   possono differire leggermente da quelli di sm.QuantReg pur avendo lo stesso valore dell'obiettivo; con False
+#   si ottengono esattamente i coefficienti di sm.QuantReg
+# Restituisce la tabella dei coefficienti (una riga per gruppo e partito) e quella dei tempi di ogni adattamento
+def fit_quantreg(X, Y, partiti, gruppi, nomi_coeff, n_jobs=None, warm_start=True):
+    gruppi = {"ITALIA": np.arange(X.shape[0]), **gruppi}
+    risultati = []
+    if n_jobs == 1:
+        _init_worker(X, Y, gruppi)
+        nazionali = [_fit("ITALIA", j, None) for j in range(len(partiti))]
+        risultati += nazionali + [
+            _fit(gruppo, j, nazionali[j][2] if warm_start else None)
+            for gruppo in gruppi if gruppo != "ITALIA"
+            for j in range(len(partiti))
+        ]
+        return _tabelle(risultati, partiti, nomi_coeff)
+
+    # usiamo spawn e non fork, che non è sicuro con i thread di polars
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(X, Y, gruppi)) as pool:
+        nazionali = list(pool.map(_fit, ["ITALIA"] * len(partiti), range(len(partiti)), [None] * len(partiti)))
+        risultati += nazionali
+
+        futuri = [
+            pool.submit(_fit, gruppo, j, nazionali[j][2] if warm_start else None)
+            for gruppo in gruppi if gruppo != "ITALIA"
+            for j in range(len(partiti))
+        ]
+        risultati += [f.result() for f in futuri]
+    return _tabelle(risultati, partiti, nomi_coeff)
+
+
+# tabella dei coefficienti e tabella dei tempi a partire dai risultati dei singoli adattamenti
+def _tabelle(risultati, partiti, nomi_coeff):
+    coeff = pl.DataFrame(
+        [[gruppo, partiti[j]] + beta.tolist() for gruppo, j, beta, _, _ in risultati],
+        schema=["REGIONE", "PARTITO"] + nomi_coeff,
+        orient="row"
+    )
+    tempi = pl.DataFrame(
+        [[gruppo, partiti[j], n_iter, secondi] for gruppo, j, _, n_iter, secondi in risultati],
+        schema=["REGIONE", "PARTITO", "ITERAZIONI", "SECONDI"],
+        orient="row"
+    )
+    return coeff, tempi
+
+
+### Bootstrap delle regressioni quantili
+
+# regressione quantile pesata per molti campioni bootstrap e molti partiti contemporaneamente, con lo stesso
+# algoritmo di quantreg_irls. Ogni campione bootstrap è rappresentato dal numero di volte in cui ogni comune è
+# stato estratto (riga di W), il che equivale a ricampionare le righe senza copiare X. Ad ogni iterazione si
+# aggiornano solo i modelli non ancora arrivati a convergenza.
+# - Y: matrice delle risposte (n comuni x P partiti)
+# - X: matrice delle esplicative (n x k), costante inclusa
+# - W: pesi dei campioni bootstrap (B x n)
+# - beta_start: coefficienti iniziali (P x k), ad esempio le stime sul campione completo, da cui i campioni
+#   bootstrap differiscono di poco; se None si parte dalla soluzione OLS come in quantreg_irls
+# Restituisce i coefficienti come array B x P x k
+def quantreg_irls_pesi(Y, X, W, q=0.5, beta_start=None, max_iter=1000, p_tol=1e-6):
+    B, n = W.shape
+    P, k = Y.shape[1], X.shape[1]
+    # ogni modello f corrisponde al campione f // P e al partito f % P
+    Yf = np.tile(Y.T, (B, 1))
+    Wf = np.repeat(W, P, axis=0)
+
+    def pesi(beta, attivi):
+        resid = Yf[attivi] - beta @ X.T
+        resid = np.where(np.abs(resid) < 0.000001, np.where(resid >= 0, 0.000001, -0.000001), resid)
+        return Wf[attivi] / np.abs(np.where(resid < 0, q * resid, (1 - q) * resid))
+
+    tutti = np.arange(B * P)
+    if beta_start is None:
+        beta = np.ones((B * P, k))
+        w = Wf.copy()
+    else:
+        beta = np.tile(np.asarray(beta_start, dtype=np.float64), (B, 1))
+        w = pesi(beta, tutti)
+
+    attivi = tutti
+    n_iter = 0
+    while n_iter < max_iter and attivi.size > 0:
+        n_iter += 1
+        wa = w[attivi]
+        xtx = np.einsum("fi,ik,il->fkl", wa, X, X, optimize=True)
+        xty = (wa * Yf[attivi]) @ X
+        beta_nuovo = (np.linalg.pinv(xtx) @ xty[..., None])[..., 0]
+        diff = np.max(np.abs(beta_nuovo - beta[attivi]), axis=1)
+        beta[attivi] = beta_nuovo
+        w[attivi] = pesi(beta_nuovo, attivi)
+        attivi = attivi[diff > p_tol]
+
+    return beta.reshape(B, P, k)
+
+
+# adatta un blocco di campioni bootstrap, generati dal seme indicato, sui dati condivisi del processo
+def _bootstrap_blocco(seme, n_campioni, beta_start, max_iter):
+    rng = np.random.default_rng(seme)
+    n = _X.shape[0]
+    W = rng.multinomial(n, np.full(n, 1 / n), size=n_campioni).astype(np.float64)
+    return quantreg_irls_pesi(_Y, _X, W, beta_start=beta_start, max_iter=max_iter)
+
+
+# stima tramite bootstrap non parametrico la distribuzione dei coefficienti delle regressioni quantili di tutti
+# i partiti (colonne di Y). Ogni campione parte dalle stime sul campione completo (beta_start, P x k) e i campioni
+# sono adattati in blocchi vettorizzati di dimensione blocco, distribuiti su n_jobs processi. Ogni blocco ha un seme
+# proprio derivato da seme, dunque i primi m campioni sono sempre gli stessi; con salta (multiplo di blocco) si
+# saltano i campioni già calcolati da una chiamata precedente e si prosegue da lì. Se tempo_max (in secondi) è
+# indicato, allo scadere del tempo i processi vengono terminati e i blocchi non ancora completati scartati: vengono
+# restituiti solo i campioni dei blocchi consecutivi completati, che possono anche essere nessuno.
+# Restituisce i coefficienti come array (campioni x partiti x coefficienti)
+def bootstrap_quantreg(X, Y, beta_start, n_boot=200, seme=0, tempo_max=None, n_jobs=None, blocco=10, max_iter=200,
+                       salta=0):
+    semi = np.random.SeedSequence(seme).spawn((n_boot + blocco - 1) // blocco)
+    dimensioni = [min(blocco, n_boot - i * blocco) for i in range(len(semi))]
+    semi, dimensioni = semi[salta // blocco:], dimensioni[salta // blocco:]
+    inizio = time.perf_counter()
+    n_jobs = n_jobs or os.cpu_count()
+    risultati = [np.empty((0, Y.shape[1], X.shape[1]))]
+
+    # con un solo processo evitiamo il costo di avvio del pool
+    if n_jobs == 1:
+        _init_worker(X, Y, None)
+        for seme_blocco, dim in zip(semi, dimensioni):
+            if tempo_max is not None and time.perf_counter() - inizio > tempo_max:
+                break
+            risultati.append(_bootstrap_blocco(seme_blocco, dim, beta_start, max_iter))
+        return np.concatenate(risultati)
+
+    # usiamo un Pool di multiprocessing, e non ProcessPoolExecutor, per poter terminare i processi ancora al lavoro
+    # allo scadere del tempo massimo
+    with multiprocessing.get_context("spawn").Pool(n_jobs, initializer=_init_worker, initargs=(X, Y, None)) as pool:
+        futuri = [
+            pool.apply_async(_bootstrap_blocco, (seme_blocco, dim, beta_start, max_iter))
+            for seme_blocco, dim in zip(semi, dimensioni)
+        ]
+        for futuro in futuri:
+            resto = None if tempo_max is None else max(0.0, tempo_max - (time.perf_counter() - inizio))
+            try:
+                risultati.append(futuro.get(timeout=resto))
+            except multiprocessing.TimeoutError:
+                break
+    # all'uscita dal blocco with il pool viene terminato, insieme ai blocchi ancora in corso
+    return np.concatenate(risultati)
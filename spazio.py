@@ -0,0 +1,232 @@
+import numpy as np
+import polars as pl
+import streamlit as st
+import mappe
+import istantanea
+import avvio
+
+# librerie pesanti, importate al primo utilizzo (vedi avvio.importa)
+sparse = avvio.importa("scipy.sparse")
+spatial = avvio.importa("scipy.spatial")
+
+### Indice spaziale sulle coordinate dei comuni e autocorrelazione spaziale (I di Moran globale e locale)
+
+# I comuni sono rappresentati come punti sulla sfera (coordinate cartesiane in km): la distanza euclidea tra due punti
+# (corda) è una funzione crescente della distanza lungo la superficie, dunque le ricerche per raggio e per vicinanza
+# sul KD-tree sono esatte senza bisogno di una proiezione cartografica
+RAGGIO_TERRA = 6371.0
+
+
+# coordinate cartesiane (km) dei punti di latitudine e longitudine indicate (in gradi)
+def cartesiane(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return RAGGIO_TERRA * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+# conversione tra distanza lungo la superficie terrestre e corda, in km
+def _corda(km):
+    return 2 * RAGGIO_TERRA * np.sin(np.asarray(km) / (2 * RAGGIO_TERRA))
+
+
+def _superficie(corda):
+    return 2 * RAGGIO_TERRA * np.arcsin(np.minimum(np.asarray(corda) / (2 * RAGGIO_TERRA), 1))
+
+
+# costruisce una volta sola il KD-tree sui comuni di mappe.votiCoord. Restituisce l'albero, i punti e i comuni
+# (nell'ordine dei punti)
+@st.cache_resource
+def get_indice():
+    comuni = mappe.votiCoord
+    punti = cartesiane(comuni.get_column("latitude").to_numpy(), comuni.get_column("longitude").to_numpy())
+    return spatial.cKDTree(punti), punti, comuni
+
+
+# indici (nell'ordine dell'indice) e distanze dei comuni entro raggio_km dal punto centro (coordinate cartesiane),
+# ordinati dal più vicino
+def _entro_raggio(centro, raggio_km):
+    albero, punti, _ = get_indice()
+    righe = np.array(albero.query_ball_point(centro, _corda(raggio_km)), dtype=np.int64)
+    distanze = _superficie(np.linalg.norm(punti[righe] - centro, axis=1))
+    ordine = np.argsort(distanze, kind="stable")
+    return righe[ordine], distanze[ordine]
+
+
+# restituisce i comuni entro raggio_km dal punto (lat, lon), con la distanza, ordinati dal più vicino
+def entro_raggio(lat, lon, raggio_km):
+    righe, distanze = _entro_raggio(cartesiane([lat], [lon])[0], raggio_km)
+    return get_indice()[2][righe].with_columns(pl.Series("DISTANZA_KM", distanze))
+
+
+# restituisce i k comuni più vicini al punto (lat, lon), con la distanza, ordinati dal più vicino
+def piu_vicini(lat, lon, k=10):
+    albero, _, comuni = get_indice()
+    distanze, righe = albero.query(cartesiane([lat], [lon])[0], k=k)
+    return comuni[np.atleast_1d(righe)].with_columns(pl.Series("DISTANZA_KM", _superficie(np.atleast_1d(distanze))))
+
+
+# restituisce i comuni entro raggio_km dal comune indicato (escluso il comune stesso, in base alla sua posizione
+# nell'indice: altri comuni con le stesse coordinate potrebbero precederlo nell'ordine per distanza). Un comune
+# assente dall'indice (e.g. senza coordinate) dà un ValueError
+def vicini_comune(comune, provincia, raggio_km=20):
+    _, punti, comuni = get_indice()
+    righe = np.flatnonzero(((comuni.get_column("COMUNE") == comune) & (comuni.get_column("PROVINCIA") == provincia))
+                           .to_numpy())
+    if len(righe) == 0:
+        raise ValueError(f"comune {comune} ({provincia}) non presente tra i comuni con coordinate")
+    riga = righe[0]
+    righe, distanze = _entro_raggio(punti[riga], raggio_km)
+    altri = righe != riga
+    return comuni[righe[altri]].with_columns(pl.Series("DISTANZA_KM", distanze[altri]))
+
+
+# matrice sparsa dei pesi spaziali, standardizzata per riga (ogni riga somma a 1, o a 0 per i comuni senza vicini):
+# - k > 0: i k comuni più vicini
+# - altrimenti: tutti i comuni entro raggio_km
+# Le coppie vengono ottenute dal KD-tree, senza calcolare la matrice n x n delle distanze
+@st.cache_resource
+def pesi_spaziali(k: int = 8, raggio_km: float = 0):
+    albero, punti, _ = get_indice()
+    n = len(punti)
+    if k > 0:
+        # il comune stesso non è sempre il primo dei k + 1 più vicini: con altri comuni nello stesso punto può
+        # comparire più avanti, o non comparire affatto. Lo togliamo dove compare, altrimenti togliamo il più lontano
+        _, vicini = albero.query(punti, k=k + 1)
+        altri = vicini != np.arange(n)[:, None]
+        altri[altri.all(axis=1), -1] = False
+        righe, colonne = np.repeat(np.arange(n), k), vicini[altri]
+    else:
+        coppie = albero.query_pairs(_corda(raggio_km), output_type="ndarray")
+        righe, colonne = np.r_[coppie[:, 0], coppie[:, 1]], np.r_[coppie[:, 1], coppie[:, 0]]
+    W = sparse.csr_matrix((np.ones(len(righe)), (righe, colonne)), shape=(n, n))
+    somme = np.asarray(W.sum(axis=1)).ravel()
+    W = (sparse.diags(np.divide(1, somme, out=np.zeros(n), where=somme > 0)) @ W).tocsr()
+    # scipy ordina gli indici di colonna sul posto alla prima operazione che lo richiede, cambiando l'ordine delle
+    # somme nei prodotti successivi: li ordiniamo subito, così che i risultati non dipendano dalle chiamate precedenti
+    W.sort_indices()
+    return W
+
+
+# valori standardizzati del partito e pesi W ristretti ai comuni dell'indice in cui il partito era candidato: negli
+# altri il valore è nullo, non 0 (e.g. la SVP è candidata solo nella circoscrizione nord-orientale), e non deve
+# entrare né nella statistica né tra i vicini. Le righe dei pesi vengono standardizzate di nuovo, dato che alcuni
+# comuni perdono dei vicini. Restituisce anche la maschera dei comuni considerati
+def _standardizza(partito, W):
+    x = get_indice()[2].get_column(partito).cast(pl.Float64).to_numpy()
+    presenti = ~np.isnan(x)
+    x = x[presenti]
+    if not presenti.all():
+        W = W[presenti][:, presenti]
+        somme = np.asarray(W.sum(axis=1)).ravel()
+        W = (sparse.diags(np.divide(1, somme, out=np.zeros(len(x)), where=somme > 0)) @ W).tocsr()
+        W.sort_indices()
+    return (x - x.mean()) / x.std(), W, presenti
+
+
+# I di Moran globale del partito con i pesi W (sui soli comuni in cui era candidato), con p-value di un test di
+# permutazione (bilaterale) con n_perm permutazioni. Le permutazioni sono valutate a blocchi con un prodotto tra la
+# matrice sparsa dei pesi e la matrice delle permutazioni. Restituisce I, il valore atteso sotto l'ipotesi nulla, lo
+# z-score rispetto alle permutazioni e il p-value
+def moran_globale(partito, W, n_perm=999, seme=0, blocco=100):
+    z, W, _ = _standardizza(partito, W)
+    n = len(z)
+    s0 = W.sum()
+    I = n / s0 * (z @ (W @ z)) / (z @ z)
+
+    rng = np.random.default_rng(seme)
+    perm = []
+    for inizio in range(0, n_perm, blocco):
+        Z = np.column_stack([rng.permutation(z) for _ in range(min(blocco, n_perm - inizio))])
+        perm.append(n / s0 * np.einsum("ip,ip->p", Z, W @ Z) / (z @ z))
+    perm = np.concatenate(perm)
+
+    atteso = -1 / (n - 1)
+    pvalue = (1 + np.sum(np.abs(perm - atteso) >= abs(I - atteso))) / (1 + n_perm)
+    return {"I": I, "atteso": atteso, "z": (I - perm.mean()) / perm.std(), "pvalue": pvalue}
+
+
+# I di Moran locale (LISA) del partito con i pesi W, per ogni comune in cui era candidato, con p-value di un test di
+# permutazione condizionata: il valore del comune resta fisso e i vicini vengono estratti a caso tra gli altri comuni.
+# Per semplicità i vicini casuali sono estratti con reinserimento, il che con migliaia di comuni è trascurabile.
+# Restituisce i comuni con I locale, p-value e tipo di cluster (alto-alto, basso-basso, alto-basso, basso-alto,
+# o non significativo al livello alfa)
+def moran_locale(partito, W, n_perm=999, alfa=0.05, seme=0, blocco=500, elementi_max=5_000_000):
+    z, W, presenti = _standardizza(partito, W)
+    n = len(z)
+    m2 = z @ z / n
+    ritardo = W @ z
+    I = z * ritardo / m2
+
+    rng = np.random.default_rng(seme)
+    cardinalita = np.diff(W.tocsr().indptr)
+    inverso = np.divide(1, cardinalita, out=np.zeros(n), where=cardinalita > 0)
+
+    # i comuni sono elaborati a blocchi in ordine di numero di vicini, così che in ogni blocco si estraggano solo
+    # tanti vicini casuali quanti ne ha il comune con più vicini del blocco (gli altri sono esclusi con peso nullo)
+    # (il blocco viene ridotto in modo da non estrarre più di elementi_max indici alla volta)
+    estremi = np.zeros(n)
+    ordine = np.argsort(cardinalita, kind="stable")
+    inizio = 0
+    while inizio < n:
+        k = cardinalita[ordine[min(inizio + blocco, n) - 1]]
+        righe = ordine[inizio:inizio + max(1, min(blocco, elementi_max // max(k * n_perm, 1)))]
+        inizio += len(righe)
+        k = cardinalita[righe].max()
+        if k == 0:
+            estremi[righe] = n_perm
+            continue
+        pesi_riga = np.where(np.arange(k)[None, :] < cardinalita[righe, None], inverso[righe, None], 0)
+        # indici casuali tra gli altri n - 1 comuni: quelli da i in su vengono spostati di uno per saltare i
+        casuali = rng.integers(0, n - 1, size=(len(righe), n_perm, k))
+        casuali += casuali >= righe[:, None, None]
+        ritardi = np.einsum("rpk,rk->rp", z[casuali], pesi_riga)
+        Ip = z[righe, None] * ritardi / m2
+        estremi[righe] = np.sum(np.abs(Ip) >= np.abs(I[righe, None]), axis=1)
+    pvalue = (1 + estremi) / (1 + n_perm)
+
+    cluster = np.select(
+        [pvalue >= alfa, (z > 0) & (ritardo > 0), (z < 0) & (ritardo < 0), z > 0],
+        ["non significativo", "alto-alto", "basso-basso", "alto-basso"],
+        "basso-alto"
+    )
+    comuni = get_indice()[2].filter(pl.Series(presenti))
+    return comuni.select(["COMUNE", "PROVINCIA", "REGIONE", "latitude", "longitude", partito]).with_columns(
+        pl.Series("I_LOCALE", I),
+        pl.Series("P_VALUE", pvalue),
+        pl.Series("CLUSTER", cluster)
+    )
+
+
+# colori dei cluster per le mappe
+colori_cluster = {
+    "alto-alto": "#d7191c",
+    "basso-basso": "#2c7bb6",
+    "alto-basso": "#fdae61",
+    "basso-alto": "#abd9e9",
+    "non significativo": "#dddddd",
+}
+
+
+# chiave dei risultati del partito con i pesi indicati nell'istantanea
+def chiave_moran(partito, k, raggio_km):
+    return f"{partito}|{k}|{raggio_km:g}"
+
+
+# risultati salvati nell'istantanea per gli argomenti di autocorrelazione: I globale (già letto) e I locale, in cui la
+# colonna del partito si chiama VALORE
+def _moran_salvato(globale, argomenti):
+    chiave = chiave_moran(argomenti["partito"], argomenti["k"], argomenti["raggio_km"])
+    locale = istantanea.scansiona(f"moran_locale_{argomenti['n_perm']}").filter(pl.col("CHIAVE") == chiave).collect()
+    return globale, locale.drop("CHIAVE").rename({"VALORE": argomenti["partito"]})
+
+
+# I di Moran globale e locale del partito, con i pesi dei k vicini più vicini (o entro raggio_km se k = 0),
+# tenuti in cache per partito e pesi (o letti dall'istantanea)
+@st.cache_data
+@istantanea.salvato("moran_globale_{n_perm}", "json", converti=_moran_salvato,
+                    chiave=lambda argomenti: chiave_moran(argomenti["partito"], argomenti["k"], argomenti["raggio_km"]))
+def autocorrelazione(partito: str, k: int = 8, raggio_km: float = 0, n_perm: int = 999):
+    W = pesi_spaziali(k, raggio_km)
+    locale = moran_locale(partito, W, n_perm).with_columns(
+        pl.col("CLUSTER").replace_strict(colori_cluster).alias("COLORE")
+    )
+    return moran_globale(partito, W, n_perm), locale
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import polars as pl
+import pytest
+import istantanea
+import componenti
+import voti_tidy as vt
+
+# comuni dei dati sintetici: (circoscrizione, regione, provincia, comune). Ci sono comuni omonimi in province
+# diverse, sia della stessa regione che di regioni diverse
+comuni = [
+    ("I : ITALIA NORD-OCCIDENTALE", "PIEMONTE", "TORINO", "TORINO"),
+    ("I : ITALIA NORD-OCCIDENTALE", "PIEMONTE", "TORINO", "SAN GIORGIO"),
+    ("I : ITALIA NORD-OCCIDENTALE", "PIEMONTE", "ALESSANDRIA", "ACQUI TERME"),
+    ("I : ITALIA NORD-OCCIDENTALE", "PIEMONTE", "ALESSANDRIA", "SAN GIORGIO"),
+    ("I : ITALIA NORD-OCCIDENTALE", "LOMBARDIA", "MILANO", "MILANO"),
+    ("I : ITALIA NORD-OCCIDENTALE", "LOMBARDIA", "MILANO", "RHO"),
+    ("II : ITALIA NORD-ORIENTALE", "VENETO", "PADOVA", "PADOVA"),
+    ("II : ITALIA NORD-ORIENTALE", "VENETO", "PADOVA", "SAN GIORGIO"),
+    ("II : ITALIA NORD-ORIENTALE", "VENETO", "VERONA", "VERONA"),
+    ("II : ITALIA NORD-ORIENTALE", "TRENTINO-ALTO ADIGE", "BOLZANO", "BOLZANO"),
+    ("II : ITALIA NORD-ORIENTALE", "TRENTINO-ALTO ADIGE", "BOLZANO", "MERANO"),
+]
+# liste candidate solo nella circoscrizione nord-orientale (nelle altre i voti sono nulli)
+solo_nord_est = ["SÜDTIROLER VOLKSPARTEI (SVP)"]
+
+
+# dati grezzi sintetici nel formato del file di Eligendo, una riga per comune e lista. Un partito ha 0 voti in un
+# comune, per distinguere lo 0 dal partito non candidato
+def dati_grezzi(seme=0):
+    rng = np.random.default_rng(seme)
+    righe = []
+    for i, (circ, reg, prov, comune) in enumerate(comuni):
+        elettori = int(rng.integers(1_000, 100_000))
+        elettori_m = int(elettori * rng.uniform(0.45, 0.52))
+        votanti = int(elettori * rng.uniform(0.4, 0.7))
+        votanti_m = int(votanti * rng.uniform(0.45, 0.52))
+        liste = [p for p in vt.partiti if circ.startswith("II") or p not in solo_nord_est]
+        quote = rng.dirichlet(np.ones(len(liste)))
+        for j, (lista, quota) in enumerate(zip(liste, quote)):
+            voti = 0 if (i, j) == (0, 3) else int(votanti * 0.95 * quota)
+            righe.append(("09/06/2024", circ, reg, prov, comune, elettori, elettori_m, votanti, votanti_m, lista, voti))
+    return pl.DataFrame(righe, orient="row", schema=[
+        "DATA_ELEZIONE", "DESCCIRCEUROPEA", "DESCREGIONE", "DESCPROVINCIA", "DESCCOMUNE", "ELETTORI", "ELETTORI_M",
+        "VOTANTI", "VOTANTI_M", "DESCLISTA", "NUMVOTI"
+    ])
+
+
+# svuota le cache e le variabili globali di voti_tidy (e dei moduli che ne dipendono), così che vengano ricalcolate
+# dal file nella cartella corrente
+def _svuota():
+    for nome in ("votiAbs", "votiPerc"):
+        vt.__dict__.pop(nome, None)
+    vt._cache_blocchi.clear()
+    vt.data_preprocessing.clear()
+    vt.voti_cube.clear()
+    componenti._memoria.clear()
+
+
+# esegue il test in una cartella temporanea con il file dei risultati sintetico al posto di quello vero, senza
+# istantanea e con le cache e le variabili globali di voti_tidy svuotate. Restituisce i dati grezzi
+@pytest.fixture
+def dati_sintetici(tmp_path, monkeypatch):
+    grezzi = dati_grezzi()
+    grezzi.write_csv(tmp_path / vt.RAW_FILE, separator=";")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(istantanea, "USA", False)
+    _svuota()
+    yield grezzi
+    _svuota()
+
+
+# come dati_sintetici, ma con il file dei risultati vero (il test viene saltato se il file non è presente)
+@pytest.fixture
+def dati_reali(monkeypatch):
+    cartella = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(os.path.join(cartella, vt.RAW_FILE)):
+        pytest.skip(f"{vt.RAW_FILE} non presente")
+    monkeypatch.chdir(cartella)
+    monkeypatch.setattr(istantanea, "USA", False)
+    _svuota()
+    yield
+    _svuota()
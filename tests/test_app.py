@@ -0,0 +1,28 @@
+import os
+import pytest
+from streamlit.testing.v1 import AppTest
+import voti_tidy as vt
+
+cartella = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# avvio a freddo dell'app: nella cartella ci sono solo i file dei dati, senza istantanea né tabelle precalcolate
+# (coefficienti della regressione quantile, gemelli, cache dei dati grezzi), che vengono calcolate dall'app stessa
+# senza avviare processi. La pagina deve essere mostrata per intero e senza eccezioni, e gli intervalli bootstrap
+# richiesti dall'utente devono contenere dei campioni
+def test_avvio_a_freddo(tmp_path, monkeypatch):
+    if not os.path.exists(os.path.join(cartella, vt.RAW_FILE)):
+        pytest.skip(f"{vt.RAW_FILE} non presente")
+    for file in (vt.RAW_FILE, "cities_coord.csv"):
+        os.symlink(os.path.join(cartella, file), tmp_path / file)
+    monkeypatch.chdir(tmp_path)
+    app = AppTest.from_file(os.path.join(cartella, "app.py"), default_timeout=600)
+    app.run()
+    assert not app.exception
+    assert os.path.exists(tmp_path / "coeff_quantreg.parquet")
+    assert len(app.markdown) > 0
+
+    app.checkbox(key="mod_boot").check().run()
+    assert not app.exception
+    intervalli = next(df.value for df in app.dataframe if "CAMPIONI" in df.value.columns)
+    assert (intervalli["CAMPIONI"] > 0).all() and intervalli["INF"].notna().all()
@@ -0,0 +1,20 @@
+import sys
+import avvio
+
+
+# il modulo importato con avvio.importa viene eseguito solo al primo accesso a un suo attributo, una sola volta, e
+# il tempo di esecuzione viene registrato; un modulo già importato viene restituito così com'è
+def test_importa_differito(tmp_path, monkeypatch):
+    eseguito = tmp_path / "eseguito.txt"
+    (tmp_path / "modulo_differito.py").write_text(f"open({str(eseguito)!r}, 'a').write('x')\nVALORE = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    try:
+        modulo = avvio.importa("modulo_differito")
+        assert sys.modules["modulo_differito"] is modulo and not eseguito.exists()
+        assert modulo.VALORE == 42 and eseguito.read_text() == "x"
+        assert modulo.VALORE == 42 and eseguito.read_text() == "x"
+        assert "import modulo_differito" in avvio.tempi
+        assert avvio.importa("modulo_differito") is modulo and eseguito.read_text() == "x"
+    finally:
+        sys.modules.pop("modulo_differito", None)
+    assert avvio.importa("json") is sys.modules["json"]
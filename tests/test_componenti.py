@@ -0,0 +1,20 @@
+import numpy as np
+import componenti
+
+
+# aggiornare la PCA con nuove osservazioni dà lo stesso risultato di calcolarla su tutte le osservazioni insieme, e
+# la PCA già restituita prima dell'aggiornamento non cambia
+def test_aggiorna(dati_sintetici):
+    prima = componenti.get_pca(True)
+    componenti_prima = prima["componenti"].copy()
+    X = componenti._matrice("ITALIA")
+    nuovi = np.random.default_rng(0).dirichlet(np.ones(X.shape[1]), size=5) * 100
+
+    componenti.aggiorna(nuovi, "PIEMONTE")
+    dopo = componenti.get_pca(True)
+    attesa = componenti._decomponi(componenti.statistiche(np.vstack([X, nuovi])), True)
+    np.testing.assert_allclose(dopo["varianza"], attesa["varianza"])
+    np.testing.assert_allclose(np.abs(dopo["componenti"]), np.abs(attesa["componenti"]), atol=1e-8)
+    assert dopo is not prima
+    np.testing.assert_array_equal(prima["componenti"], componenti_prima)
+    assert componenti._memoria()[0]["stati"]["PIEMONTE"]["n"] == componenti._matrice("PIEMONTE").shape[0] + 5
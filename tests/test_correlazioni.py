@@ -0,0 +1,75 @@
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+import istantanea
+import correlazioni
+
+
+# colonne sintetiche correlate, più una colonna costante
+def matrice(n=500, seme=0):
+    rng = np.random.default_rng(seme)
+    X = rng.normal(size=(n, 3)) @ np.array([[1.0, 0.5, 0.0], [0.0, 1.0, 0.3], [0.0, 0.0, 1.0]])
+    return np.column_stack([X, np.full(n, 7.0)])
+
+
+def test_matrice_correlazioni():
+    X = matrice()
+    corr = correlazioni.matrice_correlazioni(X)
+    np.testing.assert_allclose(corr[:3, :3], np.corrcoef(X[:, :3], rowvar=False))
+    # la colonna costante ha correlazione 0 con le altre, invece di NaN
+    np.testing.assert_array_equal(corr[3], [0, 0, 0, 1])
+    np.testing.assert_array_equal(corr[:, 3], [0, 0, 0, 1])
+
+
+# anche permutazioni e campioni bootstrap restano finiti con una colonna costante
+def test_blocchi_colonna_costante():
+    X = matrice()
+    correlazioni._init_worker(X)
+    perm = correlazioni._blocco_permutazioni(np.random.SeedSequence(0), 20)
+    boot = correlazioni._blocco_bootstrap(np.random.SeedSequence(1), 20)
+    for corr in (perm, boot):
+        assert np.isfinite(corr).all()
+        np.testing.assert_array_equal(corr[:, 3, :3], 0)
+
+
+# test delle correlazioni su otto partiti sintetici: i primi due fortemente correlati, l'ultimo costante
+@pytest.fixture
+def otto_partiti(monkeypatch):
+    rng = np.random.default_rng(3)
+    X = rng.normal(size=(300, 8))
+    X[:, 1] += 2 * X[:, 0]
+    X[:, 7] = 5.0
+    monkeypatch.setattr(correlazioni, "_matrice", lambda reg: X)
+    monkeypatch.setattr(istantanea, "USA", False)
+    correlazioni.test_correlazioni.clear()
+    yield X
+    correlazioni.test_correlazioni.clear()
+
+
+# i p-value del test di permutazione sono compresi tra 1 / (1 + n_perm) e 1: il minimo per una correlazione forte,
+# mai superata dalle permutazioni, e 1 per una colonna costante, la cui correlazione 0 è raggiunta da tutte
+def test_pvalue_limiti(otto_partiti):
+    n_perm = 99
+    tabella = correlazioni.test_correlazioni(n_perm=n_perm, n_boot=99, blocco=16)
+    pvalue = tabella.get_column("P_VALUE")
+    assert pvalue.min() >= 1 / (1 + n_perm) and pvalue.max() <= 1
+    coppia = tabella.filter((pl.col("PARTITO_1") == "FdI") & (pl.col("PARTITO_2") == "PD"))
+    assert coppia.item(0, "P_VALUE") == 1 / (1 + n_perm) and coppia.item(0, "INF") > 0.8
+    costante = tabella.filter(pl.col("PARTITO_2") == "Azione")
+    assert (costante.get_column("P_VALUE") == 1).all() and (costante.get_column("CORR") == 0).all()
+    assert (tabella.get_column("INF") <= tabella.get_column("CORR")).all()
+    assert (tabella.get_column("CORR") <= tabella.get_column("SUP")).all()
+
+
+# a parità di seme e di blocchi il risultato non dipende né dalla chiamata né dal numero di processi (i semi sono
+# assegnati ai blocchi, non ai processi); con un altro seme i campioni bootstrap cambiano
+def test_seme_deterministico(otto_partiti):
+    argomenti = dict(n_perm=49, n_boot=49, blocco=10)
+    primo = correlazioni.test_correlazioni(**argomenti)
+    correlazioni.test_correlazioni.clear()
+    assert_frame_equal(correlazioni.test_correlazioni(**argomenti), primo)
+    assert_frame_equal(correlazioni.test_correlazioni(**argomenti, n_jobs=2), primo)
+    altro = correlazioni.test_correlazioni(**argomenti, seme=1)
+    assert_frame_equal(altro.select("CORR"), primo.select("CORR"))
+    assert not altro.select("INF", "SUP").equals(primo.select("INF", "SUP"))
@@ -0,0 +1,20 @@
+import numpy as np
+import densita
+
+
+# con deviazione standard e scarto interquartile positivi la banda è quella della regola di Silverman
+def test_banda():
+    x = np.random.default_rng(0).normal(10, 2, size=1_000)
+    iqr = np.subtract(*np.percentile(x, [75, 25]))
+    assert densita.banda(x) == 1.06 * min(np.std(x, ddof=1), iqr / 1.34) * 1_000 ** -0.2
+
+
+# se lo scarto interquartile è nullo si ricade sulla deviazione standard, poi sul primo quartile e infine su 1, come in
+# Vega, invece di una banda nulla che darebbe una densità non finita
+def test_banda_degenere():
+    quasi_costante = np.concatenate([np.full(99, 3.0), [50.0]])
+    assert densita.banda(quasi_costante) == 1.06 * np.std(quasi_costante, ddof=1) * 100 ** -0.2
+    assert densita.banda(np.full(100, 3.0)) == 1.06 * 3.0 * 100 ** -0.2
+    assert densita.banda(np.zeros(100)) == 1.06 * 100 ** -0.2
+    assert densita.banda(np.array([5.0])) == 1.06 * 5.0
+    assert np.isfinite(densita.kde_binned(np.zeros(100), densita.griglia)).all()
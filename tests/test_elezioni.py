@@ -0,0 +1,96 @@
+import os
+import time
+import warnings
+import polars as pl
+import pytest
+import elezioni
+
+# comuni sintetici: due omonimi nella stessa regione ma in province diverse, un comune presente solo nella prima
+# elezione (e.g. fuso con un altro) e uno con il nome bilingue
+comuni = [
+    ("PIEMONTE", "TORINO", "SAN GIORGIO"),
+    ("PIEMONTE", "CUNEO", "SAN GIORGIO"),
+    ("PIEMONTE", "TORINO", "TORINO"),
+    ("TRENTINO-ALTO ADIGE", "BOLZANO/BOZEN", "MERANO/MERAN"),
+    ("LOMBARDIA", "MILANO", "FUSO"),
+]
+liste = {
+    "EUROPEE2019": ["PARTITO DEMOCRATICO", "LEGA SALVINI PREMIER", "MOVIMENTO 5 STELLE", "+EUROPA - ITALIA IN COMUNE"],
+    "EUROPEE2024": ["PARTITO DEMOCRATICO", "LEGA SALVINI PREMIER", "FRATELLI D'ITALIA", "STATI UNITI D'EUROPA"],
+}
+
+
+# file di Eligendo sintetico per l'elezione indicata, con i nomi delle colonne di uno dei due formati
+def scrivi(file, elezione, formato_camera=False, rinomina=None):
+    rinomina = rinomina or {}
+    righe = []
+    for i, (regione, provincia, comune) in enumerate(comuni):
+        if elezione != "EUROPEE2019" and comune == "FUSO":
+            continue
+        elettori = 1_000 * (i + 1)
+        votanti = elettori // 2 + 10 * i
+        for j, lista in enumerate(liste[elezione]):
+            voti = votanti // (j + 2)
+            righe.append((regione, provincia, comune, elettori, votanti, rinomina.get(lista, lista), voti))
+    nomi = (["REGIONE", "PROVINCIA", "COMUNE", "ELETTORI_TOTALI", "VOTANTI_TOTALI", "LISTA", "VOTILISTA"]
+            if formato_camera else
+            ["DESCREGIONE", "DESCPROVINCIA", "DESCCOMUNE", "ELETTORI", "VOTANTI", "DESCLISTA", "NUMVOTI"])
+    pl.DataFrame(righe, orient="row", schema=nomi).write_csv(file, separator=";")
+
+
+@pytest.fixture
+def fonti(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(elezioni, "fonti", {"EUROPEE2019": "Europee2019.txt", "EUROPEE2024": "Europee2024.txt"})
+    scrivi("Europee2019.txt", "EUROPEE2019", formato_camera=True)
+    scrivi("Europee2024.txt", "EUROPEE2024")
+    elezioni.get_elezioni.clear()
+    yield
+    elezioni.get_elezioni.clear()
+
+
+# i comuni omonimi della stessa regione restano distinti, i nomi bilingui e i due formati danno la stessa chiave
+def test_chiave(fonti):
+    tabella = elezioni.get_elezioni()
+    chiavi = tabella.group_by("ELEZIONE").agg(pl.col("CHIAVE").cast(pl.String).unique().sort())
+    assert chiavi.filter(pl.col("ELEZIONE") == "EUROPEE2019").item(0, "CHIAVE").len() == 5
+    assert chiavi.filter(pl.col("ELEZIONE") == "EUROPEE2024").item(0, "CHIAVE").len() == 4
+
+    with warnings.catch_warnings(record=True) as avvisi:
+        warnings.simplefilter("always")
+        sw = elezioni.swing("EUROPEE2019", "EUROPEE2024")
+    assert not [a for a in avvisi if issubclass(a.category, pl.exceptions.CategoricalRemappingWarning)]
+    assert sw.get_column("CHIAVE").n_unique() == 4
+    # il PD ha la stessa quota in entrambe le elezioni, +EUROPA e STATI UNITI D'EUROPA sono la stessa famiglia
+    assert sw.filter(pl.col("PARTITO") == "PD").get_column("SWING").abs().max() < 1e-9
+    assert sw.filter(pl.col("PARTITO") == "SUE").get_column("EUROPEE2019").min() > 0
+
+
+# la tabella viene salvata accanto ai file sorgente e riletta, e ricalcolata se un file sorgente è più recente
+def test_tabella_salvata(fonti):
+    tabella = elezioni.get_elezioni()
+    assert os.path.exists(elezioni.ELEZIONI_FILE)
+    elezioni.get_elezioni.clear()
+    letta = elezioni.get_elezioni()
+    assert letta.schema == tabella.schema and letta.equals(tabella)
+
+    scrivi("Europee2024.txt", "EUROPEE2024", rinomina={"PARTITO DEMOCRATICO": "PARTITO DEMOCRATICO - PD"})
+    os.utime("Europee2024.txt", (time.time() + 10, time.time() + 10))
+    elezioni.get_elezioni.clear()
+    assert "PARTITO DEMOCRATICO - PD" in elezioni.get_elezioni().get_column("LISTA").cast(pl.String).to_list()
+
+
+# su una coppia di elezioni vere (se i file sono presenti nella cartella del progetto) quasi tutti i comuni devono
+# essere abbinati, e i flussi devono essere quote valide
+def test_coppia_reale():
+    cartella = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    reali = {nome: os.path.join(cartella, file) for nome, file in elezioni.fonti.items()
+             if os.path.exists(os.path.join(cartella, file))}
+    if len(reali) < 2:
+        pytest.skip("servono i file di almeno due elezioni vere")
+    tabella = elezioni.carica(reali)
+    da, a = list(reali)[-2:]
+    chiavi = [set(tabella.filter(pl.col("ELEZIONE") == e).get_column("CHIAVE").cast(pl.String)) for e in (da, a)]
+    assert len(chiavi[0] & chiavi[1]) > 0.97 * len(chiavi[1])
+    fl = elezioni.flussi(da, a, tabella=tabella)
+    assert fl.group_by("DA").agg(pl.col("QUOTA").sum()).get_column("QUOTA").is_between(0, 1 + 1e-9).all()
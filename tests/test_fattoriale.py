@@ -0,0 +1,48 @@
+import numpy as np
+import fattoriale
+
+# output di factanal(X, 4) in R sui partiti in vt.partitiPlot (FdI, PD, M5S, FI, Lega, AVS, SUE, Azione), come
+# riportato nella versione originale dell'app. I pesi mancanti sono quelli che R non stampa perché minori di 0.1
+UNICITA_R = [0.419, 0.005, 0.688, 0.005, 0.678, 0.005, 0.788, 0.898]
+PESI_R = [
+    [-0.285, -0.345, -0.298, -0.540],
+    [0.979, -0.186, None, None],
+    [0.165, 0.127, None, 0.517],
+    [None, 0.986, -0.110, None],
+    [-0.419, -0.194, -0.237, -0.229],
+    [None, -0.124, 0.988, None],
+    [None, None, None, 0.456],
+    [-0.109, -0.147, None, 0.256],
+]
+VARIANZA_R = [1.268, 1.217, 1.143, 0.885]
+
+
+# sui dati reali unicità, pesi ruotati e varianze spiegate coincidono con quelli di factanal, a meno degli
+# arrotondamenti e della tolleranza dell'ottimizzatore
+def test_come_factanal(dati_reali):
+    risultato = fattoriale.analisi_fattoriale("ITALIA", 4)[4]
+    np.testing.assert_allclose(risultato["unicita"], UNICITA_R, atol=0.003)
+    pesi = risultato["pesi"]
+    for i, riga in enumerate(PESI_R):
+        for j, atteso in enumerate(riga):
+            if atteso is None:
+                assert abs(pesi[i, j]) < 0.1
+            else:
+                assert abs(pesi[i, j] - atteso) < 0.005
+    np.testing.assert_allclose((pesi ** 2).sum(axis=0), VARIANZA_R, atol=0.005)
+    assert risultato["gdl"] == 2 and risultato["pvalue"] < 1e-10
+
+
+# su dati generati da un modello a due fattori, il modello con due fattori ricostruisce la matrice di correlazione
+# e il test non lo rifiuta, mentre quello con un fattore viene rifiutato
+def test_due_fattori():
+    rng = np.random.default_rng(0)
+    L = np.array([[0.9, 0], [0.8, 0.1], [0.7, 0], [0, 0.9], [0.1, 0.8], [0, 0.7]])
+    n = 20_000
+    X = rng.normal(size=(n, 2)) @ L.T + rng.normal(size=(n, 6)) * np.sqrt(1 - (L ** 2).sum(axis=1))
+    S = np.corrcoef(X, rowvar=False)
+    due = fattoriale.fit_fattori(S, n, 2)
+    np.testing.assert_allclose(due["pesi"] @ due["pesi"].T + np.diag(due["unicita"]), S, atol=0.02)
+    np.testing.assert_allclose(np.sort(np.abs(due["pesi"]).max(axis=1)), np.sort(L.max(axis=1)), atol=0.03)
+    assert due["pvalue"] > 0.01
+    assert fattoriale.fit_fattori(S, n, 1)["pvalue"] < 1e-10
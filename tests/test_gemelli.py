@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import pytest
+import istantanea
+import voti_tidy as vt
+import gemelli
+
+
+# gemelli per forza bruta: distanze da tutti i comuni con la formula della metrica, esclusi i comuni con lo stesso
+# nome, ordinate in modo stabile (a parità di distanza vince la riga precedente)
+def forza_bruta(X, comuni, riga, k, metrica):
+    diff = X - X[riga]
+    dist = {
+        "euclidea": np.sqrt((diff ** 2).sum(axis=1)),
+        "manhattan": np.abs(diff).sum(axis=1),
+        "chebyshev": np.abs(diff).max(axis=1)
+    }[metrica]
+    dist[comuni == comuni[riga]] = np.inf
+    ordine = np.argsort(dist, kind="stable")[:k]
+    return ordine[np.isfinite(dist[ordine])], dist[ordine][np.isfinite(dist[ordine])]
+
+
+# la ricerca per singolo comune e la tabella calcolata a blocchi danno gli stessi k gemelli della forza bruta, per
+# ogni metrica, anche con comuni omonimi (esclusi dalla ricerca) e con blocchi di poche righe
+@pytest.mark.parametrize("metrica", list(gemelli.metriche))
+def test_gemelli_come_forza_bruta(dati_sintetici, metrica):
+    gemelli.get_indice.clear()
+    X, comuni, province, righe = gemelli.get_indice()
+    k = 3
+    tabella = gemelli.calcola_tabella_gemelli(k, metrica, memoria_mb=0.001, n_jobs=2)
+    for nome, (riga, *_) in righe.items():
+        attesi, distanze = forza_bruta(X, comuni, riga, k, metrica)
+        trovati = gemelli.gemelli(nome, k, metrica)
+        assert trovati.get_column("COMUNE").to_list() == comuni[attesi].tolist()
+        assert trovati.get_column("PROVINCIA").to_list() == province[attesi].tolist()
+        np.testing.assert_allclose(trovati.get_column("DISTANZA").to_numpy(), distanze, rtol=1e-9)
+    for riga in range(len(comuni)):
+        attesi, distanze = forza_bruta(X, comuni, riga, k, metrica)
+        della_riga = tabella.filter(tabella.get_column("RIGA") == riga)
+        assert della_riga.get_column("RANGO").to_list() == list(range(1, k + 1))
+        assert della_riga.get_column("GEMELLO").to_list() == comuni[attesi].tolist()
+        np.testing.assert_allclose(della_riga.get_column("DISTANZA").to_numpy(), distanze, rtol=1e-9, atol=1e-9)
+    gemelli.get_indice.clear()
+
+
+# la tabella dei gemelli salvata su disco è riusata solo se calcolata dallo stesso codice e dallo stesso file dei
+# risultati; se il file dei risultati non c'è si usa quella salvata
+def test_get_tabella_gemelli_su_disco(dati_sintetici, monkeypatch):
+    calcoli = []
+    calcola = gemelli.calcola_tabella_gemelli
+
+    def conta(k, metrica):
+        calcoli.append((k, metrica))
+        return calcola(k, metrica)
+
+    def tabella():
+        gemelli.get_tabella_gemelli.clear()
+        return gemelli.get_tabella_gemelli(2)
+
+    monkeypatch.setattr(gemelli, "calcola_tabella_gemelli", conta)
+    gemelli.get_indice.clear()
+    try:
+        attesa = tabella()
+        assert tabella().equals(attesa) and len(calcoli) == 1
+        with monkeypatch.context() as m:
+            m.setattr(istantanea, "impronta", lambda: "codice diverso")
+            tabella()
+        assert len(calcoli) == 2
+        with open(vt.RAW_FILE, "a") as f:
+            f.write("\n")
+        tabella()
+        assert len(calcoli) == 3
+        os.remove(vt.RAW_FILE)
+        assert tabella().equals(attesa) and len(calcoli) == 3
+    finally:
+        gemelli.get_tabella_gemelli.clear()
+        gemelli.get_indice.clear()
@@ -0,0 +1,104 @@
+import os
+import json
+import urllib.request
+import numpy as np
+import pytest
+import altair as alt
+import geometrie
+
+
+# topologia sintetica con due aree confinanti (che condividono l'arco 0, con molti punti quasi allineati) e
+# un'isola piccola rispetto alla tolleranza (arco chiuso 3), senza trasformazione
+def topologia(oggetto="municipalities", proprieta="name"):
+    t = np.linspace(0, 1, 200)
+    confine = np.column_stack([1 + 0.0001 * np.sin(40 * np.pi * t), t])
+    confine[[0, -1], 0] = 1.0
+    confine = confine.tolist()
+    isola = [[3.0, 0.0], [3.02, 0.0], [3.01, 0.0001], [3.0001, 0.00005], [3.0, 0.0]]
+    return {
+        "type": "Topology",
+        "objects": {oggetto: {"type": "GeometryCollection", "geometries": [
+            {"type": "Polygon", "arcs": [[0, 1]], "properties": {proprieta: "Forlì"}},
+            {"type": "Polygon", "arcs": [[~0, 2]], "properties": {proprieta: "Cantù"}},
+            {"type": "Polygon", "arcs": [[3]], "properties": {proprieta: "Isola"}},
+        ]}},
+        "arcs": [
+            confine,
+            [[1.0, 1.0], [0.0, 1.0], [0.0, 0.0], [1.0, 0.0]],
+            [[1.0, 0.0], [2.0, 0.0], [2.0, 1.0], [1.0, 1.0]],
+            isola,
+        ],
+    }
+
+
+# un anello piccolo resta un anello valido (almeno 4 punti, il primo ripetuto alla fine), anche quando il punto più
+# lontano dall'inizio è il secondo e la metà del primo tratto coinciderebbe con l'inizio
+def test_semplifica_anello_piccolo():
+    anello = np.array(topologia()["arcs"][3])
+    semplificato = geometrie._semplifica_arco(anello, 1.0)
+    assert len(semplificato) == 4 and len(np.unique(semplificato[:-1], axis=0)) == 3
+    np.testing.assert_array_equal(semplificato[0], semplificato[-1])
+    degenere = np.zeros((5, 2))
+    assert len(geometrie._semplifica_arco(degenere, 1.0)) == 5
+
+
+# gli archi semplificati mantengono gli estremi, dunque le aree confinanti continuano a combaciare, e il confine
+# quasi rettilineo si riduce a pochi punti
+def test_semplifica():
+    topo = topologia()
+    archi = geometrie._decodifica_archi(geometrie.semplifica(topo, 0.001))
+    originali = geometrie._decodifica_archi(topo)
+    for arco, originale in zip(archi, originali):
+        np.testing.assert_allclose(arco[[0, -1]], originale[[0, -1]], atol=0.0001)
+    assert len(archi[0]) < 10
+    assert len(archi[3]) >= 4
+
+
+# l'archivio costruito da un file locale viene usato al posto dei file remoti; senza archivio i comuni non hanno
+# geometria (il file remoto originale è troppo pesante), regioni e province usano il file remoto
+def test_get_geometria(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(geometrie, "CARTELLA", str(tmp_path / "geometrie"))
+    geometrie.get_geometria.clear()
+    assert geometrie.get_geometria("COMUNE")[0] is None
+    assert geometrie.get_geometria("REGIONE")[0].url.startswith(geometrie.URL_BASE)
+
+    with open("comuni.topo.json", "w") as f:
+        json.dump(topologia(), f)
+    geometrie.costruisci("COMUNE", "comuni.topo.json")
+    geometrie.get_geometria.clear()
+    dati, etichetta = geometrie.get_geometria("COMUNE")
+    assert isinstance(dati, alt.Data) and etichetta == "properties.CHIAVE"
+    chiavi = [g["properties"]["CHIAVE"] for g in dati.values["objects"]["municipalities"]["geometries"]]
+    assert chiavi == ["FORLI'", "CANTU'", "ISOLA"]
+    geometrie.get_geometria.clear()
+
+
+# con l'archivio completo nessun livello usa la rete, qualunque sia la cartella corrente
+def test_get_geometria_senza_rete(tmp_path, monkeypatch):
+    monkeypatch.setattr(geometrie, "CARTELLA", str(tmp_path / "geometrie"))
+    for livello, (_, oggetto, proprieta) in geometrie.sorgenti.items():
+        sorgente = str(tmp_path / f"{livello}.topo.json")
+        with open(sorgente, "w") as f:
+            json.dump(topologia(oggetto, proprieta), f)
+        geometrie.costruisci(livello, sorgente)
+
+    def senza_rete(*args, **kwargs):
+        raise OSError("rete non disponibile")
+    monkeypatch.setattr(urllib.request, "urlopen", senza_rete)
+    monkeypatch.chdir(tmp_path / "geometrie")
+    geometrie.get_geometria.clear()
+    for livello, (_, oggetto, _) in geometrie.sorgenti.items():
+        dati, _ = geometrie.get_geometria(livello)
+        assert isinstance(dati, alt.Data) and oggetto in dati.values["objects"]
+    geometrie.get_geometria.clear()
+
+
+# l'archivio salvato nel repository contiene tutti i livelli a tutte le tolleranze
+def test_archivio_repository():
+    if not os.path.isdir(geometrie.CARTELLA):
+        pytest.skip("archivio delle geometrie non ancora generato (python geometrie.py)")
+    for livello, (_, oggetto, _) in geometrie.sorgenti.items():
+        for tolleranza in geometrie.tolleranze:
+            with open(geometrie._file_geometria(livello, tolleranza)) as f:
+                assert oggetto in json.load(f)["objects"]
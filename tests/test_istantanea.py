@@ -0,0 +1,85 @@
+import os
+import json
+import polars as pl
+import pytest
+import istantanea
+
+
+# crea nella cartella corrente un'istantanea con gli artefatti indicati (nome -> oggetto) e la rende quella corrente
+def crea(nome, artefatti, impronta=None):
+    cartella = os.path.join(istantanea.CARTELLA, nome)
+    os.makedirs(cartella)
+    file = {}
+    for artefatto, oggetto in artefatti.items():
+        if isinstance(oggetto, pl.DataFrame):
+            file[artefatto] = f"{artefatto}.parquet"
+            oggetto.write_parquet(os.path.join(cartella, file[artefatto]))
+        else:
+            file[artefatto] = f"{artefatto}.json"
+            with open(os.path.join(cartella, file[artefatto]), "w") as f:
+                json.dump(oggetto, f)
+    with open(os.path.join(cartella, istantanea.MANIFESTO), "w") as f:
+        json.dump({
+            "versione": istantanea.VERSIONE,
+            "sorgente": {"file": "assente.txt"},
+            "impronta": impronta or istantanea.impronta(),
+            "artefatti": file
+        }, f)
+    with open(os.path.join(istantanea.CARTELLA, istantanea.CORRENTE), "w") as f:
+        f.write(nome)
+
+
+@pytest.fixture
+def cartella(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(istantanea, "USA", True)
+    istantanea._leggi_corrente.clear()
+    yield tmp_path
+    istantanea._leggi_corrente.clear()
+
+
+# funzioni decorate come nell'app: i risultati calcolati sono riconoscibili da quelli salvati
+@istantanea.salvato("tabella_{k}")
+def tabella(k: int = 1):
+    return pl.DataFrame({"CALCOLATA": [k]})
+
+
+@istantanea.salvato("dizionario", "json", chiave="{reg}|{k}", converti=lambda salvato, argomenti: salvato * 2)
+def voce(reg: str, k: int = 1):
+    return "calcolata"
+
+
+@istantanea.salvato("righe", chiave=("REGIONE", "{reg}"))
+def righe(reg: str):
+    return "calcolate"
+
+
+def test_salvato(cartella):
+    crea("prima", {
+        "tabella_1": pl.DataFrame({"SALVATA": [1]}),
+        "dizionario": {"LAZIO|1": "salvata"},
+        "righe": pl.DataFrame({"REGIONE": ["LAZIO", "PUGLIA"], "VALORE": [1, 2]})
+    })
+    assert tabella().columns == ["SALVATA"] and tabella(2).columns == ["CALCOLATA"]
+    assert voce("LAZIO") == "salvatasalvata" and voce("LAZIO", k=2) == "calcolata"
+    assert righe("PUGLIA").to_dicts() == [{"VALORE": 2}] and righe("MOLISE") == "calcolate"
+
+    istantanea.USA = False
+    assert tabella().columns == ["CALCOLATA"]
+
+
+# un'istantanea creata con un codice o un blocchi.json diversi non viene usata
+def test_impronta_diversa(cartella):
+    crea("vecchia", {"tabella_1": pl.DataFrame({"SALVATA": [1]})}, impronta="diversa")
+    assert istantanea.get_corrente() is None
+    assert tabella().columns == ["CALCOLATA"]
+
+
+# una nuova istantanea resa corrente con l'app avviata viene usata subito, senza svuotare la cache
+def test_nuova_corrente(cartella):
+    crea("prima", {"tabella_1": pl.DataFrame({"SALVATA": [1]})})
+    assert tabella().item() == 1
+    crea("seconda", {"tabella_1": pl.DataFrame({"SALVATA": [2]})})
+    corrente = os.path.join(istantanea.CARTELLA, istantanea.CORRENTE)
+    os.utime(corrente, ns=(os.stat(corrente).st_atime_ns, os.stat(corrente).st_mtime_ns + 1))
+    assert tabella().item() == 2
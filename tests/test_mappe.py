@@ -0,0 +1,55 @@
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+import voti_tidy as vt
+import mappe
+
+
+# comuni sintetici con le colonne di votiCoord: percentuali arrotondate come in votiPerc (dunque con molti valori
+# uguali) e un partito non candidato in una parte dei comuni
+@pytest.fixture
+def voti_coord(monkeypatch):
+    rng = np.random.default_rng(0)
+    n = 2_000
+    voti = pl.DataFrame({
+        "CIRCOSCRIZIONE": "I",
+        "REGIONE": rng.choice(["PIEMONTE", "LOMBARDIA", "VENETO"], n),
+        "PROVINCIA": rng.choice(["A", "B", "C"], n),
+        "COMUNE": [f"COMUNE {i}" for i in rng.permutation(n)],
+        "ELETTORI_M": rng.integers(100, 1000, n),
+        "latitude": rng.uniform(36, 47, n),
+        "longitude": rng.uniform(6, 19, n),
+    } | {partito: rng.gamma(2, 3, n).round(2) for partito in vt.partiti_ext})
+    voti = voti.with_columns(pl.when(pl.col("REGIONE") != "VENETO").then(None).otherwise(pl.col(vt.partiti_ext[-1]))
+                             .alias(vt.partiti_ext[-1]))
+    monkeypatch.setattr(mappe, "get_voti_coord", lambda: voti)
+    mappe.get_indice_mappa.clear()
+    yield voti
+    mappe.get_indice_mappa.clear()
+
+
+# filtro originale della mappa, come riferimento
+def filtra(voti, partito, minimo, massimo):
+    return (
+        voti.drop(["CIRCOSCRIZIONE", "ELETTORI_M"])
+        .filter(pl.col(partito) >= minimo)
+        .filter(pl.col(partito) <= massimo)
+        .sort(["REGIONE", "PROVINCIA", "COMUNE"])
+    )
+
+
+# le ricerche binarie sull'indice ordinato danno gli stessi comuni, nello stesso ordine, del filtro su tutte le righe,
+# anche con estremi pari a valori presenti, intervalli vuoti o rovesciati e comuni in cui il partito non era candidato
+@pytest.mark.parametrize("partito", [vt.partiti_ext[0], vt.partiti_ext[-1]])
+def test_intervallo_come_filtro(voti_coord, partito):
+    valori = voti_coord.get_column(partito).drop_nulls().to_numpy()
+    intervalli = [(0, 100), (valori[0], valori[0]), (valori[1], valori[2]), (5, 5.001), (30, 10), (200, 300)]
+    for minimo, massimo in intervalli:
+        attesi = filtra(voti_coord, partito, minimo, massimo)
+        assert_frame_equal(mappe.comuni_intervallo(partito, minimo, massimo), attesi)
+        posizioni = mappe.posizioni_intervallo(partito, minimo, massimo)
+        assert_frame_equal(posizioni, attesi.select(["latitude", "longitude"]))
+        assert mappe.conteggio(partito, minimo, massimo) == attesi.height
+        if minimo < massimo:
+            assert mappe.istogramma(partito, minimo, massimo).get_column("COMUNI").sum() == attesi.height
@@ -0,0 +1,102 @@
+import os
+import threading
+import numpy as np
+import polars as pl
+import pytest
+import istantanea
+import voti_tidy as vt
+import modelli as mod
+
+
+# punti sintetici con la x distribuita come il numero di elettori (log=True) o come una percentuale
+def punti(log, n=5_000, seme=0):
+    rng = np.random.default_rng(seme)
+    x = np.exp(rng.normal(8, 1.5, size=n)) if log else rng.normal(50, 10, size=n)
+    return x, rng.uniform(0, 40, size=n), rng.integers(100, 10_000, size=n)
+
+
+# con min_comuni=1 le celle coincidono con quelle di np.histogram2d
+def test_bin_2d_come_histogram2d():
+    x, y, elettori = punti(False)
+    celle, isolati = mod._bin_2d(x, y, elettori, 30, False)
+    attesi, _, _ = np.histogram2d(x, y, [np.histogram_bin_edges(x, 30), np.histogram_bin_edges(y, 30)])
+    assert not isolati.any()
+    assert sorted(celle.get_column("COMUNI").to_list()) == sorted(attesi[attesi > 0].astype(int).tolist())
+
+
+# ogni comune finisce in una cella o tra i punti isolati, anche con la scala logaritmica, in cui gli estremi delle
+# celle sono ricavati con exp e potrebbero escludere il comune più piccolo e quello più grande
+@pytest.mark.parametrize("log", [False, True])
+def test_bin_2d_isolati(log):
+    x, y, elettori = punti(log)
+    celle, _ = mod._bin_2d(x, y, elettori, 30, log)
+    assert celle.get_column("X0").min() == x.min() and celle.get_column("X1").max() == x.max()
+    assert celle.get_column("COMUNI").sum() == x.size
+
+    celle, isolati = mod._bin_2d(x, y, elettori, 30, log, min_comuni=5)
+    assert (celle.get_column("COMUNI") >= 5).all()
+    assert celle.get_column("COMUNI").sum() + isolati.sum() == x.size
+    assert celle.get_column("ELETTORI").sum() + elettori[isolati].sum() == elettori.sum()
+
+
+# il bootstrap viene eseguito nel processo corrente e le sessioni si attendono solo per la stessa regione: il
+# bootstrap di una regione non blocca quello di un'altra. Una richiesta successiva riprende dai campioni già calcolati
+def test_get_bootstrap(dati_sintetici, monkeypatch):
+    chiamate, avviata = [], threading.Event()
+
+    def bootstrap(X, Y, beta, n_boot, tempo_max=None, n_jobs=None, salta=0):
+        chiamate.append((n_jobs, salta))
+        if salta == 0 and len(chiamate) == 1:
+            avviata.set()
+            # resta in attesa finché l'altra regione non ha finito
+            fatta.wait(10)
+        return np.zeros((5, Y.shape[1], X.shape[1]))
+
+    monkeypatch.setattr(mod.rq, "bootstrap_quantreg", bootstrap)
+    monkeypatch.setattr(mod, "get_coeff_quantreg", lambda: {"ITALIA": None, "PIEMONTE": None})
+    mod._campioni_bootstrap.clear()
+    fatta = threading.Event()
+    prima = threading.Thread(target=mod.get_bootstrap, args=("ITALIA", 10))
+    prima.start()
+    assert avviata.wait(10)
+    # con un unico lock la seconda regione attenderebbe la prima
+    seconda = threading.Thread(target=mod.get_bootstrap, args=("PIEMONTE", 10))
+    seconda.start()
+    seconda.join(5)
+    assert not seconda.is_alive()
+    fatta.set()
+    prima.join()
+    assert mod.get_bootstrap("ITALIA", 10).shape[0] == 10
+    assert all(n_jobs == 1 for n_jobs, _ in chiamate) and chiamate[-1] == (1, 5)
+    mod._campioni_bootstrap.clear()
+
+
+# la tabella dei coefficienti salvata su disco è riusata solo se calcolata dallo stesso codice e dallo stesso file dei
+# risultati; se il file dei risultati non c'è si usa quella salvata
+def test_get_coeff_quantreg_su_disco(dati_sintetici, monkeypatch):
+    calcoli = []
+
+    def calcola(n_jobs=None):
+        calcoli.append(n_jobs)
+        return pl.DataFrame({"REGIONE": "ITALIA", "PARTITO": vt.partitiPlot, "const": float(len(calcoli))}).with_columns(
+            [pl.lit(0.0).alias(e) for e in mod.esplicative]
+        )
+
+    def costante():
+        mod.get_coeff_quantreg.clear()
+        return mod.get_coeff_quantreg()["ITALIA"][0, 0]
+
+    monkeypatch.setattr(mod, "calcola_coeff_quantreg", calcola)
+    try:
+        assert costante() == 1 and costante() == 1
+        with monkeypatch.context() as m:
+            m.setattr(istantanea, "impronta", lambda: "codice diverso")
+            assert costante() == 2
+        with open(vt.RAW_FILE, "a") as f:
+            f.write("\n")
+        assert costante() == 3
+        os.remove(vt.RAW_FILE)
+        assert costante() == 3
+        assert calcoli == [1, 1, 1]
+    finally:
+        mod.get_coeff_quantreg.clear()
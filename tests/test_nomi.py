@@ -0,0 +1,55 @@
+import numpy as np
+import nomi
+
+# tabella di riferimento sintetica: nome, codice di provincia, tipo di località e popolazione.
+# Due comuni omonimi in province diverse e una frazione con lo stesso nome di un capoluogo
+riferimento = [
+    ("Torino", 1, "PPLA", 850_000),
+    ("San Giorgio", 1, "PPLA3", 2_000),
+    ("Moncalieri", 1, "PPLA3", 55_000),
+    ("Alessandria", 6, "PPLA2", 90_000),
+    ("San Giorgio", 6, "PPLA3", 1_500),
+    ("Acqui Terme", 6, "PPLA3", 19_000),
+    ("Forlì", 40, "PPLA2", 117_000),
+    ("Sant’Agata Feltria", 40, "PPLA3", 2_000),
+    ("Cesena", 40, "PPLA2", 95_000),
+    ("Cesena", 40, "PPL", 500),
+]
+
+
+def abbina(comuni, province, **kwargs):
+    nomi_rif, codici, tipi, popolazione = zip(*riferimento)
+    return nomi.abbina(comuni, province, list(nomi_rif), list(codici), list(tipi), list(popolazione), **kwargs)
+
+
+# gli omonimi sono distinti tramite la provincia, ricavata dalle corrispondenze esatte non ambigue; tra località con
+# lo stesso nome nella stessa provincia si preferisce il capoluogo del comune
+def test_omonimi_per_provincia():
+    comuni = ["TORINO", "MONCALIERI", "SAN GIORGIO", "ALESSANDRIA", "ACQUI TERME", "SAN GIORGIO", "CESENA"]
+    province = ["TORINO", "TORINO", "TORINO", "ALESSANDRIA", "ALESSANDRIA", "ALESSANDRIA", "FORLI'-CESENA"]
+    scelta, confidenza, metodo = abbina(comuni, province)
+    assert scelta.tolist() == [0, 2, 1, 3, 5, 4, 8]
+    assert (confidenza == 1).all() and set(metodo) == {"esatto"}
+
+
+# accenti, apostrofi (dritti o tipografici) e maiuscole non contano
+def test_accenti_e_apostrofi():
+    assert nomi.normalizza("Forlì") == nomi.normalizza("FORLI'") == "FORLI"
+    assert nomi.normalizza("Sant’Agata Feltria") == nomi.normalizza("SANT'AGATA FELTRIA")
+    scelta, _, metodo = abbina(["FORLI'", "SANT'AGATA FELTRIA", "CESENA"], ["FORLI'-CESENA"] * 3)
+    assert scelta.tolist() == [6, 7, 8] and set(metodo) == {"esatto"}
+
+
+# un nome scritto in modo diverso è abbinato per similarità solo se questa raggiunge la soglia, e la confidenza è la
+# similarità di Dice dei trigrammi; un nome simile di un'altra provincia non viene mai scelto
+def test_soglia_similarita():
+    comuni = ["TORINO", "MONCALIERI", "MONCALIERE", "ACQUI TERME", "MONCALIERE"]
+    province = ["TORINO", "TORINO", "TORINO", "ALESSANDRIA", "ALESSANDRIA"]
+    attesa = 2 * len(nomi.trigrammi("MONCALIERE") & nomi.trigrammi("MONCALIERI")) / (
+        len(nomi.trigrammi("MONCALIERE")) + len(nomi.trigrammi("MONCALIERI"))
+    )
+    scelta, confidenza, metodo = abbina(comuni, province, soglia=attesa)
+    assert scelta[2] == 2 and metodo[2] == "simile" and np.isclose(confidenza[2], attesa)
+    assert scelta[4] == -1 and metodo[4] == "nessuno"
+    scelta, confidenza, metodo = abbina(comuni, province, soglia=attesa + 0.01)
+    assert scelta[2] == -1 and confidenza[2] == 0 and metodo[2] == "nessuno"
@@ -0,0 +1,30 @@
+import istantanea
+
+# prestazioni disattiva l'istantanea all'importazione: va ripristinata per gli altri test
+_usa = istantanea.USA
+import prestazioni
+istantanea.USA = _usa
+
+
+def riga(caso, scala, stato="ok", mediana_s=1.0, picco_mb=100.0):
+    return {"caso": caso, "scala": scala, "stato": stato, "mediana_s": mediana_s, "picco_mb": picco_mb}
+
+
+# un caso riuscito prima che ora fallisce è una regressione; uno che falliva già, o nuovo, no
+def test_confronta_casi_falliti():
+    precedenti = [riga("voti_grouped_by", 100), riga("get_coord", 100, stato="errore: x"), riga("prediction", 1)]
+    risultati = [
+        riga("voti_grouped_by", 100, stato="errore: processo terminato (e.g. memoria esaurita)"),
+        riga("get_coord", 100, stato="errore: x"),
+        riga("prediction", 1),
+        riga("find_closer", 1, stato="errore: y")
+    ]
+    regressioni = prestazioni.confronta(risultati, precedenti)
+    assert len(regressioni) == 1 and regressioni[0].startswith("voti_grouped_by x100: ok ->")
+
+
+# tempi e memoria oltre la tolleranza e oltre le soglie minime
+def test_confronta_tolleranza():
+    precedenti = [riga("a", 1), riga("b", 1), riga("c", 1, picco_mb=10.0)]
+    risultati = [riga("a", 1, mediana_s=1.3), riga("b", 1, mediana_s=1.1), riga("c", 1, picco_mb=20.0)]
+    assert prestazioni.confronta(risultati, precedenti) == ["a x1: mediana_s 1.0 -> 1.3"]
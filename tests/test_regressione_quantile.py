@@ -0,0 +1,47 @@
+import time
+import numpy as np
+import pytest
+import regressione_quantile as rq
+
+
+# dati sintetici per una regressione mediana con costante, due esplicative e due risposte
+def dati(n=300, seme=0):
+    rng = np.random.default_rng(seme)
+    X = np.column_stack([np.ones(n), rng.normal(size=(n, 2))])
+    Y = X @ np.array([[1.0, 2.0], [0.5, -1.0], [-0.3, 0.2]]) + rng.standard_t(3, size=(n, 2))
+    beta = np.array([rq.quantreg_irls(Y[:, j], X)[0] for j in range(Y.shape[1])])
+    return X, Y, beta
+
+
+# i campioni dipendono solo dalla loro posizione nella sequenza: riprendere da quelli già calcolati, con uno o più
+# processi, dà gli stessi campioni di un'unica chiamata
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_bootstrap_ripresa_deterministica(n_jobs):
+    X, Y, beta = dati()
+    tutti = rq.bootstrap_quantreg(X, Y, beta, n_boot=20, n_jobs=1, blocco=10)
+    primi = rq.bootstrap_quantreg(X, Y, beta, n_boot=10, n_jobs=1, blocco=10)
+    resto = rq.bootstrap_quantreg(X, Y, beta, n_boot=20, n_jobs=n_jobs, blocco=10, salta=10)
+    assert tutti.shape == (20, 2, 3) and primi.shape[0] == resto.shape[0] == 10
+    np.testing.assert_allclose(np.concatenate([primi, resto]), tutti)
+    # senza tempo a disposizione nel processo corrente non si calcola alcun campione
+    assert rq.bootstrap_quantreg(X, Y, beta, n_boot=20, n_jobs=1, blocco=10, tempo_max=0.0).shape == (0, 2, 3)
+
+
+# anche la prima attesa rispetta il tempo massimo: se nessun blocco è completato si ottengono zero campioni, e i
+# processi ancora al lavoro vengono terminati
+def test_bootstrap_tempo_massimo():
+    X, Y, beta = dati(n=20_000)
+    inizio = time.perf_counter()
+    campioni = rq.bootstrap_quantreg(X, Y, beta, n_boot=1_000, n_jobs=2, blocco=100, tempo_max=0.0)
+    assert campioni.shape[1:] == (2, 3) and campioni.shape[0] < 1_000
+    assert time.perf_counter() - inizio < 30
+
+
+# adattando i modelli nel processo corrente (come fa l'app) si ottengono gli stessi coefficienti del pool
+def test_fit_quantreg_sequenziale():
+    X, Y, _ = dati()
+    gruppi = {"A": np.arange(0, 150), "B": np.arange(150, 300)}
+    sequenziale, _ = rq.fit_quantreg(X, Y, ["P1", "P2"], gruppi, ["const", "x1", "x2"], n_jobs=1)
+    pool, _ = rq.fit_quantreg(X, Y, ["P1", "P2"], gruppi, ["const", "x1", "x2"], n_jobs=2)
+    assert sequenziale.height == 6
+    assert sequenziale.equals(pool)
@@ -0,0 +1,64 @@
+import numpy as np
+import polars as pl
+import pytest
+import spazio
+
+
+# indice spaziale sintetico su una griglia di comuni, con due comuni nello stesso punto e un partito candidato solo
+# nella metà settentrionale
+@pytest.fixture
+def indice(monkeypatch):
+    rng = np.random.default_rng(0)
+    lat, lon = np.meshgrid(np.linspace(44, 46, 20), np.linspace(10, 12, 20))
+    lat, lon = lat.ravel(), lon.ravel()
+    n = len(lat)
+    comuni = pl.DataFrame({
+        "COMUNE": [f"C{i}" for i in range(n)] + ["GEMELLO"],
+        "PROVINCIA": ["P"] * (n + 1),
+        "REGIONE": ["R"] * (n + 1),
+        "latitude": np.r_[lat, lat[0]],
+        "longitude": np.r_[lon, lon[0]],
+        "NORD": np.r_[np.where(lat >= 45, lat + rng.normal(0, 0.1, n), np.nan), np.nan],
+        "TUTTI": np.r_[lat + rng.normal(0, 0.1, n), lat[0]],
+    }).with_columns(pl.col("NORD").fill_nan(None))
+    punti = spazio.cartesiane(comuni.get_column("latitude").to_numpy(), comuni.get_column("longitude").to_numpy())
+    monkeypatch.setattr(spazio, "get_indice", lambda: (spazio.spatial.cKDTree(punti), punti, comuni))
+    spazio.pesi_spaziali.clear()
+    yield comuni
+    spazio.pesi_spaziali.clear()
+
+
+# il comune stesso è escluso anche quando un altro comune ha le stesse coordinate
+def test_vicini_comune(indice):
+    for comune in ("C0", "GEMELLO"):
+        vicini = spazio.vicini_comune(comune, "P", 30)
+        assert comune not in vicini.get_column("COMUNE").to_list()
+        assert {"C0", "GEMELLO"} - {comune} <= set(vicini.get_column("COMUNE").to_list())
+    with pytest.raises(ValueError, match="C0"):
+        spazio.vicini_comune("C0", "ALTRA", 30)
+
+
+# nei pesi k-NN ogni comune ha esattamente k vicini diversi da sé, anche quando un altro comune ha le stesse coordinate
+# e il KD-tree restituisce quello come primo vicino
+def test_pesi_knn_senza_se_stesso(indice):
+    W = spazio.pesi_spaziali(k=4)
+    assert (W.diagonal() == 0).all()
+    assert (np.diff(W.indptr) == 4).all()
+    gemelli = [0, indice.height - 1]
+    for riga in gemelli:
+        assert set(gemelli) - {riga} <= set(W.indices[W.indptr[riga]:W.indptr[riga + 1]])
+
+
+# i comuni in cui il partito non era candidato sono esclusi dalla statistica (invece di contare come 0): il risultato
+# coincide con quello calcolato sui soli comuni in cui era candidato
+def test_moran_solo_comuni_candidati(indice, monkeypatch):
+    W = spazio.pesi_spaziali(k=4)
+    globale = spazio.moran_globale("NORD", W, n_perm=99)
+    locale = spazio.moran_locale("NORD", W, n_perm=99)
+    assert locale.height == indice.get_column("NORD").is_not_null().sum()
+    assert locale.get_column("NORD").null_count() == 0
+    assert globale["I"] > 0.5 and np.isfinite(locale.get_column("I_LOCALE").to_numpy()).all()
+
+    z, Wr, _ = spazio._standardizza("NORD", W)
+    np.testing.assert_allclose(np.asarray(Wr.sum(axis=1)).ravel()[np.asarray(Wr.sum(axis=1)).ravel() > 0], 1)
+    assert abs(z.mean()) < 1e-12
@@ -0,0 +1,163 @@
+import json
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+import voti_tidy as vt
+
+
+# implementazione originale di voti_grouped_by (un group_by sui dati grezzi a ogni chiamata), come riferimento
+def voti_grouped_by_group_by(livello, cond=None):
+    if livello == "ITALIA":
+        abs_gr = vt.votiAbs.sum()
+    else:
+        abs_gr = (
+            vt.get_raw_data()
+            .select(
+                ["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE", "LISTA", "NUMVOTI"]
+            )
+            .group_by([livello, "LISTA"])
+            .sum()
+            .pivot(
+                on="LISTA",
+                values="NUMVOTI"
+            )
+            .with_columns(
+                VOTI_VALIDI=pl.sum_horizontal(vt.partiti)
+            )
+        )
+
+    perc_gr = abs_gr.select(["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE"])
+    for partito in vt.partiti:
+        perc_gr = perc_gr.with_columns(
+            (abs_gr.get_column(partito) / abs_gr.get_column("VOTI_VALIDI") * 100).round(2).alias(partito)
+        )
+
+    if livello == "ITALIA" or cond is None:
+        return perc_gr
+    else:
+        return perc_gr.filter(pl.col(livello) == cond)
+
+
+# confronta i risultati del cubo con quelli del group_by. I livelli diversi da quello richiesto sono nulli in
+# entrambe le versioni, ma con tipi che possono differire
+def confronta(nuovo, vecchio):
+    assert_frame_equal(
+        nuovo.select(vt.partiti).cast(pl.Float64).with_columns(nuovo.select(vt.livelli).cast(pl.String)),
+        vecchio.select(vt.partiti).cast(pl.Float64).with_columns(vecchio.select(vt.livelli).cast(pl.String)),
+        check_row_order=False, check_column_order=False
+    )
+
+
+# il cubo deve dare gli stessi risultati del group_by per ogni livello, sia per l'intero livello che per ogni unità
+@pytest.mark.parametrize("livello", ["ITALIA"] + vt.livelli)
+def test_voti_grouped_by_come_group_by(dati_sintetici, livello):
+    confronta(vt.voti_grouped_by(livello), voti_grouped_by_group_by(livello))
+    if livello != "ITALIA":
+        for unita in dati_sintetici.get_column(f"DESC{livello}" if livello != "CIRCOSCRIZIONE" else
+                                                "DESCCIRCEUROPEA").unique():
+            confronta(vt.voti_grouped_by(livello, unita), voti_grouped_by_group_by(livello, unita))
+
+
+# sul file dei risultati vero si confrontano gli interi livelli
+@pytest.mark.parametrize("livello", ["ITALIA"] + vt.livelli)
+def test_voti_grouped_by_come_group_by_dati_reali(dati_reali, livello):
+    confronta(vt.voti_grouped_by(livello), voti_grouped_by_group_by(livello))
+
+
+# come nel group_by originale, che raggruppa per nome, i comuni omonimi sono aggregati in un'unica riga; un'unità
+# inesistente dà un dataframe vuoto
+def test_voti_grouped_by_omonimi_e_mancanti(dati_sintetici):
+    assert vt.voti_grouped_by("COMUNE", "SAN GIORGIO").height == 1
+    mancante = vt.voti_grouped_by("PROVINCIA", "NESSUNA")
+    assert mancante.is_empty()
+    assert mancante.columns == vt.voti_grouped_by("PROVINCIA").columns
+
+
+# un partito non candidato resta nullo, uno candidato senza voti vale 0
+def test_voti_grouped_by_nulli(dati_sintetici):
+    svp = "SÜDTIROLER VOLKSPARTEI (SVP)"
+    assert vt.voti_grouped_by("CIRCOSCRIZIONE", "I : ITALIA NORD-OCCIDENTALE").item(0, svp) is None
+    assert vt.voti_grouped_by("COMUNE", "TORINO").item(0, vt.partiti[3]) == 0
+
+
+# le coalizioni sono la somma delle percentuali arrotondate dei partiti che le compongono, come nella versione
+# originale del preprocessing, sia in votiPerc che nella lettura lazy e nei blocchi calcolati su richiesta
+def test_coalizioni_come_somma_delle_quote(dati_sintetici):
+    originali = vt.votiPerc.select(
+        CENTRODESTRA=pl.col("FRATELLI D'ITALIA") + pl.col("LEGA SALVINI PREMIER")
+        + pl.col("FORZA ITALIA - NOI MODERATI - PPE"),
+        CENTROSINISTRA=pl.col("PARTITO DEMOCRATICO") + pl.col("MOVIMENTO 5 STELLE")
+        + pl.col("ALLEANZA VERDI E SINISTRA")
+    )
+    assert_frame_equal(vt.votiPerc.select(originali.columns), originali)
+    assert_frame_equal(vt.scan_voti_perc(partiti_sel=originali.columns).collect().select(originali.columns), originali)
+    assert_frame_equal(vt.voti_con_blocchi(originali.columns).select(originali.columns), originali)
+
+
+# un file dei blocchi con partiti sconosciuti non impedisce l'importazione: i blocchi non validi vengono ignorati con
+# un avviso alla prima richiesta, quelli validi aggiunti
+def test_blocchi_non_validi(dati_sintetici, monkeypatch):
+    monkeypatch.setattr(vt, "blocchi", dict(vt.blocchi))
+    monkeypatch.setattr(vt, "_blocchi_caricati", False)
+    with open(vt.BLOCCHI_FILE, "w") as f:
+        json.dump({"DESTRA": ["FRATELLI D'ITALIA", "LEGA SALVINI PREMIER"], "SBAGLIATO": ["NESSUN PARTITO"]}, f)
+    with pytest.warns(UserWarning, match="SBAGLIATO"):
+        blocchi = vt.get_blocchi()
+    assert "DESTRA" in blocchi and "SBAGLIATO" not in blocchi
+    assert vt.voti_con_blocchi(["DESTRA"]).get_column("DESTRA").null_count() == 0
+
+
+# la lettura a blocchi dà lo stesso risultato del pivot sul file intero anche con blocchi di poche righe, che dividono
+# le righe dei comuni tra più blocchi; le caratteristiche assenti dal file restano assenti
+@pytest.mark.parametrize("senza", [[], ["VOTANTI_M"]])
+def test_aggrega_a_blocchi_come_pivot(dati_sintetici, senza):
+    dati_sintetici.drop(senza).write_csv("blocchi.txt", separator=";")
+    attesi = vt._rinomina(dati_sintetici.drop(senza)).pivot(on="LISTA", values="NUMVOTI")
+    assert_frame_equal(vt.aggrega_a_blocchi("blocchi.txt", memoria_mb=0.01), attesi)
+
+
+# nei file per sezione le caratteristiche di ogni sezione sono contate una sola volta e sommate per comune
+def test_aggrega_a_blocchi_per_sezione(dati_sintetici):
+    sezioni = pl.concat([dati_sintetici.with_columns(SEZIONE=pl.lit(s)) for s in (1, 2)]).sort(
+        "DESCPROVINCIA", "DESCCOMUNE", "SEZIONE", maintain_order=True
+    )
+    sezioni.write_csv("sezioni.txt", separator=";")
+    per_comune = vt.aggrega_a_blocchi("sezioni.txt", memoria_mb=0.01)
+    attesi = vt._rinomina(dati_sintetici).pivot(on="LISTA", values="NUMVOTI")
+    assert_frame_equal(per_comune, attesi.with_columns(pl.exclude(vt.livelli) * 2), check_row_order=False)
+    assert vt.aggrega_a_blocchi("sezioni.txt", memoria_mb=0.01, per_sezione=True).height == 2 * attesi.height
+
+
+# un file per sezione abbastanza piccolo da essere letto tutto insieme dà una riga per comune, come la lettura a blocchi
+def test_data_preprocessing_per_sezione(dati_sintetici):
+    sezioni = pl.concat([dati_sintetici.with_columns(SEZIONE=pl.lit(s)) for s in (1, 2)]).sort(
+        "DESCPROVINCIA", "DESCCOMUNE", "SEZIONE", maintain_order=True
+    )
+    sezioni.write_csv(vt.RAW_FILE, separator=";")
+    in_memoria = vt.data_preprocessing()
+    a_blocchi = vt.data_preprocessing(memoria_mb=0.01)
+    assert in_memoria[0].height == len(set(dati_sintetici.select("DESCPROVINCIA", "DESCCOMUNE").rows()))
+    for tutto, blocchi in zip(in_memoria, a_blocchi):
+        assert_frame_equal(tutto, blocchi)
+
+
+# la lettura lazy con filtro e selezione di partiti e colonne dà le stesse righe di votiPerc filtrato, con filtro e
+# colonne spinti fino alla lettura della cache colonnare
+@pytest.mark.parametrize("filtro, partiti_sel, colonne", [
+    (None, None, None),
+    (pl.col("REGIONE") == "VENETO", ["PARTITO DEMOCRATICO", "CENTRODESTRA"], ["ELETTORI", "AFFLUENZA"]),
+    (pl.col("CIRCOSCRIZIONE").str.starts_with("I "), ["SÜDTIROLER VOLKSPARTEI (SVP)", "CENTROSINISTRA"], []),
+    (pl.col("PROVINCIA").is_in(["TORINO", "BOLZANO"]), ["SÜDTIROLER VOLKSPARTEI (SVP)"], ["VOTANTI"]),
+])
+def test_scan_voti_perc_come_voti_perc(dati_sintetici, filtro, partiti_sel, colonne):
+    lazy = vt.scan_voti_perc(filtro, partiti_sel, colonne)
+    attesi = vt.votiPerc if filtro is None else vt.votiPerc.filter(filtro)
+    risultato = lazy.collect()
+    assert_frame_equal(risultato, attesi.select(risultato.columns))
+    assert risultato.height > 0 and set(risultato.columns) == set(
+        vt.livelli + (vt.colonne_comune + ["AFFLUENZA"] if colonne is None else colonne)
+        + (vt.partiti_ext if partiti_sel is None else partiti_sel)
+    )
+    if filtro is not None:
+        piano = lazy.explain()
+        assert "SELECTION" in piano.split("SCAN")[1] and "PROJECT" in piano.split("SCAN")[1]
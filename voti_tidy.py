@@ -1,15 +1,26 @@
+import io
+import os
+import json
+import hashlib
+import warnings
+import itertools
 import polars as pl
 import streamlit as st
-from statsmodels.tsa.statespace.tools import prepare_trend_data
+import istantanea
+import avvio
 
-# legge, modifica i nomi di colonna e restituisce i dati nello stesso formato in cui sono contenuti nel file
-def get_raw_data():
-    file = "Europee2024.txt"
-    voti = pl.read_csv(file, separator=";")
+# file dei risultati scaricato da Eligendo
+RAW_FILE = "Europee2024.txt"
+# versione dello schema salvato in cache: va incrementata se cambia il preprocessing di _parse_raw_data
+CACHE_VERSION = 1
+# memoria di lavoro (in MB) per la lettura dei dati grezzi (vedi aggrega_a_blocchi per cosa comprende): il file
+# viene letto tutto insieme se ci sta, come il file per comune, altrimenti a blocchi. Con None è sempre letto tutto
+MEMORIA_MB = 256
 
-    # togliamo una colonna inutile e rinominiamo per semplificarci la vita
-    # questo sarà il dataframe che rappresenta l'linformazione iniziale "raw"
-    voti: pl.dataframe = (
+
+# toglie una colonna inutile e rinomina le altre, sia su un DataFrame che su un LazyFrame
+def _rinomina(voti):
+    return (
         voti
         .drop("DATA_ELEZIONE")
         .rename({
@@ -21,75 +32,417 @@ def get_raw_data():
         }
         )
     )
+
+
+# legge il file csv originale in modo lazy, toglie una colonna inutile e rinomina le altre
+def _scan_csv(file):
+    voti = pl.scan_csv(file, separator=";")
+
+    # togliamo una colonna inutile e rinominiamo per semplificarci la vita
+    # questo sarà il dataframe che rappresenta l'linformazione iniziale "raw"
+    voti: pl.LazyFrame = _rinomina(voti)
+    return voti
+
+
+# legge il file csv originale, toglie una colonna inutile e rinomina le altre
+def _parse_raw_data(file):
+    return _scan_csv(file).collect()
+
+
+# percorsi della cache colonnare (Arrow IPC) e dei relativi metadati, salvati accanto al file sorgente
+def _cache_paths(file):
+    return f"{file}.arrow", f"{file}.arrow.json"
+
+
+# calcola l'hash sha256 del file leggendolo a blocchi, per non caricarlo tutto in memoria
+def _file_hash(file):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# restituisce i metadati salvati con la cache, oppure None se mancano o sono di una versione diversa
+def _read_cache_meta(meta_file):
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    return meta
+
+
+def _write_cache_meta(meta_file, meta):
+    def scrivi(tmp):
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+
+    _scrivi_atomico(meta_file, scrivi)
+
+
+# scrive file tramite scrivi (che riceve il percorso su cui scrivere) passando per un file temporaneo nella stessa
+# cartella, che poi sostituisce file in modo atomico: chi ha già aperto (o mappato in memoria) il vecchio file continua
+# a leggerlo intero, e un'interruzione a metà scrittura non lascia file incompleti
+def _scrivi_atomico(file, scrivi):
+    tmp = f"{file}.{os.getpid()}.tmp"
+    try:
+        scrivi(tmp)
+        os.replace(tmp, file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# controlla se la cache di file è valida. La cache è invalidata se cambiano dimensione o data di modifica del file
+# sorgente: se cambia solo la data di modifica ma l'hash del contenuto è lo stesso (ad esempio dopo una copia del file)
+# la cache viene mantenuta
+def _cache_valida(file):
+    cache, meta_file = _cache_paths(file)
+    stat = os.stat(file)
+    meta = _read_cache_meta(meta_file)
+
+    if meta is None or not os.path.exists(cache) or meta["size"] != stat.st_size:
+        return False
+    if meta["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    if meta["sha256"] == _file_hash(file):
+        meta["mtime_ns"] = stat.st_mtime_ns
+        _write_cache_meta(meta_file, meta)
+        return True
+    return False
+
+
+# legge, modifica i nomi di colonna e restituisce i dati nello stesso formato in cui sono contenuti nel file.
+# Il risultato viene salvato in una cache Arrow IPC (già con i nomi rinominati) che viene poi letta tramite memory map
+def get_raw_data(file=RAW_FILE):
+    cache, meta_file = _cache_paths(file)
+    if _cache_valida(file):
+        return pl.read_ipc(cache, memory_map=True)
+
+    stat = os.stat(file)
+    voti = _parse_raw_data(file)
+    # se la cartella non è scrivibile lavoriamo comunque, semplicemente senza cache. La cache viene sostituita prima
+    # dei metadati: se il processo si interrompe tra le due scritture, i metadati vecchi non corrispondono al file
+    # sorgente attuale e la cache viene ricreata alla lettura successiva
+    try:
+        # niente compressione, altrimenti il memory map in lettura non sarebbe possibile
+        _scrivi_atomico(cache, lambda tmp: voti.write_ipc(tmp, compression="uncompressed"))
+        _write_cache_meta(meta_file, {
+            "version": CACHE_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": _file_hash(file)
+        })
+    except OSError:
+        pass
     return voti
 
 
+# restituisce i dati grezzi come LazyFrame: filtri e selezioni di colonne applicati in seguito vengono spinti fino
+# alla lettura, così che sia letto solo il necessario. Si legge dalla cache colonnare, creandola se necessario
+def scan_raw_data(file=RAW_FILE):
+    cache, _ = _cache_paths(file)
+    if not _cache_valida(file):
+        get_raw_data(file)
+    if os.path.exists(cache):
+        return pl.scan_ipc(cache, memory_map=True)
+    return _scan_csv(file)
+
+
+# prime n righe dei dati grezzi, come mostrate all'inizio dell'app (dall'istantanea, se presente)
+@istantanea.salvato("anteprima_raw", converti=lambda salvata, argomenti: salvata.head(argomenti["n"]))
+def anteprima_raw(n=4):
+    return get_raw_data().head(n)
+
+
+### Lettura a blocchi, per i file per sezione: il file non viene mai caricato tutto in memoria, ma letto a blocchi
+### di righe che vengono subito aggregati per comune (o per sezione)
+
+# possibili nomi della colonna con il numero di sezione nei file per sezione di Eligendo
+_colonne_sezione = ["SEZIONE", "NUMSEZ", "NUMSEZIONE"]
+# caratteristiche dell'unità di lettura (sezione o comune), ripetute su ogni riga della stessa unità
+_attributi = ["ELETTORI", "ELETTORI_M", "VOTANTI", "VOTANTI_M"]
+
+
+# somma per gruppo delle colonne indicate, che resta nulla se tutti i valori del gruppo sono nulli, come il valore
+# mancante nel pivot. È scritta come somma e conteggio dei valori non nulli, due aggregazioni semplici, e non come
+# when/then dentro l'aggregazione, che nel group_by viene valutato gruppo per gruppo e occupa il doppio della memoria
+def _somma_nulla(df, chiave, colonne):
+    return (
+        df.group_by(chiave, maintain_order=True)
+        .agg(pl.col(colonne).sum(), pl.col(colonne).count().name.suffix("|N"))
+        .select(chiave + [pl.when(pl.col(f"{c}|N") > 0).then(pl.col(c)).alias(c) for c in colonne])
+    )
+
+
+# legge il file csv a blocchi di circa byte_blocco byte, tagliati a fine riga, e restituisce un DataFrame (con le
+# colonne già rinominate e le colonne interi lette come Int64) per blocco. Non usiamo pl.read_csv_batched, che mappa
+# in memoria l'intero file
+def _blocchi(file, byte_blocco, interi):
+    with open(file, "rb") as f:
+        intestazione = f.readline()
+        resto = b""
+        while dati := f.read(byte_blocco):
+            dati = resto + dati
+            fine = dati.rfind(b"\n") + 1
+            resto = dati[fine:]
+            if fine > 0:
+                yield _leggi_blocco(intestazione + dati[:fine], interi)
+        if resto.strip():
+            yield _leggi_blocco(intestazione + resto, interi)
+
+
+# legge un blocco di righe (con l'intestazione) come DataFrame, con gli interi sempre Int64 come nel file intero
+def _leggi_blocco(dati, interi):
+    return _rinomina(pl.read_csv(io.BytesIO(dati), separator=";", schema_overrides={c: pl.Int64 for c in interi}))
+
+
+# converte le colonne di testo di un aggregato in categorie (da usare dentro pl.StringCache, così che gli aggregati
+# dei blocchi si possano unire): le stringhe di polars sono viste sui buffer del blocco letto, che resterebbe
+# altrimenti in memoria per intero finché ne viene usato anche solo un aggregato
+def _stacca(df):
+    return df.with_columns(pl.col(pl.String).cast(pl.Categorical))
+
+
+# legge il file a blocchi e restituisce i voti assoluti nello stesso formato di votiAbs (senza VOTI_VALIDI): una riga
+# per comune (o per sezione, con per_sezione=True), nell'ordine in cui compaiono nel file, con le liste in colonna.
+# Come nei file di Eligendo, le righe di uno stesso comune (e di una stessa sezione) devono essere consecutive: ogni
+# blocco viene così aggregato e messo in colonna da solo, e solo il primo comune di un blocco può dover essere sommato
+# all'ultimo del blocco precedente. Le caratteristiche di ogni sezione sono contate una sola volta anche se le sue
+# righe sono divise tra due blocchi; quelle assenti dal file (e.g. VOTANTI_M) restano assenti anche nel risultato.
+# memoria_mb è la memoria di lavoro della lettura: un blocco, tra copia dei byte e parsing, arriva a occupare circa
+# dieci volte la sua dimensione su disco, da cui la dimensione dei blocchi. Il picco del processo resta così entro
+# circa memoria_mb più il risultato, che si accumula blocco per blocco, e un costo fisso di polars di qualche decina
+# di MB, che non dipendono da memoria_mb e ne fanno un limite inferiore pratico
+def aggrega_a_blocchi(file=RAW_FILE, memoria_mb=256, per_sezione=False):
+    # l'intestazione è letta direttamente: anche con n_rows=0, pl.read_csv carica l'intero file
+    with open(file) as f:
+        intestazione = f.readline().strip().split(";")
+    sezione = [c for c in _colonne_sezione if c in intestazione][:1]
+    attributi = [c for c in _attributi if c in intestazione]
+    unita = livelli + sezione
+    chiave = unita if per_sezione else livelli
+
+    # righe già complete del risultato e liste nell'ordine in cui compaiono
+    parti, liste = [], []
+    # ultima unità letta e ultima riga del risultato, che può continuare nel blocco successivo
+    ultima, pendente = None, None
+    with pl.StringCache():
+        for blocco in _blocchi(file, int(memoria_mb * 2 ** 20 / 10), attributi + ["NUMVOTI"]):
+            nuove = blocco.unique(unita, keep="first", maintain_order=True).select(unita + attributi)
+            # solo la prima unità del blocco può essere già stata contata, alla fine del blocco precedente
+            if ultima is not None and _stacca(nuove.head(1).select(unita)).equals(ultima):
+                nuove = nuove.slice(1)
+            if nuove.height > 0:
+                ultima = _stacca(nuove.tail(1).select(unita))
+            largo = _stacca(
+                _somma_nulla(blocco, chiave + ["LISTA"], ["NUMVOTI"])
+                .pivot(on="LISTA", index=chiave, values="NUMVOTI")
+                .join(nuove.group_by(chiave, maintain_order=True).agg(pl.col(attributi).sum()), on=chiave, how="left")
+            )
+            liste += [c for c in largo.columns if c not in chiave + attributi + liste]
+            # il blocco viene liberato prima di leggere il successivo
+            del blocco, nuove
+
+            if pendente is not None and largo.head(1).select(chiave).equals(pendente.select(chiave)):
+                divisa = pl.concat([pendente, largo.head(1)], how="diagonal_relaxed")
+                largo = pl.concat(
+                    [_somma_nulla(divisa, chiave, [c for c in divisa.columns if c not in chiave]), largo.slice(1)],
+                    how="diagonal_relaxed"
+                )
+            elif pendente is not None:
+                parti.append(pendente)
+            parti.append(largo.head(-1))
+            pendente = largo.tail(1)
+
+        risultato = pl.concat(parti + [pendente], how="diagonal_relaxed")
+        return risultato.select(chiave + attributi + liste).with_columns(pl.col(pl.Categorical).cast(pl.String))
+
+
+# espressione della percentuale di un partito sui voti validi.
+# Per una questione di visualizzazione in Streamlit, arrotondiamo tutto alla seconda cifra decimale
+def _quota(partito):
+    return (pl.col(partito) / pl.col("VOTI_VALIDI") * 100).round(2).alias(partito)
+
+
+# espressione della percentuale di un blocco di partiti (definito in blocchi), come somma delle percentuali già
+# arrotondate dei partiti che lo compongono, così che resti uguale alla somma dei valori mostrati per ogni partito.
+# I partiti non candidati in un comune contano come 0
+def _quota_blocco(nome):
+    return pl.sum_horizontal([_quota(partito) for partito in get_blocchi()[nome]]).alias(nome)
+
+
 # effettua il preprocessing, creando un dataset per i voti in valore assoluto e uno per i voti espressi sulla percentuale
 # dei voti validi, dove ogni comune è una unità statistica e i risultati di ogni lista una variabile
 @st.cache_data
-def data_preprocessing():
-    voti = get_raw_data()
-
-    # effettuamo un pivot per rendere il singolo comune l'unità statistica e il numero di voti di ogni lista una variabile
-    abs: pl.DataFrame = (
-        voti
-        .pivot(on="LISTA", values="NUMVOTI")
-        .with_columns(
-            VOTI_VALIDI=pl.sum_horizontal(partiti)
-        )
+@istantanea.salvato(("voti_abs", "voti_perc"))
+def data_preprocessing(memoria_mb=None):
+    # MEMORIA_MB è letta qui e non come valore predefinito, così che conti il valore al momento della chiamata
+    memoria_mb = MEMORIA_MB if memoria_mb is None else memoria_mb
+    # come un blocco di aggrega_a_blocchi, il file letto tutto insieme occupa circa dieci volte la sua dimensione
+    if memoria_mb is None or not os.path.exists(RAW_FILE) or os.path.getsize(RAW_FILE) * 10 <= memoria_mb * 2 ** 20:
+        # effettuamo un pivot per rendere il singolo comune l'unità statistica e il numero di voti di ogni lista una variabile
+        raw = get_raw_data()
+        abs: pl.DataFrame = raw.pivot(on="LISTA", values="NUMVOTI")
+        # in un file per sezione il pivot dà una riga per sezione: come in aggrega_a_blocchi le sommiamo per comune
+        sezione = [c for c in _colonne_sezione if c in raw.columns][:1]
+        if sezione:
+            attributi = [c for c in _attributi if c in raw.columns]
+            liste = [c for c in abs.columns if c not in raw.columns]
+            abs = _somma_nulla(abs, livelli, attributi + liste)
+    else:
+        # stesso risultato, leggendo il file a blocchi con la memoria di lavoro indicata
+        abs: pl.DataFrame = aggrega_a_blocchi(RAW_FILE, memoria_mb)
+    abs = abs.with_columns(
+        VOTI_VALIDI=pl.sum_horizontal(partiti)
     )
 
-    # inizializza il dataframe per le percentuali di voto per partito
+    # crea il dataframe votiPerc affiancando alle colonne delle caratteristiche dei comuni le percentuali di ogni partito
+    # e delle coalizioni, tutto in un'unica select
     perc: pl.DataFrame = abs.select(
         ["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE", "ELETTORI", "ELETTORI_M", "VOTANTI"]
+        + [_quota(partito) for partito in partiti]
+        + [_quota_blocco(nome) for nome in coalizioni]
+        + [(pl.col("VOTANTI") / pl.col("ELETTORI") * 100).alias("AFFLUENZA")]
     )
-    # crea il dataframe votiPerc aggiungendo alle colonne delle caratteristiche dei comuni le percentuali di ogni partito
-    for partito in partiti:
-        perc = perc.with_columns(
-            # per una questione di visualizzazione in Streamlit, arrotondiamo tutto alla seconda cifra decimale
-            (abs.get_column(partito) / abs.get_column("VOTI_VALIDI") * 100).round(2).alias(partito)
+    return abs, perc
+
+### API lazy: ogni funzione restituisce un LazyFrame, così che filtri geografici e selezioni di partiti o colonne
+### vengano spinti fino alla lettura dei dati grezzi e sia materializzato solo quanto serve
+
+# livelli geografici in ordine gerarchico, dal più ampio al più piccolo
+livelli = ["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE"]
+
+# colonne di votiPerc che descrivono il comune (oltre ai livelli geografici)
+colonne_comune = ["ELETTORI", "ELETTORI_M", "VOTANTI"]
+
+
+# equivalente lazy di votiAbs: il pivot è scritto come group_by per comune, in cui il numero di voti di ogni lista è
+# l'unico valore NUMVOTI di quella lista (nullo se la lista non era candidata nel comune).
+# - filtro: espressione polars sui dati grezzi, ad esempio pl.col("REGIONE") == "VENETO"
+# - partiti_sel: partiti di cui calcolare le colonne (di default tutti)
+# - colonne: colonne descrittive del comune da mantenere oltre ai livelli geografici (di default tutte)
+# VOTI_VALIDI è comunque calcolato su tutti i partiti
+def scan_voti_abs(filtro=None, partiti_sel=None, colonne=None):
+    raw = scan_raw_data()
+    if filtro is not None:
+        raw = raw.filter(filtro)
+    if partiti_sel is None:
+        partiti_sel = partiti
+    if colonne is None:
+        colonne = [c for c in raw.collect_schema().names() if c not in livelli + ["LISTA", "NUMVOTI"]]
+
+    return (
+        raw
+        .group_by(livelli, maintain_order=True)
+        .agg(
+            [pl.col(c).first() for c in colonne]
+            + [pl.col("NUMVOTI").filter(pl.col("LISTA") == partito).first().alias(partito) for partito in partiti_sel]
+            + [pl.col("NUMVOTI").filter(pl.col("LISTA").is_in(partiti)).sum().alias("VOTI_VALIDI")]
         )
-    perc = perc.with_columns(
-        CENTRODESTRA=pl.col("FRATELLI D'ITALIA") + pl.col("LEGA SALVINI PREMIER") + pl.col("FORZA ITALIA - NOI MODERATI - PPE"),
-        CENTROSINISTRA=pl.col("PARTITO DEMOCRATICO") + pl.col("MOVIMENTO 5 STELLE") + pl.col("ALLEANZA VERDI E SINISTRA"),
-        AFFLUENZA=pl.col("VOTANTI") / pl.col("ELETTORI") * 100
     )
-    return abs, perc
 
-# restituisce un dataframe polars contenente le percentuali di voto di tutti i partiti per un certo livello geografico
+
+# equivalente lazy di votiPerc, con gli stessi argomenti di scan_voti_abs. partiti_sel può contenere anche i blocchi
+# definiti in blocchi; in colonne si può indicare anche AFFLUENZA
+def scan_voti_perc(filtro=None, partiti_sel=None, colonne=None):
+    if partiti_sel is None:
+        partiti_sel = partiti_ext
+    if colonne is None:
+        colonne = colonne_comune + ["AFFLUENZA"]
+
+    # servono le colonne assolute dei partiti richiesti e di quelli che compongono i blocchi richiesti
+    necessari = set()
+    for nome in partiti_sel:
+        necessari.update(get_blocchi().get(nome, [nome]))
+    descrittive = [c for c in colonne if c != "AFFLUENZA"]
+    if "AFFLUENZA" in colonne:
+        descrittive = list(dict.fromkeys(descrittive + ["VOTANTI", "ELETTORI"]))
+    voti_abs = scan_voti_abs(filtro, [partito for partito in partiti if partito in necessari], descrittive)
+
+    derivate = {"AFFLUENZA": (pl.col("VOTANTI") / pl.col("ELETTORI") * 100).alias("AFFLUENZA")}
+    return voti_abs.select(
+        livelli
+        + [derivate.get(c, c) for c in colonne]
+        + [_quota_blocco(nome) if nome in get_blocchi() else _quota(nome) for nome in partiti_sel]
+    )
+
+
+# calcola il dataframe con le percentuali di voto di tutti i partiti per ogni unità di un certo livello geografico
 # (italia, circorscizione, regione, provincia o comune)
-# se specificata la condizione cond, restituisce solo quel circ/reg/prov/comune
-def voti_grouped_by(livello, cond=None):
+def _voti_level(livello):
     if livello == "ITALIA":
-        abs_gr = votiAbs.sum()
-        # return votiAbs.sum()
+        abs_gr = get_voti()[0].sum()
     else:
-        abs_gr = (
-            get_raw_data()
-            .select(
-                ["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE", "LISTA", "NUMVOTI"]
-            )
-            .group_by([livello, "LISTA"])
-            .sum()
-            .pivot(
-                on="LISTA",
-                values="NUMVOTI"
-            )
-            .with_columns(
-                VOTI_VALIDI=pl.sum_horizontal(partiti)
-            )
+        # aggreghiamo votiAbs e non i dati grezzi, che con i file per sezione non vogliamo caricare tutti in memoria.
+        # Un partito mai candidato nell'unità resta nullo, le colonne degli altri livelli sono nulle come in sum()
+        abs_gr = _somma_nulla(get_voti()[0], [livello], partiti).with_columns(
+            [pl.lit(None, dtype=pl.String).alias(c) for c in livelli if c != livello],
+            VOTI_VALIDI=pl.sum_horizontal(partiti)
         )
 
-    perc_gr = abs_gr.select(["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE"])
-    for partito in partiti:
-        perc_gr = perc_gr.with_columns(
-            (abs_gr.get_column(partito) / abs_gr.get_column("VOTI_VALIDI") * 100).round(2).alias(partito)
+    perc_gr = abs_gr.select(
+        ["CIRCOSCRIZIONE", "REGIONE", "PROVINCIA", "COMUNE"] + [_quota(partito) for partito in partiti]
+    )
+    return perc_gr
+
+
+# cubo delle aggregazioni, calcolato una sola volta per tutti i livelli più ITALIA. Restituisce tre dizionari:
+# - tabelle: livello -> dataframe con tutte le unità di quel livello, ordinate per nome
+# - righe: (livello, nome) -> (prima riga, numero di righe) di quell'unità nella tabella del livello. Non teniamo un
+#   dataframe per unità: con centinaia di migliaia di comuni, i dataframe di una riga occupano molta più memoria
+#   della tabella stessa, mentre una fetta della tabella non copia i dati
+# - figli: (livello, nome) -> lista ordinata delle unità del livello successivo contenute in quella unità
+# usiamo cache_resource e non cache_data per non copiare l'intero cubo ad ogni accesso
+@st.cache_resource
+def voti_cube():
+    # le tabelle e la gerarchia sono lette dall'istantanea, se presente; le righe sono comunque ricavate qui
+    salvate = {livello: istantanea.leggi(f"cubo_{livello}") for livello in ["ITALIA"] + livelli}
+    tabelle = {livello: _voti_level(livello) if tabella is None else tabella for livello, tabella in salvate.items()}
+    righe = {}
+    for livello in livelli:
+        tabelle[livello] = tabelle[livello].sort(livello, maintain_order=True)
+        gruppi = tabelle[livello].get_column(livello).rle()
+        lunghezze = gruppi.struct.field("len").to_list()
+        inizi = itertools.accumulate(lunghezze, initial=0)
+        righe.update(
+            ((livello, nome), (inizio, n)) for nome, inizio, n in zip(gruppi.struct.field("value"), inizi, lunghezze)
         )
 
-    if livello == "ITALIA" or cond is None:
-        return perc_gr
+    salvati = istantanea.leggi_json("cubo_figli")
+    if salvati is not None:
+        figli = {(livello, nome): sotto for livello, nome, sotto in salvati}
     else:
-        return perc_gr.filter(pl.col(livello) == cond)
+        gerarchia = get_voti()[1].select(livelli).unique()
+        figli = {("ITALIA", None): sorted(gerarchia.get_column("CIRCOSCRIZIONE").unique().to_list())}
+        for padre, figlio in zip(livelli[:-1], livelli[1:]):
+            for (nome,), sotto in gerarchia.partition_by(padre, as_dict=True).items():
+                figli[(padre, nome)] = sorted(sotto.get_column(figlio).unique().to_list())
+
+    return tabelle, righe, figli
+
+
+# restituisce un dataframe polars contenente le percentuali di voto di tutti i partiti per un certo livello geografico
+# (italia, circorscizione, regione, provincia o comune)
+# se specificata la condizione cond, restituisce solo quel circ/reg/prov/comune
+def voti_grouped_by(livello, cond=None):
+    tabelle, righe, _ = voti_cube()
+    if livello == "ITALIA" or cond is None:
+        return tabelle[livello]
+    if (livello, cond) in righe:
+        return tabelle[livello].slice(*righe[(livello, cond)])
+    # se l'unità non esiste restituiamo un dataframe vuoto, come farebbe un filter
+    return tabelle[livello].clear()
+
+
+# restituisce la lista ordinata delle unità del livello successivo contenute in (livello, nome),
+# ad esempio le regioni di una circoscrizione. Con livello "ITALIA" restituisce le circoscrizioni
+def sottolivelli(livello, nome=None):
+    _, _, figli = voti_cube()
+    return figli.get((livello, nome), [])
 
 
 # scriviamo a mano per tenere questo preciso ordine
@@ -111,8 +464,6 @@ partiti = [
     "RASSEMBLEMENT VALDÔTAIN"
 ]
 
-partiti_ext = partiti + ["CENTRODESTRA", "CENTROSINISTRA"]
-
 # partiti oltre il 3%
 partitiPlot = [
     "FRATELLI D'ITALIA",
@@ -127,13 +478,94 @@ partitiPlot = [
 
 # colors = ["blue","red","yellow","lightblue","darkgreen","lightgreen","purple","darkblue"]
 colors = ["#1f77b4","#d62728","#e7ba52","#aec7e8","#2ca02c","#98df8a","#9467bd","#393b79"]
-# dati iniziali già preprocessati
-votiAbs, votiPerc = data_preprocessing()
+
+# blocchi di partiti (coalizioni, aree politiche, "altri") definiti come elenco dei partiti che li compongono.
+# Ulteriori blocchi possono essere aggiunti, senza modificare il codice, nel file BLOCCHI_FILE, nella forma
+# {"NOME BLOCCO": ["PARTITO 1", "PARTITO 2", ...]}
+blocchi = {
+    "CENTRODESTRA": ["FRATELLI D'ITALIA", "LEGA SALVINI PREMIER", "FORZA ITALIA - NOI MODERATI - PPE"],
+    "CENTROSINISTRA": ["PARTITO DEMOCRATICO", "MOVIMENTO 5 STELLE", "ALLEANZA VERDI E SINISTRA"],
+    "ALTRI": [partito for partito in partiti if partito not in partitiPlot]
+}
+BLOCCHI_FILE = "blocchi.json"
+
+# blocchi sempre presenti come colonne di votiPerc
+coalizioni = ["CENTRODESTRA", "CENTROSINISTRA"]
+
+partiti_ext = partiti + coalizioni
+
+# indica se il file di configurazione dei blocchi è già stato letto
+_blocchi_caricati = False
+
+
+# restituisce i blocchi predefiniti più quelli contenuti nel file di configurazione, se presente. Il file viene letto
+# alla prima richiesta e non all'importazione del modulo; i blocchi che contengono partiti sconosciuti (o l'intero
+# file, se non è leggibile) vengono ignorati con un avviso
+def get_blocchi():
+    global _blocchi_caricati
+    if not _blocchi_caricati:
+        _blocchi_caricati = True
+        if os.path.exists(BLOCCHI_FILE):
+            try:
+                with open(BLOCCHI_FILE) as f:
+                    nuovi = dict(json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                warnings.warn(f"{BLOCCHI_FILE} ignorato: {e}")
+                nuovi = {}
+            for nome, membri in nuovi.items():
+                if not isinstance(membri, list):
+                    warnings.warn(f"Il blocco {nome} non è un elenco di partiti ed è ignorato")
+                    continue
+                sconosciuti = [partito for partito in membri if partito not in partiti]
+                if sconosciuti:
+                    warnings.warn(f"Il blocco {nome} contiene partiti sconosciuti ed è ignorato: {sconosciuti}")
+                else:
+                    blocchi[nome] = membri
+    return blocchi
+
+
+# percentuali dei blocchi non presenti in votiPerc, calcolate solo alla prima richiesta
+_cache_blocchi = {}
+
+
+# restituisce la serie delle percentuali per comune di un blocco. I blocchi in coalizioni sono già in votiPerc,
+# gli altri vengono calcolati da votiAbs con una sola espressione alla prima richiesta e poi tenuti in memoria
+def voti_blocco(nome):
+    abs, perc = get_voti()
+    if nome in coalizioni:
+        return perc.get_column(nome)
+    if nome not in _cache_blocchi:
+        _cache_blocchi[nome] = abs.select(_quota_blocco(nome)).to_series()
+    return _cache_blocchi[nome]
+
+
+# restituisce votiPerc con in più le colonne dei blocchi richiesti
+def voti_con_blocchi(nomi):
+    return get_voti()[1].with_columns([voti_blocco(nome) for nome in nomi if nome not in coalizioni])
+
+
+# dati iniziali già preprocessati (votiAbs e votiPerc). Vengono calcolati alla prima richiesta, e non all'importazione
+# del modulo, e poi restano in memoria come variabili globali
+def get_voti():
+    global votiAbs, votiPerc
+    if "votiPerc" not in globals():
+        with avvio.misura("voti_tidy.votiAbs, votiPerc"):
+            votiAbs, votiPerc = data_preprocessing()
+    return votiAbs, votiPerc
+
+
+# vt.votiAbs e vt.votiPerc restano utilizzabili come variabili globali: al primo accesso vengono calcolate con
+# get_voti (vedi PEP 562)
+def __getattr__(nome):
+    if nome in ("votiAbs", "votiPerc"):
+        return get_voti()[nome == "votiPerc"]
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
 
 
 if __name__ == "__main__":
     pl.Config.set_tbl_width_chars(200)
     pl.Config(tbl_cols=30)
+    votiAbs, votiPerc = get_voti()
     print("VOTI:")
     print(get_raw_data())
     print(votiPerc)